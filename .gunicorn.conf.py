@@ -1,4 +1,69 @@
+import os
+from config import Config
+from utils.concurrency import hold_background_threads
+
+# This file runs in the master only (workers are forked from it); keep the
+# log listener and metrics flusher out of it, even with preload_app
+hold_background_threads()
+
 bind = "0.0.0.0:10000"
-workers = 2
-threads = 4
-timeout = 120
\ No newline at end of file
+workers = Config.GUNICORN_WORKERS
+threads = Config.GUNICORN_THREADS
+timeout = 120
+
+# SERVING_MODE picks the worker class, so both modes can be benchmarked on
+# the same box with the same routes:
+#   threaded  gthread: workers * threads requests in flight; a slow query or
+#             upload holds one of those threads until it's done
+#   async     gevent: each request is a greenlet; sockets, psycopg2 (patched
+#             below) and pool checkouts yield while they wait, so a worker
+#             carries up to ASYNC_WORKER_CONNECTIONS requests. It also serves
+#             /api/stream connections without tying up threads.
+# GUNICORN_WORKER_CLASS still overrides the class directly.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or ('gevent' if Config.SERVING_MODE == 'async' else 'gthread')
+if worker_class == 'gevent':
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', Config.ASYNC_WORKER_CONNECTIONS))
+
+# Each worker keeps its own SQLAlchemy pool (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+# Size it to at least `threads` so request threads never queue on checkout;
+# total Postgres connections = workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+
+
+def on_starting(server):
+    if worker_class == 'gevent' and Config.DATABASE_URL.startswith('sqlite'):
+        # sqlite3 calls (and busy_timeout waits) block the whole event loop
+        server.log.warning('Async serving mode on SQLite: database calls will not yield; use PostgreSQL')
+
+    # Migrate once in the master, so workers boot against a current schema
+    # instead of racing each other through DDL
+    from models.migrations import migrate
+    from database import dispose_engine
+    migrate()
+    dispose_engine()
+
+    # Per-worker metric snapshots from the previous run (see utils/metrics.py)
+    from utils.metrics import reset_metrics
+    reset_metrics()
+
+    # Fingerprint and precompress the frontend before workers load the manifest
+    if Config.ASSET_BUILD_ON_START:
+        from utils.assets import build_assets
+        build_assets()
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # Let psycopg2 yield to other greenlets while waiting on Postgres
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    # Never share pooled sockets inherited from the master (e.g. with --preload)
+    from database import dispose_engine
+    dispose_engine(close=False)
+
+
+def post_worker_init(worker):
+    # Job pollers (utils/jobs.py) start here rather than in post_fork: under
+    # gevent that is before threading is patched
+    from utils.jobs import start_workers
+    start_workers()
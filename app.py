@@ -1,36 +1,71 @@
-from flask import Flask
+from flask import Flask, jsonify
 from flask_cors import CORS
 from config import Config
-from models.user import init_db
+from database import get_pool_stats
+from utils.passwords import get_hashing_stats
+from utils.log import get_log_stats
+from utils.serialization import FastJSONProvider
+from utils.ratelimit import get_rate_limit_stats
+from utils.admission import configure_admission_control, get_admission_stats
+from utils.auth import get_revocation_stats
+from utils.jobs import get_job_stats
+from models.rating_breakdowns import get_rating_cache_stats
+from models.migrations import ensure_schema
 from routes.auth_routes import configure_auth_routes
 from routes.user_routes import configure_user_routes
 from routes.rating_routes import configure_rating_routes
 from routes.preference_routes import configure_preference_routes
+from routes.picture_routes import configure_picture_routes
+from routes.matchday_routes import configure_matchday_routes
+from routes.leaderboard_routes import configure_leaderboard_routes
+from routes.analytics_routes import configure_analytics_routes
+from routes.stream_routes import configure_stream_routes
+from routes.asset_routes import configure_asset_routes
+from routes.metrics_routes import configure_metrics_routes
 
 app = Flask(__name__,
     static_folder='static',
     static_url_path='',
     template_folder='static')
 app.config.from_object(Config)
+app.json = FastJSONProvider(app)
 CORS(app, supports_credentials=True)
 
-# Initialize database BEFORE configuring routes
-init_db()
+# Check the schema BEFORE configuring routes. Migrations normally run once per
+# deploy (python -m models.migrations upgrade, or the gunicorn master); this
+# is a single SELECT when the schema is already current.
+ensure_schema()
 
 # Configure routes
+configure_metrics_routes(app)
+# After the metrics hooks, so shed requests are still counted
+configure_admission_control(app)
 configure_auth_routes(app)
 configure_user_routes(app)
 configure_preference_routes(app)
 configure_rating_routes(app)
+configure_picture_routes(app)
+configure_matchday_routes(app)
+configure_leaderboard_routes(app)
+configure_analytics_routes(app)
+configure_stream_routes(app)
+configure_asset_routes(app)
 
-@app.route('/')
-def serve_frontend():
-    return app.send_static_file('index.html')
-
-@app.route('/<path:path>')
-def serve_static(path):
-    return app.send_static_file(path)
+@app.route('/api/debug/pool', methods=['GET'])
+def debug_pool():
+    """This worker's pools, queues, caches, load shedding, token revocations and background jobs"""
+    return jsonify({
+        'pool': get_pool_stats(),
+        'password_hashing': get_hashing_stats(),
+        'logging': get_log_stats(),
+        'rating_cache': get_rating_cache_stats(),
+        'rate_limits': get_rate_limit_stats(),
+        'admission': get_admission_stats(),
+        'token_revocations': get_revocation_stats(),
+        'jobs': get_job_stats(),
+    }), 200
 
 if __name__ == '__main__':
-    # Don't call init_db() here again - it's already called above
+    from utils.jobs import start_workers
+    start_workers()
     app.run(debug=False, host='0.0.0.0', port=5000)  # Changed for production
\ No newline at end of file
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Load test against the real Flask app (app.app) through its test client, so
+# it measures routing, auth, SQL and serialization without a network in the
+# way. Each virtual user walks the signup flow
+#
+#     register -> login -> save preferences -> rate players -> list users
+#     -> view ratings -> leaderboard
+#
+# against a freshly seeded league (bench/seed.py), or one restored from a
+# snapshot with --snapshot, and the results are written as JSON. With
+# --baseline, p50/p99 regressions beyond --tolerance fail the run.
+#
+#     python -m bench.run --database-url sqlite:////tmp/bench.db --output bench.json
+#     python -m bench.run --database-url postgresql://localhost/fantasyfc_bench \
+#         --baseline bench.json
+#
+# --serving-mode async runs the virtual users as greenlets under gevent's
+# monkey patching (the same setup as the gevent workers), so the two serving
+# modes can be compared at the same --concurrency.
+
+# Endpoints compared against a baseline; others are reported only
+GATED_ENDPOINTS = {'GET /api/users', 'POST /api/ratings/<int:user_id>'}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='FantasyFC benchmark')
+    parser.add_argument('--database-url', default=None,
+                        help='database to seed and test against (wiped); default: a temporary SQLite file')
+    parser.add_argument('--users', type=int, default=200, help='seeded league size')
+    parser.add_argument('--density', type=float, default=0.5, help='share of user pairs with a rating')
+    parser.add_argument('--picture-bytes', type=int, default=60000)
+    parser.add_argument('--snapshot', help='restore this league snapshot instead of seeding one '
+                                           '(python -m models.snapshot export)')
+    parser.add_argument('--concurrency', type=int, default=4, help='virtual users running at once')
+    parser.add_argument('--serving-mode', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--flows', type=int, default=5, help='signup flows per virtual user')
+    parser.add_argument('--ratings-per-flow', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='allowed slowdown factor before a gated endpoint counts as a regression')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir):
+    """Point Config at the bench database and throwaway stores (before anything imports it)"""
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('PICTURE_STORAGE_PATH', os.path.join(workdir, 'pictures'))
+    os.environ.setdefault('VERSION_STORE_PATH', os.path.join(workdir, 'versions'))
+    os.environ.setdefault('METRICS_PATH', os.path.join(workdir, 'metrics'))
+    os.environ.setdefault('EVENT_FANOUT', 'local')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # Every simulated client shares one address; per-IP limits would throttle the run
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+    os.environ['SERVING_MODE'] = args.serving_mode
+
+
+def enable_async_mode():
+    """What the gevent worker does at boot, before the app is imported"""
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Recorder:
+    """Latency, status and query count per endpoint, shared by the virtual users"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.local = threading.local()
+
+    def on_request_finished(self, sender, response, **extra):
+        # Runs in the request's own thread while g is still populated
+        from flask import g, request
+        self.local.endpoint = f"{request.method} {request.url_rule.rule if request.url_rule else 'unmatched'}"
+        self.local.queries = g.get('db_queries', 0)
+
+    def call(self, client, method, path, **kwargs):
+        self.local.endpoint = None
+        self.local.queries = 0
+        started = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        elapsed = time.perf_counter() - started
+
+        endpoint = self.local.endpoint or f'{method} {path}'
+        with self._lock:
+            sample = self.samples.setdefault(endpoint, {'latencies': [], 'queries': [], 'statuses': {}})
+            sample['latencies'].append(elapsed)
+            sample['queries'].append(self.local.queries)
+            status = str(response.status_code)
+            sample['statuses'][status] = sample['statuses'].get(status, 0) + 1
+        return response
+
+    def summary(self, wall_time):
+        endpoints = {}
+        for endpoint, sample in sorted(self.samples.items()):
+            latencies = sample['latencies']
+            errors = sum(count for status, count in sample['statuses'].items() if int(status) >= 500)
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'errors': errors,
+                'statuses': sample['statuses'],
+                'throughput_rps': round(len(latencies) / wall_time, 2),
+                'latency_ms': {
+                    'mean': round(1000 * sum(latencies) / len(latencies), 3),
+                    'p50': round(1000 * percentile(latencies, 0.50), 3),
+                    'p90': round(1000 * percentile(latencies, 0.90), 3),
+                    'p99': round(1000 * percentile(latencies, 0.99), 3),
+                    'max': round(1000 * max(latencies), 3),
+                },
+                'queries_per_request': {
+                    'mean': round(sum(sample['queries']) / len(sample['queries']), 2),
+                    'max': max(sample['queries']),
+                },
+            }
+        return endpoints
+
+
+def signup_flow(recorder, client, rng, league_ids, worker, flow, ratings_per_flow):
+    from bench.seed import make_picture, picture_data_url, BENCH_PASSWORD
+
+    email = f'bench-{worker}-{flow}-{rng.getrandbits(32):08x}@bench.local'
+    recorder.call(client, 'POST', '/api/register', json={'email': email, 'password': BENCH_PASSWORD, 'name': email})
+    response = recorder.call(client, 'POST', '/api/login', json={'email': email, 'password': BENCH_PASSWORD})
+    token = (response.get_json() or {}).get('token')
+    if not token:
+        # Registration failed (it is still reported); carry on as a seeded
+        # player so the rest of the flow is measured rather than 401s
+        email = f'player{rng.choice(league_ids)}@bench.local'
+        response = recorder.call(client, 'POST', '/api/login', json={'email': email, 'password': BENCH_PASSWORD})
+        token = (response.get_json() or {}).get('token')
+        if not token:
+            return
+    headers = {'Authorization': f'Bearer {token}'}
+
+    recorder.call(client, 'POST', '/api/preferences', headers=headers, json={
+        'position': rng.choice(['Goalkeeper', 'Defender', 'Midfielder', 'Forward']),
+        'favorite_team': 'Bench FC',
+        'picture': picture_data_url(make_picture(rng, 20000)),
+        'slogan': 'Benchmarking',
+    })
+
+    for rated_id in rng.sample(league_ids, min(ratings_per_flow, len(league_ids))):
+        recorder.call(client, 'POST', f'/api/ratings/{rated_id}', headers=headers,
+                      json={f'skill_{i}': rng.randint(0, 100) for i in range(1, 7)})
+
+    recorder.call(client, 'GET', '/api/users', headers=headers)
+    recorder.call(client, 'GET', f'/api/ratings/{rng.choice(league_ids)}', headers=headers)
+    recorder.call(client, 'GET', '/api/leaderboard', headers=headers)
+
+
+def compare(results, baseline, tolerance):
+    """Gated endpoints whose p50 or p99 got slower than tolerance allows"""
+    regressions = []
+    for endpoint in sorted(GATED_ENDPOINTS):
+        now = results['endpoints'].get(endpoint)
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if not now or not before:
+            continue
+        for stat in ('p50', 'p99'):
+            if now['latency_ms'][stat] > before['latency_ms'][stat] * tolerance:
+                regressions.append(
+                    f"{endpoint} {stat}: {before['latency_ms'][stat]}ms -> {now['latency_ms'][stat]}ms"
+                )
+        if now['queries_per_request']['mean'] > before['queries_per_request']['mean']:
+            regressions.append(
+                f"{endpoint} queries/request: {before['queries_per_request']['mean']} -> "
+                f"{now['queries_per_request']['mean']}"
+            )
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='fantasyfc-bench-')
+    configure_environment(args, workdir)
+    if args.serving_mode == 'async':
+        # Patched threading makes the virtual users below greenlets
+        enable_async_mode()
+
+    from flask import request_finished
+    from bench.seed import seed_league, restore_league
+    from utils.jobs import start_workers
+    from app import app
+
+    # This process is the app server here, so it runs the job pollers too
+    start_workers()
+
+    if args.snapshot:
+        print(f"Restoring {args.snapshot} into {os.environ['DATABASE_URL']}")
+        league_ids = restore_league(args.snapshot)
+    else:
+        print(f"Seeding {args.users} users (density {args.density}) into {os.environ['DATABASE_URL']}")
+        league_ids = seed_league(args.users, args.density, args.picture_bytes, seed=args.seed)
+
+    recorder = Recorder()
+    request_finished.connect(recorder.on_request_finished, app)
+
+    def virtual_user(worker):
+        rng = random.Random(args.seed * 1000 + worker)
+        client = app.test_client()
+        for flow in range(args.flows):
+            signup_flow(recorder, client, rng, league_ids, worker, flow, args.ratings_per_flow)
+
+    threads = [threading.Thread(target=virtual_user, args=(worker,)) for worker in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+
+    endpoints = recorder.summary(wall_time)
+    total_requests = sum(endpoint['requests'] for endpoint in endpoints.values())
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'database': os.environ['DATABASE_URL'].split('://', 1)[0],
+            **{key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        },
+        'wall_time_s': round(wall_time, 3),
+        'requests': total_requests,
+        'throughput_rps': round(total_requests / wall_time, 2),
+        'endpoints': endpoints,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{total_requests} requests in {wall_time:.1f}s ({results['throughput_rps']} req/s)")
+    print(f"{'endpoint':45} {'n':>5} {'err':>4} {'p50 ms':>9} {'p99 ms':>9} {'q/req':>6}")
+    for endpoint, stats in endpoints.items():
+        print(f"{endpoint:45} {stats['requests']:>5} {stats['errors']:>4} "
+              f"{stats['latency_ms']['p50']:>9} {stats['latency_ms']['p99']:>9} "
+              f"{stats['queries_per_request']['mean']:>6}")
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions against baseline:')
+            for regression in regressions:
+                print(f'  {regression}')
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import base64
+import io
+import os
+import random
+import sys
+import sqlalchemy as sa
+
+# Synthetic league for benchmarks: users with preferences, stored pictures of
+# a realistic size and a dense rating matrix. Deterministic for a given seed,
+# so runs against the same parameters are comparable.
+#
+# Imports of app modules happen inside functions: the caller sets
+# DATABASE_URL (and friends) in the environment before Config is loaded.
+
+POSITIONS = ['Goalkeeper', 'Defender', 'Midfielder', 'Forward']
+TEAMS = ['Real Madrid', 'Barcelona', 'Bayern', 'Liverpool', 'Juventus', 'PSG', 'Inter', 'Ajax']
+BENCH_PASSWORD = 'bench-password'
+# Rows per INSERT while seeding user_ratings
+RATING_CHUNK = 500
+
+
+def make_picture(rng, size_bytes):
+    """PNG of roughly size_bytes (noise doesn't compress), as raw bytes"""
+    from PIL import Image
+
+    # 3 bytes per pixel of noise is about what the PNG ends up weighing
+    side = max(8, int((size_bytes / 3) ** 0.5))
+    noise = bytes(rng.getrandbits(8) for _ in range(side * side * 3))
+    output = io.BytesIO()
+    Image.frombytes('RGB', (side, side), noise).save(output, format='PNG')
+    return output.getvalue()
+
+
+def picture_data_url(data):
+    return f"data:image/png;base64,{base64.b64encode(data).decode()}"
+
+
+def seed_league(users=200, density=0.5, picture_bytes=60000, distinct_pictures=20, seed=1):
+    """Reset the database and fill it with a synthetic league. Returns the user ids."""
+    from database import get_connection
+    from models.migrations import migrate
+    from models.rating_stats import backfill_rating_stats, SKILL_COLUMNS
+    from utils.passwords import hash_password
+    from utils.pictures import store_picture
+
+    rng = random.Random(seed)
+    migrate()
+
+    # One hash for everyone: seeding shouldn't spend minutes in the KDF
+    password = hash_password(BENCH_PASSWORD)
+    pictures = [store_picture(make_picture(rng, picture_bytes), 'image/png') for _ in range(distinct_pictures)]
+
+    conn = get_connection()
+    try:
+        with conn.begin():
+            for table in ('matchday_player_stats', 'matchday_results', 'user_rating_stats',
+                          'user_ratings', 'user_preferences', 'users'):
+                conn.execute(sa.text(f'DELETE FROM {table}'))
+
+            user_ids = list(range(1, users + 1))
+            conn.execute(
+                sa.text('INSERT INTO users (id, email, password, name) VALUES (:id, :email, :password, :name)'),
+                [{"id": i, "email": f'player{i}@bench.local', "password": password, "name": f'Player {i}'} for i in user_ids]
+            )
+            conn.execute(
+                sa.text('''
+                    INSERT INTO user_preferences (id, user_id, position, favorite_team, picture, slogan, completed)
+                    VALUES (:id, :user_id, :position, :favorite_team, :picture, :slogan, :completed)
+                '''),
+                [{
+                    "id": i, "user_id": i,
+                    "position": rng.choice(POSITIONS),
+                    "favorite_team": rng.choice(TEAMS),
+                    "picture": rng.choice(pictures),
+                    "slogan": f'Slogan of player {i}',
+                    "completed": True,
+                } for i in user_ids]
+            )
+
+            ratings = []
+            for rated in user_ids:
+                for rater in user_ids:
+                    if rated != rater and rng.random() < density:
+                        skills = [rng.randint(0, 100) for _ in SKILL_COLUMNS]
+                        ratings.append({
+                            "rated_user_id": rated, "rater_user_id": rater,
+                            **dict(zip(SKILL_COLUMNS, skills)),
+                            "overall_score": round(sum(skills) / len(skills)),
+                        })
+            insert_rating = sa.text(f'''
+                INSERT INTO user_ratings (rated_user_id, rater_user_id, {', '.join(SKILL_COLUMNS)}, overall_score)
+                VALUES (:rated_user_id, :rater_user_id, {', '.join(f':{skill}' for skill in SKILL_COLUMNS)}, :overall_score)
+            ''')
+            for start in range(0, len(ratings), RATING_CHUNK):
+                conn.execute(insert_rating, ratings[start:start + RATING_CHUNK])
+            backfill_rating_stats(conn)
+
+            if conn.dialect.name == 'postgresql':
+                # Explicit ids above don't advance the SERIAL sequences
+                for table in ('users', 'user_preferences'):
+                    conn.execute(sa.text(
+                        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))"
+                    ))
+    finally:
+        conn.close()
+
+    return user_ids
+
+
+def restore_league(path):
+    """Reset the database to a league snapshot (see models/snapshot.py). Returns the user ids."""
+    from database import get_connection
+    from models.snapshot import import_snapshot
+
+    import_snapshot(path, replace=True)
+    conn = get_connection()
+    try:
+        return [row[0] for row in conn.execute(sa.text('SELECT id FROM users ORDER BY id'))]
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Seed a synthetic league into DATABASE_URL')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--density', type=float, default=0.5, help='share of user pairs with a rating')
+    parser.add_argument('--picture-bytes', type=int, default=60000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        print('Set DATABASE_URL to the database to seed (it is wiped first)')
+        sys.exit(2)
+
+    ids = seed_league(args.users, args.density, args.picture_bytes, seed=args.seed)
+    print(f'Seeded {len(ids)} users')
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here'
@@ -12,3 +13,167 @@ class Config:
         # Development - use SQLite
         DATABASE_URL = 'sqlite:///users.db'
         DATABASE_PATH = 'users.db'
+
+    # Serving mode (see .gunicorn.conf.py and utils/concurrency.py):
+    #   threaded  gthread workers, GUNICORN_THREADS requests in flight each
+    #   async     gevent workers, up to ASYNC_WORKER_CONNECTIONS requests each
+    #             as greenlets, with psycopg2 waiting cooperatively
+    SERVING_MODE = os.environ.get('SERVING_MODE', 'threaded')
+    GUNICORN_WORKERS = int(os.environ.get('GUNICORN_WORKERS', 2))
+    GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 4))
+    ASYNC_WORKER_CONNECTIONS = int(os.environ.get('ASYNC_WORKER_CONNECTIONS', 1000))
+
+    # Connection pool (one pool per gunicorn worker, see .gunicorn.conf.py).
+    # In async mode many more requests share it, so it defaults larger; a
+    # greenlet waiting on checkout yields instead of holding a thread.
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 20 if SERVING_MODE == 'async' else 4))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10 if SERVING_MODE == 'async' else 2))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    # SQLite (single-node deployments): seconds a writer waits for the lock,
+    # WAL sync level and page cache size per connection
+    SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 5))
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 20000))
+
+    # Tokens (utils/auth.py): access tokens are checked from their claims and
+    # the in-memory revocation set alone; refresh tokens get new ones from
+    # /api/token/refresh. Revocations reach every worker within
+    # REVOCATION_SYNC_INTERVAL seconds.
+    ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', 900))
+    REFRESH_TOKEN_TTL = int(os.environ.get('REFRESH_TOKEN_TTL', 30 * 24 * 3600))
+    REVOCATION_SYNC_INTERVAL = int(os.environ.get('REVOCATION_SYNC_INTERVAL', 5))
+
+    # Principal cache for legacy 7-day tokens (issued before access tokens),
+    # which still resolve their user from the database until they expire
+    PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', 2048))
+    PRINCIPAL_CACHE_TTL = int(os.environ.get('PRINCIPAL_CACHE_TTL', 300))
+
+    # Rating breakdown cache behind /api/ratings/<id> (models/rating_breakdowns.py).
+    # 'memory' is an LRU per worker; 'file' is shared by the workers on the host
+    # and, like the entries' version tags, needs VERSION_BACKEND=file.
+    RATING_CACHE_BACKEND = os.environ.get('RATING_CACHE_BACKEND', 'memory')
+    RATING_CACHE_SIZE = int(os.environ.get('RATING_CACHE_SIZE', 512))
+    RATING_CACHE_TTL = int(os.environ.get('RATING_CACHE_TTL', 600))
+    RATING_CACHE_PATH = os.environ.get('RATING_CACHE_PATH') or os.path.join(
+        tempfile.gettempdir(), 'fantasyfc-rating-cache')
+
+    # Rating analytics (models/analytics.py). SHRINKAGE is how many average
+    # ratings a rater's or player's own ratings are blended with; a position
+    # needs MIN_GROUP rated players for z-scores and similarity. Ratings
+    # queue a recompute as a background job, at most one per REFRESH_DELAY
+    # seconds. With REFRESH_INTERVAL set, the same job also runs that often
+    # (recomputing only when ratings changed); or run
+    # "python -m models.analytics refresh".
+    ANALYTICS_SHRINKAGE = float(os.environ.get('ANALYTICS_SHRINKAGE', 5))
+    ANALYTICS_ITERATIONS = int(os.environ.get('ANALYTICS_ITERATIONS', 10))
+    ANALYTICS_MIN_GROUP = int(os.environ.get('ANALYTICS_MIN_GROUP', 3))
+    ANALYTICS_SIMILAR_COUNT = int(os.environ.get('ANALYTICS_SIMILAR_COUNT', 5))
+    ANALYTICS_REFRESH_DELAY = int(os.environ.get('ANALYTICS_REFRESH_DELAY', 60))
+    ANALYTICS_REFRESH_INTERVAL = int(os.environ.get('ANALYTICS_REFRESH_INTERVAL', 0))
+
+    # Background jobs (utils/jobs.py). 'database' keeps them in the jobs table,
+    # where any process can run them; 'memory' is a queue in each process,
+    # lost on restart. Every app process runs JOB_WORKER_THREADS pollers; set
+    # it to 0 when "python -m utils.jobs work" runs as its own process.
+    # Failed jobs are retried after JOB_RETRY_BACKOFF * 2**(attempt - 1)
+    # seconds; a job still running after JOB_LEASE seconds is presumed lost
+    # with its worker and runs again.
+    JOB_BACKEND = os.environ.get('JOB_BACKEND', 'database')
+    JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', 1))
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', 5))
+    JOB_LEASE = int(os.environ.get('JOB_LEASE', 300))
+    # How long finished jobs (and so their idempotency keys) are kept
+    JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 24 * 3600))
+
+    # Response encoding (utils/serialization.py): 'auto' uses orjson when it is
+    # installed. Arrays of at least JSON_STREAM_MIN_ITEMS are sent chunked.
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+    JSON_STREAM_MIN_ITEMS = int(os.environ.get('JSON_STREAM_MIN_ITEMS', 100))
+    JSON_STREAM_CHUNK = int(os.environ.get('JSON_STREAM_CHUNK', 100))
+
+    # Profile picture storage (see utils/pictures.py)
+    PICTURE_BACKEND = os.environ.get('PICTURE_BACKEND', 'local')
+    PICTURE_STORAGE_PATH = os.environ.get('PICTURE_STORAGE_PATH') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'pictures')
+    PICTURE_THUMBNAIL_SIZE = int(os.environ.get('PICTURE_THUMBNAIL_SIZE', 160))
+    PICTURE_MAX_BYTES = int(os.environ.get('PICTURE_MAX_BYTES', 750000))
+
+    # Frontend assets (see utils/assets.py). The build directory holds the
+    # fingerprinted, precompressed copy of static/ served under /assets/.
+    STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    ASSET_BUILD_PATH = os.environ.get('ASSET_BUILD_PATH') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static_build')
+    ASSET_BUILD_ON_START = os.environ.get('ASSET_BUILD_ON_START', 'true').lower() == 'true'
+    # GIF -> animated WebP takes tens of seconds; prefer the build CLI for it
+    ASSET_TRANSCODE_GIFS = os.environ.get('ASSET_TRANSCODE_GIFS', 'false').lower() == 'true'
+
+    # Resource version counters behind ETag revalidation (see utils/versions.py).
+    # 'file' is shared by all workers on the host; 'memory' is per process.
+    VERSION_BACKEND = os.environ.get('VERSION_BACKEND', 'file')
+    VERSION_STORE_PATH = os.environ.get('VERSION_STORE_PATH') or os.path.join(
+        tempfile.gettempdir(), 'fantasyfc-versions')
+
+    # Server-sent events (/api/stream). EVENT_FANOUT=postgres delivers events
+    # to every worker via LISTEN/NOTIFY; 'local' stays within one process.
+    EVENT_FANOUT = os.environ.get('EVENT_FANOUT') or ('postgres' if DATABASE_URL.startswith('postgresql') else 'local')
+    STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', 100))
+    STREAM_HEARTBEAT = int(os.environ.get('STREAM_HEARTBEAT', 20))
+    # Open streams per worker. Under gevent an idle stream is just a greenlet;
+    # with threaded workers each one pins a request thread, so keep it small.
+    STREAM_MAX_CLIENTS = int(os.environ.get('STREAM_MAX_CLIENTS', 5000))
+    STREAM_MAX_CLIENTS_THREADED = int(os.environ.get('STREAM_MAX_CLIENTS_THREADED', 1))
+
+    # Password hashing (utils/passwords.py). scrypt n=2**14, r=8 costs ~16MB
+    # and tens of ms per hash; the pool bounds how many run at once.
+    SCRYPT_N = int(os.environ.get('SCRYPT_N', 2 ** 14))
+    SCRYPT_R = int(os.environ.get('SCRYPT_R', 8))
+    SCRYPT_P = int(os.environ.get('SCRYPT_P', 1))
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 8))
+    PASSWORD_HASH_TIMEOUT = int(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+    # Per-client rate limits (utils/ratelimit.py), as "<count>/<period>" with
+    # period second, minute, hour, day or a number of seconds; empty or 0
+    # turns one off. 'memory' buckets are per worker; 'file' buckets are
+    # shared by the workers on the host.
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+    RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH') or os.path.join(
+        tempfile.gettempdir(), 'fantasyfc-rate-limits')
+    RATE_LIMIT_LOGIN_IP = os.environ.get('RATE_LIMIT_LOGIN_IP', '30/minute')
+    RATE_LIMIT_LOGIN_ACCOUNT = os.environ.get('RATE_LIMIT_LOGIN_ACCOUNT', '10/minute')
+    RATE_LIMIT_REGISTER_IP = os.environ.get('RATE_LIMIT_REGISTER_IP', '10/hour')
+    RATE_LIMIT_RATING_IP = os.environ.get('RATE_LIMIT_RATING_IP', '300/minute')
+    RATE_LIMIT_RATING_ACCOUNT = os.environ.get('RATE_LIMIT_RATING_ACCOUNT', '120/minute')
+    # Proxies in front of gunicorn that append to X-Forwarded-For. Leave at 0
+    # when clients connect directly, or they can pick their own address.
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+
+    # Admission control (utils/admission.py): /api requests get 503 with
+    # Retry-After instead of queueing once a worker is overloaded. 0 turns a
+    # check off. In-flight is only capped by default in async mode, where
+    # nothing else bounds it. Queue time needs a proxy that sets
+    # X-Request-Start.
+    ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 500 if SERVING_MODE == 'async' else 0))
+    ADMISSION_MAX_POOL_WAITERS = int(os.environ.get('ADMISSION_MAX_POOL_WAITERS', 50 if SERVING_MODE == 'async' else 0))
+    ADMISSION_MAX_POOL_WAIT = float(os.environ.get('ADMISSION_MAX_POOL_WAIT', 2))
+    ADMISSION_MAX_QUEUE_TIME = float(os.environ.get('ADMISSION_MAX_QUEUE_TIME', 10))
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 2))
+
+    # Apply pending migrations when a worker finds the schema out of date.
+    # Set to false where deploys run "python -m models.migrations upgrade".
+    AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', 'true').lower() == 'true'
+
+    # Logging and metrics (utils/log.py, utils/metrics.py, /metrics)
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+    METRICS_PATH = os.environ.get('METRICS_PATH') or os.path.join(
+        tempfile.gettempdir(), 'fantasyfc-metrics')
+    METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+    # A request running the same statement this many times is flagged as N+1
+    DB_REPEATED_QUERY_THRESHOLD = int(os.environ.get('DB_REPEATED_QUERY_THRESHOLD', 2))
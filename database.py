@@ -1,10 +1,210 @@
+import itertools
 import os
+import threading
+import time
 import sqlalchemy as sa
+from sqlalchemy import event
 from config import Config
+from utils.metrics import record_query
+
+# One engine (and one pool) per process. Gunicorn forks workers after the
+# master imports the app, so the engine is created lazily and re-created
+# whenever we notice we're running in a different pid than the one that
+# built it.
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'checked_out': 0,
+    'max_checked_out': 0,
+    'wait_time_total': 0.0,
+    'wait_time_max': 0.0,
+    'timeouts': 0,
+}
+# Checkouts in progress (id -> when it started), for admission control
+_waiting = {}
+_waiter_ids = itertools.count()
+
+
+def _is_sqlite_file(url):
+    url = sa.engine.make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def _engine_options():
+    options = {}
+    if Config.DATABASE_URL.startswith('sqlite'):
+        if not _is_sqlite_file(Config.DATABASE_URL):
+            # In-memory databases only exist on their one connection
+            return options
+        # 1.4 defaults file databases to a NullPool (a new connection, and
+        # new pragmas, per checkout). Pool them like PostgreSQL instead; the
+        # pool only hands a connection to one thread at a time.
+        return dict(
+            poolclass=sa.pool.QueuePool,
+            pool_size=Config.DB_POOL_SIZE,
+            max_overflow=Config.DB_MAX_OVERFLOW,
+            pool_timeout=Config.DB_POOL_TIMEOUT,
+            connect_args={'check_same_thread': False, 'timeout': Config.SQLITE_BUSY_TIMEOUT},
+        )
+
+    options.update(
+        pool_size=Config.DB_POOL_SIZE,
+        max_overflow=Config.DB_MAX_OVERFLOW,
+        pool_timeout=Config.DB_POOL_TIMEOUT,
+        pool_recycle=Config.DB_POOL_RECYCLE,
+        pool_pre_ping=Config.DB_POOL_PRE_PING,
+    )
+    return options
+
+
+def _register_pool_events(engine):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        with _pool_stats_lock:
+            _pool_stats['connects'] += 1
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        with _pool_stats_lock:
+            _pool_stats['checkouts'] += 1
+            _pool_stats['checked_out'] += 1
+            if _pool_stats['checked_out'] > _pool_stats['max_checked_out']:
+                _pool_stats['max_checked_out'] = _pool_stats['checked_out']
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Statements on one connection run one at a time
+        conn.info['query_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record_query(statement, time.perf_counter() - conn.info['query_started'])
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        with _pool_stats_lock:
+            _pool_stats['checkins'] += 1
+            if _pool_stats['checked_out'] > 0:
+                _pool_stats['checked_out'] -= 1
+
+
+def _register_sqlite_events(engine):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        # Leave BEGIN to SQLAlchemy (see begin_immediate) instead of the
+        # driver's implicit, deferred transactions
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            # WAL lets readers carry on while one writer commits
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute(f'PRAGMA synchronous={Config.SQLITE_SYNCHRONOUS}')
+            cursor.execute(f'PRAGMA busy_timeout={int(Config.SQLITE_BUSY_TIMEOUT * 1000)}')
+            cursor.execute('PRAGMA foreign_keys=ON')
+            cursor.execute(f'PRAGMA cache_size=-{Config.SQLITE_CACHE_KB}')
+        finally:
+            cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin_immediate(conn):
+        # Take the write lock when the transaction starts. A deferred
+        # transaction that reads and then writes fails with "database is
+        # locked" when another writer got in between, instead of waiting
+        # out busy_timeout.
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
 
 def get_engine():
-    return sa.create_engine(Config.DATABASE_URL)
+    global _engine, _engine_pid
+
+    pid = os.getpid()
+    if _engine is not None and _engine_pid == pid:
+        return _engine
+
+    with _engine_lock:
+        if _engine is None or _engine_pid != pid:
+            if _engine is not None:
+                # Inherited from the parent process: drop the references
+                # without closing the parent's sockets.
+                _engine.dispose(close=False)
+            _engine = sa.create_engine(Config.DATABASE_URL, **_engine_options())
+            _register_pool_events(_engine)
+            if _engine.dialect.name == 'sqlite':
+                _register_sqlite_events(_engine)
+            _engine_pid = pid
+            with _pool_stats_lock:
+                _pool_stats['checked_out'] = 0
+
+    return _engine
+
+
+def dispose_engine(close=True):
+    """Drop the process engine so the next get_engine() builds a fresh pool.
+
+    Pass close=False from a freshly forked child so the parent's sockets are
+    left alone.
+    """
+    global _engine, _engine_pid
+
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose(close=close)
+        _engine = None
+        _engine_pid = None
+
 
 def get_connection():
     engine = get_engine()
-    return engine.connect()
+    started = time.perf_counter()
+    with _pool_stats_lock:
+        waiter = next(_waiter_ids)
+        _waiting[waiter] = started
+    try:
+        return engine.connect()
+    except sa.exc.TimeoutError:
+        with _pool_stats_lock:
+            _pool_stats['timeouts'] += 1
+        raise
+    finally:
+        waited = time.perf_counter() - started
+        with _pool_stats_lock:
+            del _waiting[waiter]
+            _pool_stats['wait_time_total'] += waited
+            if waited > _pool_stats['wait_time_max']:
+                _pool_stats['wait_time_max'] = waited
+
+
+def get_pool_pressure():
+    """(requests waiting for a connection now, seconds the longest has waited)"""
+    with _pool_stats_lock:
+        if not _waiting:
+            return 0, 0.0
+        return len(_waiting), time.perf_counter() - min(_waiting.values())
+
+
+def get_pool_stats():
+    """Snapshot of this worker's pool usage, for sizing against gunicorn threads"""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats['waiting'], stats['longest_wait'] = get_pool_pressure()
+
+    checkouts = stats['checkouts']
+    stats['wait_time_avg'] = stats['wait_time_total'] / checkouts if checkouts else 0.0
+    stats['pid'] = os.getpid()
+
+    engine = _engine
+    if engine is not None and _engine_pid == stats['pid']:
+        pool = engine.pool
+        stats['pool_class'] = type(pool).__name__
+        stats['pool_status'] = pool.status()
+        if isinstance(pool, sa.pool.QueuePool):
+            stats['pool_size'] = pool.size()
+            stats['overflow'] = pool.overflow()
+            stats['checked_in'] = pool.checkedin()
+    return stats
@@ -0,0 +1,267 @@
+import json
+import sys
+import time
+import numpy as np
+import sqlalchemy as sa
+from config import Config
+from database import get_connection
+from models.tables import user_preferences, user_ratings, player_analytics
+from models.rating_stats import POSITION_SKILLS, SKILL_COLUMNS
+from utils.versions import bump
+from utils.jobs import job, enqueue
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# Batch analytics over the whole rating matrix, precomputed into
+# player_analytics and served as-is by /api/analytics. user_ratings is read
+# once into arrays (one row per rating) and everything below is vectorized
+# over them, so tens of thousands of ratings take well under a second:
+#
+#   adjusted_score  the player's quality with rater leniency taken out: the
+#                   ratings are fitted as mean + leniency[rater] +
+#                   quality[player] by alternating ridge regression, each
+#                   side shrunk towards 0 by ANALYTICS_SHRINKAGE pseudo-ratings
+#                   so one rating (from a player or rater) can't swing it
+#   skill_<n>_z     the player's leniency-corrected skill_<n> average as a
+#                   z-score among rated players of the same position
+#   similar         the ANALYTICS_SIMILAR_COUNT players of the same position
+#                   with the closest skill profile (cosine of the z-scores)
+#
+# Nothing here runs per request: refresh() replaces the table in one
+# transaction and bumps the 'analytics' version. Rating writes only call
+# schedule_refresh(), which queues it as a background job; with
+# ANALYTICS_REFRESH_INTERVAL set, the job also runs that often, and then
+# skips the recompute when user_ratings hasn't changed.
+VERSION_KEY = 'analytics'
+REFRESH_JOB = 'analytics.refresh'
+Z_COLUMNS = [f'{skill}_z' for skill in SKILL_COLUMNS]
+
+CREATE_PLAYER_ANALYTICS_TABLE = f'''
+    CREATE TABLE IF NOT EXISTS player_analytics (
+        user_id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+        position TEXT,
+        rating_count INTEGER NOT NULL,
+        raw_score DOUBLE PRECISION NOT NULL,
+        adjusted_score DOUBLE PRECISION NOT NULL,
+        {', '.join(f'{column} DOUBLE PRECISION' for column in Z_COLUMNS)},
+        similar TEXT,
+        computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+_RATING_COLUMNS = ['rater_user_id', 'rated_user_id', 'overall_score', *SKILL_COLUMNS]
+_ALL_RATINGS = sa.select(*[user_ratings.c[column] for column in _RATING_COLUMNS])
+_ALL_POSITIONS = sa.select(user_preferences.c.user_id, user_preferences.c.position).where(
+    user_preferences.c.position.isnot(None))
+# Cheap fingerprint of user_ratings, to skip refreshes when nothing changed
+_RATINGS_FINGERPRINT = sa.select(sa.func.count(), sa.func.max(user_ratings.c.updated_at))
+
+# Rows of the similarity matrix computed at a time (block x group floats)
+_SIMILARITY_BLOCK = 1024
+
+
+def load_ratings(conn):
+    """Every rating as an (n, 9) float array in _RATING_COLUMNS order"""
+    # Straight from the DBAPI cursor: numpy converts its plain tuples several
+    # times faster than SQLAlchemy Rows
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(str(_ALL_RATINGS.compile(dialect=conn.dialect)))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    return np.array(rows, dtype=np.float64).reshape(-1, len(_RATING_COLUMNS))
+
+
+def fit_leniency(rater, rated, scores, size, shrinkage, iterations):
+    """Fit scores ~ mean + leniency[rater] + quality[rated].
+
+    rater and rated are indexes into one id space of `size` users. Returns
+    (mean, leniency, quality).
+    """
+    mean = scores.mean()
+    leniency = np.zeros(size)
+    quality = np.zeros(size)
+    rater_weight = np.bincount(rater, minlength=size) + shrinkage
+    rated_weight = np.bincount(rated, minlength=size) + shrinkage
+    for _ in range(iterations):
+        leniency = np.bincount(rater, scores - mean - quality[rated], minlength=size) / rater_weight
+        quality = np.bincount(rated, scores - mean - leniency[rater], minlength=size) / rated_weight
+    return mean, leniency, quality
+
+
+def position_z_scores(values, groups, min_group):
+    """z-score the rows of values within each group; NaN for groups under min_group rows"""
+    z = np.full(values.shape, np.nan)
+    for group in np.unique(groups[groups >= 0]):
+        members = groups == group
+        if members.sum() < min_group:
+            continue
+        spread = values[members].std(axis=0)
+        # A skill everyone got the same average on says nothing: z = 0
+        z[members] = (values[members] - values[members].mean(axis=0)) / np.where(spread > 0, spread, 1.0)
+    return z
+
+
+def most_similar(profiles, count):
+    """For each row, the (indexes, cosine similarities) of its `count` nearest other rows"""
+    norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+    unit = profiles / np.where(norms > 0, norms, 1.0)
+    count = min(count, len(profiles) - 1)
+    if count <= 0:
+        return np.empty((len(profiles), 0), dtype=np.int64), np.empty((len(profiles), 0))
+
+    indexes = np.empty((len(profiles), count), dtype=np.int64)
+    scores = np.empty((len(profiles), count))
+    for start in range(0, len(profiles), _SIMILARITY_BLOCK):
+        block = unit[start:start + _SIMILARITY_BLOCK] @ unit.T
+        # Never your own neighbour
+        block[np.arange(len(block)), np.arange(start, start + len(block))] = -np.inf
+        top = np.argpartition(-block, count - 1, axis=1)[:, :count]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        indexes[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+        scores[start:start + len(block)] = np.take_along_axis(top_scores, order, axis=1)
+    return indexes, scores
+
+
+def compute_analytics(ratings, positions):
+    """player_analytics rows from load_ratings() output and {user_id: position}"""
+    if not len(ratings):
+        return []
+
+    rater_ids = ratings[:, 0].astype(np.int64)
+    rated_ids = ratings[:, 1].astype(np.int64)
+    scores = ratings[:, 2]
+    skills = ratings[:, 3:]
+
+    # One index space for raters and rated players
+    user_ids = np.unique(np.concatenate([rater_ids, rated_ids]))
+    rater = np.searchsorted(user_ids, rater_ids)
+    rated = np.searchsorted(user_ids, rated_ids)
+    size = len(user_ids)
+
+    mean, leniency, quality = fit_leniency(
+        rater, rated, scores, size, Config.ANALYTICS_SHRINKAGE, Config.ANALYTICS_ITERATIONS)
+
+    counts = np.bincount(rated, minlength=size)
+    players = np.flatnonzero(counts)
+    player_counts = counts[players]
+    raw_scores = np.bincount(rated, scores, minlength=size)[players] / player_counts
+    adjusted_scores = np.clip(mean + quality[players], 0, 100)
+
+    # Skill averages with each rating's rater leniency removed
+    corrected = skills - leniency[rater][:, None]
+    skill_means = np.stack([
+        np.bincount(rated, corrected[:, k], minlength=size)[players] for k in range(len(SKILL_COLUMNS))
+    ], axis=1) / player_counts[:, None]
+
+    # Position as a group number per player (-1: none set)
+    position_names = list(POSITION_SKILLS)
+    groups = np.array([
+        position_names.index(positions[user_id]) if positions.get(user_id) in POSITION_SKILLS else -1
+        for user_id in user_ids[players].tolist()
+    ], dtype=np.int64)
+    z = position_z_scores(skill_means, groups, Config.ANALYTICS_MIN_GROUP)
+
+    similar = [None] * len(players)
+    for group in np.unique(groups[groups >= 0]):
+        members = np.flatnonzero((groups == group) & ~np.isnan(z[:, 0]))
+        if not len(members):
+            continue
+        neighbours, similarities = most_similar(z[members], Config.ANALYTICS_SIMILAR_COUNT)
+        member_ids = user_ids[players[members]]
+        for row, i in enumerate(members.tolist()):
+            similar[i] = json.dumps([
+                [int(member_ids[j]), round(float(s), 4)] for j, s in zip(neighbours[row], similarities[row])
+            ])
+
+    z = np.round(z, 4)
+    rows = []
+    for i, user_id in enumerate(user_ids[players].tolist()):
+        row = {
+            'user_id': user_id,
+            'position': position_names[groups[i]] if groups[i] >= 0 else None,
+            'rating_count': int(player_counts[i]),
+            'raw_score': round(float(raw_scores[i]), 2),
+            'adjusted_score': round(float(adjusted_scores[i]), 2),
+            'similar': similar[i],
+        }
+        for k, column in enumerate(Z_COLUMNS):
+            row[column] = None if np.isnan(z[i, k]) else float(z[i, k])
+        rows.append(row)
+    return rows
+
+
+def ratings_fingerprint(conn):
+    count, last_updated = conn.execute(_RATINGS_FINGERPRINT).one()
+    return count, str(last_updated)
+
+
+# Fingerprint of the ratings this process last computed from
+_refreshed_fingerprint = None
+
+
+@job(REFRESH_JOB, every=Config.ANALYTICS_REFRESH_INTERVAL, payload={'if_changed': True})
+def refresh(if_changed=False):
+    """Recompute player_analytics from user_ratings; returns the number of
+    players written, or None when if_changed and the ratings weren't"""
+    global _refreshed_fingerprint
+    started = time.perf_counter()
+    conn = get_connection()
+    try:
+        fingerprint = ratings_fingerprint(conn)
+        if if_changed and fingerprint == _refreshed_fingerprint:
+            return None
+        ratings = load_ratings(conn)
+        positions = dict(conn.execute(_ALL_POSITIONS).fetchall())
+        loaded = time.perf_counter()
+
+        rows = compute_analytics(ratings, positions)
+        computed = time.perf_counter()
+
+        # Replace the whole table at once: readers see the old or the new
+        # results, never a mix
+        with conn.begin():
+            conn.execute(player_analytics.delete())
+            if rows:
+                conn.execute(player_analytics.insert(), rows)
+    finally:
+        conn.close()
+    _refreshed_fingerprint = fingerprint
+    bump(VERSION_KEY)
+
+    log.info('Rating analytics refreshed', extra={
+        'ratings': len(ratings),
+        'players': len(rows),
+        'load_seconds': round(loaded - started, 3),
+        'compute_seconds': round(computed - loaded, 3),
+        'write_seconds': round(time.perf_counter() - computed, 3),
+    })
+    return len(rows)
+
+
+def schedule_refresh():
+    """Queue a refresh at the end of the current ANALYTICS_REFRESH_DELAY window.
+
+    Every rating in the window maps to the same job key, so a burst of
+    ratings costs one recompute (and, per process, one enqueue).
+    """
+    delay = Config.ANALYTICS_REFRESH_DELAY
+    if not delay:
+        return False
+    now = time.time()
+    window = int(now // delay)
+    return enqueue(REFRESH_JOB, key=f'{REFRESH_JOB}:{window}', delay=(window + 1) * delay - now)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'refresh':
+        started = time.perf_counter()
+        players = refresh()
+        print(f'Analytics for {players} players written in {time.perf_counter() - started:.2f}s')
+    else:
+        print('usage: python -m models.analytics refresh')
+        sys.exit(2)
@@ -0,0 +1,119 @@
+import json
+import time
+import sqlalchemy as sa
+from models.tables import jobs, upsert
+
+# The jobs table behind JOB_BACKEND=database (see utils/jobs.py). A job is
+# queued until a worker claims it, running while that worker holds its
+# lease, then done or failed. Claims are a conditional UPDATE on the status,
+# so any number of pollers in any number of processes can share the table
+# without explicit locks (and without a write transaction per idle poll on
+# SQLite).
+#
+# idempotency_key is unique (NULLs never collide): a job enqueued again
+# under a key that is still in the table is dropped.
+CREATE_JOBS_TABLE = [
+    '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id {id_column},
+        name TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        idempotency_key TEXT UNIQUE,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        run_after DOUBLE PRECISION NOT NULL,
+        locked_until DOUBLE PRECISION,
+        last_error TEXT,
+        enqueued_at DOUBLE PRECISION NOT NULL,
+        finished_at DOUBLE PRECISION
+    )
+    ''',
+    # Claim order
+    'CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)',
+]
+
+_NEXT_JOB = (
+    sa.select(jobs.c.id, jobs.c.name, jobs.c.payload, jobs.c.attempts, jobs.c.max_attempts, jobs.c.run_after)
+    .where(jobs.c.status == 'queued', jobs.c.run_after <= sa.bindparam('now'))
+    .order_by(jobs.c.run_after, jobs.c.id)
+    .limit(1)
+)
+_CLAIM_JOB = (
+    jobs.update()
+    .where(jobs.c.id == sa.bindparam('job_id'), jobs.c.status == 'queued')
+    .values(status='running', attempts=jobs.c.attempts + 1, locked_until=sa.bindparam('locked_until'))
+)
+# Updates from the worker holding the job (a worker whose lease ran out
+# and whose job was claimed again changes nothing)
+_OWNED = sa.and_(jobs.c.id == sa.bindparam('job_id'), jobs.c.status == 'running',
+                 jobs.c.attempts == sa.bindparam('attempt'))
+
+
+def insert_job(conn, name, payload, key, run_after, max_attempts):
+    """Queue a job. Returns False when one with the same key already exists."""
+    now = time.time()
+    result = conn.execute(upsert(conn, jobs, ['idempotency_key']), {
+        "name": name,
+        "payload": json.dumps(payload or {}),
+        "idempotency_key": key,
+        "status": 'queued',
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "run_after": run_after,
+        "enqueued_at": now,
+    })
+    return result.rowcount > 0
+
+
+def claim_job(conn, lease):
+    """Take the next due job, or None. Its attempts already count this run."""
+    while True:
+        now = time.time()
+        row = conn.execute(_NEXT_JOB, {"now": now}).fetchone()
+        if row is None:
+            return None
+        claimed = conn.execute(_CLAIM_JOB, {"job_id": row.id, "locked_until": now + lease})
+        if claimed.rowcount:
+            job = dict(row._mapping)
+            job['payload'] = json.loads(job['payload'])
+            job['attempts'] += 1
+            return job
+        # Another worker got there first; try the next one
+
+
+def complete_job(conn, job):
+    conn.execute(jobs.update().where(_OWNED).values(status='done', locked_until=None, finished_at=time.time()),
+                 {"job_id": job['id'], "attempt": job['attempts']})
+
+
+def retry_job(conn, job, run_after, error):
+    conn.execute(jobs.update().where(_OWNED).values(status='queued', locked_until=None, run_after=run_after,
+                                                    last_error=error),
+                 {"job_id": job['id'], "attempt": job['attempts']})
+
+
+def fail_job(conn, job, error):
+    conn.execute(jobs.update().where(_OWNED).values(status='failed', locked_until=None, last_error=error,
+                                                    finished_at=time.time()),
+                 {"job_id": job['id'], "attempt": job['attempts']})
+
+
+def recover_jobs(conn, retention):
+    """Requeue jobs whose worker died (lease expired) and drop old finished ones.
+
+    A job that already used all its attempts fails instead. Failed jobs are
+    kept for inspection; done ones (and their keys) go after retention.
+    """
+    now = time.time()
+    expired = sa.and_(jobs.c.status == 'running', jobs.c.locked_until <= now)
+    conn.execute(jobs.update().where(expired, jobs.c.attempts >= jobs.c.max_attempts)
+                 .values(status='failed', locked_until=None, last_error='Lease expired', finished_at=now))
+    conn.execute(jobs.update().where(expired)
+                 .values(status='queued', locked_until=None, run_after=now, last_error='Lease expired'))
+    conn.execute(jobs.delete().where(jobs.c.status == 'done', jobs.c.finished_at < now - retention))
+
+
+def count_jobs(conn):
+    """{status: number of jobs}"""
+    return dict(conn.execute(sa.select(jobs.c.status, sa.func.count()).group_by(jobs.c.status)).fetchall())
@@ -0,0 +1,197 @@
+import bisect
+import datetime
+import threading
+from models.user import get_db_connection
+from models.tables import users, user_preferences, user_rating_stats
+from models.rating_stats import POSITION_SKILLS, SKILL_COLUMNS
+from utils.versions import get_version_store
+import sqlalchemy as sa
+
+# Ranked lists held in memory per worker, built from user_rating_stats (never
+# from user_ratings). Two versions drive them:
+#
+#   leaderboard  bumped by writes that reshape the boards (position changes,
+#                renames, deletes, snapshot imports): rebuilt from scratch
+#   users        bumped by every rating (and more): only the stats rows
+#                updated since the last sync are read, and each of those
+#                players is moved to their new place on their boards
+#
+# Boards are keyed by (position, skill), each optional:
+#   (None, None)             overall average, everyone
+#   ('Defender', None)       overall average among defenders
+#   (None, 'Pace')           Pace, across every position that has it
+#   ('Forward', 'Pace')      Pace among forwards
+VERSION_KEY = 'leaderboard'
+RATINGS_VERSION_KEY = 'users'
+# Stats rows updated this many seconds before the newest one already seen
+# are read again, so a transaction that committed late (with an earlier
+# timestamp) isn't missed. Applying a row twice is harmless.
+SYNC_MARGIN = datetime.timedelta(seconds=10)
+
+# Skill name -> {position: skill column}
+NAMED_SKILLS = {}
+for _position, _skills in POSITION_SKILLS.items():
+    for _column, _skill in zip(SKILL_COLUMNS, _skills):
+        NAMED_SKILLS.setdefault(_skill, {})[_position] = _column
+
+_STATS_ROWS = (
+    sa.select(users.c.id.label('user_id'), users.c.name, user_preferences.c.position,
+              user_rating_stats.c.rating_count, user_rating_stats.c.overall_sum,
+              *[user_rating_stats.c[f'{skill}_sum'] for skill in SKILL_COLUMNS],
+              user_rating_stats.c.updated_at)
+    .select_from(user_rating_stats.join(users, users.c.id == user_rating_stats.c.rated_user_id)
+                 .outerjoin(user_preferences, user_preferences.c.user_id == users.c.id))
+)
+_ALL_STATS = _STATS_ROWS.where(user_rating_stats.c.rating_count > 0)
+_STATS_SINCE = _STATS_ROWS.where(user_rating_stats.c.updated_at >= sa.bindparam('since'))
+
+
+def _sort_key(entry):
+    # Highest score first; more ratings, then lower id, break ties
+    return (-entry['score'], -entry['rating_count'], entry['user_id'])
+
+
+class Board:
+    """One ranked list, kept sorted as players are added, moved or removed"""
+
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=_sort_key)
+        self.keys = [_sort_key(entry) for entry in self.entries]
+        self.by_user = {entry['user_id']: entry for entry in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _rank(self, score):
+        # Standard competition ranking: equal scores share a rank (1, 1, 3).
+        # (-score,) sorts before every key with that score.
+        return bisect.bisect_left(self.keys, (-score,)) + 1
+
+    def top(self, k):
+        """The first k entries, each with its rank"""
+        ranked = []
+        for i, entry in enumerate(self.entries[:k]):
+            if i and entry['score'] == self.entries[i - 1]['score']:
+                rank = ranked[-1]['rank']
+            else:
+                rank = i + 1
+            ranked.append(dict(entry, rank=rank))
+        return ranked
+
+    def find(self, user_id):
+        entry = self.by_user.get(user_id)
+        return dict(entry, rank=self._rank(entry['score'])) if entry is not None else None
+
+    def remove(self, user_id):
+        entry = self.by_user.pop(user_id, None)
+        if entry is not None:
+            i = bisect.bisect_left(self.keys, _sort_key(entry))
+            del self.keys[i]
+            del self.entries[i]
+
+    def put(self, entry):
+        self.remove(entry['user_id'])
+        key = _sort_key(entry)
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.entries.insert(i, entry)
+        self.by_user[entry['user_id']] = entry
+
+
+def board_entries(row):
+    """[(board key, entry)] for one stats row: the boards this player is on"""
+    count = row['rating_count']
+    if not count:
+        return []
+
+    def entry(total):
+        return {
+            'user_id': row['user_id'],
+            'name': row['name'],
+            'position': row['position'],
+            'score': total / count,
+            'rating_count': count,
+        }
+
+    position = row['position']
+    entries = [((None, None), entry(row['overall_sum']))]
+    if position in POSITION_SKILLS:
+        entries.append(((position, None), entry(row['overall_sum'])))
+        for column, skill in zip(SKILL_COLUMNS, POSITION_SKILLS[position]):
+            entries.append(((None, skill), entry(row[f'{column}_sum'])))
+            entries.append(((position, skill), entry(row[f'{column}_sum'])))
+    return entries
+
+
+def build_boards(rows):
+    boards = {}
+    for row in rows:
+        for key, entry in board_entries(row):
+            boards.setdefault(key, []).append(entry)
+    return {key: Board(entries) for key, entries in boards.items()}
+
+
+class Leaderboard:
+    def __init__(self):
+        self._boards = {}
+        self._versions = None
+        self._synced_to = None
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+        self.updates = 0
+
+    def _load(self, statement, params=None):
+        conn = get_db_connection()
+        try:
+            rows = [dict(row._mapping) for row in conn.execute(statement, params or {})]
+        finally:
+            conn.close()
+        newest = max((row['updated_at'] for row in rows if row['updated_at']), default=None)
+        if newest is not None and (self._synced_to is None or newest > self._synced_to):
+            self._synced_to = newest
+        return rows
+
+    def _rebuild(self):
+        self._synced_to = None
+        self._boards = build_boards(self._load(_ALL_STATS))
+        self.rebuilds += 1
+
+    def _apply_changes(self):
+        if self._synced_to is None:
+            # Nothing rated yet when we last looked
+            rows = self._load(_ALL_STATS)
+        else:
+            rows = self._load(_STATS_SINCE, {"since": self._synced_to - SYNC_MARGIN})
+        for row in rows:
+            for board in self._boards.values():
+                board.remove(row['user_id'])
+            for key, entry in board_entries(row):
+                if key not in self._boards:
+                    self._boards[key] = Board([])
+                self._boards[key].put(entry)
+        self._boards = {key: board for key, board in self._boards.items() if len(board)}
+        self.updates += 1
+
+    def _sync(self):
+        # Called with the lock held
+        store = get_version_store()
+        versions = (store.epoch(), store.get(VERSION_KEY)[0], store.get(RATINGS_VERSION_KEY)[0])
+        if versions == self._versions:
+            return
+        if self._versions is None or versions[:2] != self._versions[:2]:
+            self._rebuild()
+        else:
+            self._apply_changes()
+        self._versions = versions
+
+    def query(self, position=None, skill=None, top=10, user_id=None):
+        """(board size, top entries, user_id's entry or None), all with ranks"""
+        with self._lock:
+            self._sync()
+            board = self._boards.get((position, skill))
+            if board is None:
+                return 0, [], None
+            return len(board), board.top(top), board.find(user_id)
+
+
+leaderboard = Leaderboard()
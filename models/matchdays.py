@@ -0,0 +1,298 @@
+import re
+from decimal import Decimal, InvalidOperation
+import sqlalchemy as sa
+from models.tables import matchday_results, matchday_player_stats, upsert, first
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# Matchday history: one row per matchday number in matchday_results, never
+# overwritten by a later matchday. The players are kept as display names
+# (not everyone in the league has an account) plus the id of the user with
+# that name, when there is one. matchday_player_stats holds per-player season
+# totals, maintained in the same transaction as every matchday write.
+#
+# Money is stored as integer cents; the API still shows "$30" on the banner.
+
+# (API field, column prefix, stats column counting it)
+PLAYER_FIELDS = [
+    ('topPlayer', 'top_player', 'top_finishes'),
+    ('secondToLast', 'second_to_last', 'second_to_last_finishes'),
+    ('lastPlayer', 'last_player', 'last_finishes'),
+    ('noSubs', 'no_subs', 'no_subs_count'),
+]
+STATS_COLUMNS = [stats_column for _, _, stats_column in PLAYER_FIELDS] + ['winnings_cents']
+
+CREATE_MATCHDAY_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS matchday_results (
+        number INTEGER PRIMARY KEY,
+        top_player_name TEXT,
+        top_player_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        second_to_last_name TEXT,
+        second_to_last_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        last_player_name TEXT,
+        last_player_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        no_subs_name TEXT,
+        no_subs_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        accumulated_cents INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS matchday_player_stats (
+        user_id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+        top_finishes INTEGER NOT NULL DEFAULT 0,
+        second_to_last_finishes INTEGER NOT NULL DEFAULT 0,
+        last_finishes INTEGER NOT NULL DEFAULT 0,
+        no_subs_count INTEGER NOT NULL DEFAULT 0,
+        winnings_cents INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    # Standings order
+    '''
+    CREATE INDEX IF NOT EXISTS idx_matchday_player_stats_standings
+    ON matchday_player_stats (top_finishes DESC, winnings_cents DESC, user_id)
+    ''',
+]
+
+MONEY_RE = re.compile(r'^\$?\s*(-?[\d,]*\.?\d*)$')
+
+
+class MatchdayError(ValueError):
+    pass
+
+
+def parse_money(value):
+    """30, 30.5, "$30" or "$1,250.50" -> integer cents"""
+    if value is None or value == '':
+        return 0
+    if isinstance(value, bool):
+        raise MatchdayError('accumulated must be an amount')
+    if isinstance(value, (int, float)):
+        return int(round(Decimal(str(value)) * 100))
+
+    match = MONEY_RE.match(str(value).strip())
+    if not match or not match.group(1):
+        raise MatchdayError('accumulated must be an amount')
+    try:
+        return int(round(Decimal(match.group(1).replace(',', '')) * 100))
+    except InvalidOperation:
+        raise MatchdayError('accumulated must be an amount')
+
+
+def format_money(cents):
+    if cents % 100 == 0:
+        return f'${cents // 100}'
+    return f'${cents / 100:.2f}'
+
+
+def _player_value(value):
+    """Normalize a player field: None, a user id (int) or a display name"""
+    if value is None or value is False or value is True:
+        return None
+    if isinstance(value, int):
+        return value
+    value = str(value).strip()
+    return value or None
+
+
+def resolve_players(conn, data):
+    """Turn the player fields of a matchday payload into {prefix: (name, user_id)}.
+
+    Fields may hold a user id or a display name. Names are linked to the user
+    with that name (case-insensitive) when exactly one exists.
+    """
+    values = {prefix: _player_value(data.get(field)) for field, prefix, _ in PLAYER_FIELDS}
+
+    ids = sorted({value for value in values.values() if isinstance(value, int)})
+    names = sorted({value.lower() for value in values.values() if isinstance(value, str)})
+
+    users_by_id = {}
+    if ids:
+        result = conn.execute(
+            sa.text('SELECT id, name FROM users WHERE id IN :ids').bindparams(sa.bindparam('ids', expanding=True)),
+            {"ids": ids}
+        )
+        users_by_id = {row.id: row.name for row in result}
+
+    ids_by_name = {}
+    if names:
+        result = conn.execute(
+            sa.text('SELECT id, LOWER(name) AS name FROM users WHERE LOWER(name) IN :names')
+            .bindparams(sa.bindparam('names', expanding=True)),
+            {"names": names}
+        )
+        for row in result:
+            ids_by_name.setdefault(row.name, []).append(row.id)
+
+    players = {}
+    for prefix, value in values.items():
+        if value is None:
+            players[prefix] = (None, None)
+        elif isinstance(value, int):
+            if value not in users_by_id:
+                raise MatchdayError(f'Unknown user id: {value}')
+            players[prefix] = (users_by_id[value], value)
+        else:
+            matches = ids_by_name.get(value.lower(), [])
+            players[prefix] = (value, matches[0] if len(matches) == 1 else None)
+    return players
+
+
+def _contributions(row):
+    """{user_id: [top, second_to_last, last, no_subs, winnings_cents]} for one matchday row"""
+    contributions = {}
+    for i, (_, prefix, _) in enumerate(PLAYER_FIELDS):
+        user_id = row.get(f'{prefix}_id')
+        if user_id is not None:
+            contributions.setdefault(user_id, [0] * len(STATS_COLUMNS))[i] += 1
+    winner = row.get('top_player_id')
+    if winner is not None:
+        # The champion of a matchday takes the pot shown on its banner
+        contributions[winner][-1] += row.get('accumulated_cents') or 0
+    return contributions
+
+
+def _apply_stats_deltas(conn, deltas):
+    deltas = {user_id: values for user_id, values in deltas.items() if any(values)}
+    if not deltas:
+        return
+
+    conn.execute(
+        upsert(conn, matchday_player_stats, ['user_id'], increment=STATS_COLUMNS),
+        [{"user_id": user_id, **dict(zip(STATS_COLUMNS, values))} for user_id, values in sorted(deltas.items())]
+    )
+
+
+def record_matchday(conn, data):
+    """Store a matchday result and fold it into the season totals.
+
+    Must run inside a transaction on conn. Re-sending a number that already
+    exists corrects that matchday: its previous contribution to the totals
+    is taken back before the new one is added. Returns the stored row.
+    """
+    try:
+        number = int(data['number'])
+    except (TypeError, ValueError):
+        raise MatchdayError('number must be an integer')
+    accumulated_cents = parse_money(data.get('accumulated'))
+    players = resolve_players(conn, data)
+
+    # Make sure the row exists, then lock it so corrections of the same
+    # matchday apply one at a time
+    conn.execute(upsert(conn, matchday_results, ['number']), {"number": number})
+    previous = first(conn.execute(
+        # FOR UPDATE is rendered on PostgreSQL only (SQLite locks the database)
+        sa.select(matchday_results).where(matchday_results.c.number == number).with_for_update()
+    ))
+
+    row = {'number': number, 'accumulated_cents': accumulated_cents}
+    for prefix, (name, user_id) in players.items():
+        row[f'{prefix}_name'] = name
+        row[f'{prefix}_id'] = user_id
+
+    conn.execute(
+        matchday_results.update()
+        .where(matchday_results.c.number == number)
+        .values(updated_at=sa.func.current_timestamp()),
+        {column: value for column, value in row.items() if column != 'number'}
+    )
+
+    deltas = {}
+    for user_id, values in _contributions(previous).items():
+        deltas[user_id] = [-value for value in values]
+    for user_id, values in _contributions(row).items():
+        current = deltas.setdefault(user_id, [0] * len(STATS_COLUMNS))
+        deltas[user_id] = [a + b for a, b in zip(current, values)]
+    _apply_stats_deltas(conn, deltas)
+
+    return row
+
+
+def rebuild_player_stats(conn):
+    """Recompute matchday_player_stats from matchday_results (after a bulk load)"""
+    conn.execute(matchday_player_stats.delete())
+    totals = {}
+    for row in conn.execute(sa.select(matchday_results)):
+        for user_id, values in _contributions(row._mapping).items():
+            current = totals.setdefault(user_id, [0] * len(STATS_COLUMNS))
+            totals[user_id] = [a + b for a, b in zip(current, values)]
+    _apply_stats_deltas(conn, totals)
+
+
+def matchday_to_dict(row):
+    """API shape of a matchday row (same keys the banner has always used)"""
+    if row is None:
+        return None
+    matchday = {'number': row['number']}
+    for field, prefix, _ in PLAYER_FIELDS:
+        matchday[field] = row[f'{prefix}_name']
+        matchday[f'{field}Id'] = row[f'{prefix}_id']
+    matchday['accumulated'] = format_money(row['accumulated_cents'])
+    matchday['accumulatedCents'] = row['accumulated_cents']
+    return matchday
+
+
+def get_matchday(conn, number=None):
+    """One matchday by number, or the latest one"""
+    if number is None:
+        result = conn.execute(sa.text('SELECT * FROM matchday_results ORDER BY number DESC LIMIT 1'))
+    else:
+        result = conn.execute(
+            sa.text('SELECT * FROM matchday_results WHERE number = :number'),
+            {"number": number}
+        )
+    row = result.fetchone()
+    return matchday_to_dict(row._mapping) if row else None
+
+
+def get_matchday_history(conn, limit, before=None):
+    """Newest first, keyset-paginated on number"""
+    if before is None:
+        result = conn.execute(
+            sa.text('SELECT * FROM matchday_results ORDER BY number DESC LIMIT :limit'),
+            {"limit": limit}
+        )
+    else:
+        result = conn.execute(
+            sa.text('SELECT * FROM matchday_results WHERE number < :before ORDER BY number DESC LIMIT :limit'),
+            {"before": before, "limit": limit}
+        )
+    return [matchday_to_dict(row._mapping) for row in result]
+
+
+def get_season_standings(conn):
+    result = conn.execute(sa.text(f'''
+        SELECT s.user_id, u.name, {', '.join(f's.{column}' for column in STATS_COLUMNS)}
+        FROM matchday_player_stats s
+        JOIN users u ON u.id = s.user_id
+        ORDER BY s.top_finishes DESC, s.winnings_cents DESC, s.user_id
+    '''))
+    standings = []
+    for row in result:
+        entry = dict(row._mapping)
+        entry['winnings'] = format_money(entry['winnings_cents'])
+        standings.append(entry)
+    return standings
+
+
+def migrate_matchday_info(conn):
+    """Copy the single legacy matchdayInfo row into matchday_results"""
+    for row in conn.execute(sa.text('SELECT * FROM matchdayInfo')).fetchall():
+        legacy = {key.lower(): value for key, value in row._mapping.items()}
+        data = {
+            'number': legacy['number'],
+            'topPlayer': legacy['topplayer'],
+            'secondToLast': legacy['secondtolast'],
+            'lastPlayer': legacy['lastplayer'],
+            # The admin payload sends false when everyone made substitutions
+            'noSubs': None if str(legacy['nosubs']).lower() in ('false', 'none', '') else legacy['nosubs'],
+        }
+        try:
+            data['accumulated'] = parse_money(legacy['accumulated']) / 100
+        except MatchdayError:
+            log.error('Unreadable accumulated value, migrating as $0', extra={'value': legacy['accumulated']})
+            data['accumulated'] = 0
+        record_matchday(conn, data)
@@ -0,0 +1,257 @@
+import sys
+from database import get_connection
+import sqlalchemy as sa
+from config import Config
+from utils.log import get_logger
+from models.rating_stats import CREATE_RATING_STATS_TABLE, backfill_rating_stats
+from models.matchdays import CREATE_MATCHDAY_TABLES, migrate_matchday_info
+from models.analytics import CREATE_PLAYER_ANALYTICS_TABLE
+from models.revocations import CREATE_TOKEN_REVOCATIONS_TABLE
+from models.jobs import CREATE_JOBS_TABLE
+
+log = get_logger(__name__)
+
+# Versioned schema migrations. Each entry runs once, in its own transaction,
+# and is recorded in schema_version. Deploys run
+#
+#     python -m models.migrations upgrade
+#
+# (the gunicorn master also does this once in on_starting), and workers only
+# check that the recorded version is current before serving.
+#
+# Never edit a migration that has shipped; append a new one instead.
+
+# Key for pg_advisory_lock, so only one process migrates at a time
+MIGRATION_LOCK_KEY = 48151623
+
+
+def _id_column(conn):
+    # SQLite only fills in ids for INTEGER PRIMARY KEY; a SERIAL column there
+    # is a plain nullable integer
+    return 'SERIAL PRIMARY KEY' if _is_postgres(conn) else 'INTEGER PRIMARY KEY'
+
+
+def _create_base_tables(conn):
+    # IF NOT EXISTS: databases created by the old init_db() already have these
+    id_column = _id_column(conn)
+    conn.execute(sa.text(f'''
+        CREATE TABLE IF NOT EXISTS users (
+            id {id_column},
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    '''))
+
+    conn.execute(sa.text(f'''
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            id {id_column},
+            user_id INTEGER NOT NULL,
+            position TEXT,
+            favorite_team TEXT,
+            picture TEXT,
+            slogan TEXT,
+            completed BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(user_id)
+        )
+    '''))
+
+    conn.execute(sa.text(f'''
+        CREATE TABLE IF NOT EXISTS user_ratings (
+            id {id_column},
+            rated_user_id INTEGER NOT NULL,
+            rater_user_id INTEGER NOT NULL,
+            skill_1 INTEGER NOT NULL,
+            skill_2 INTEGER NOT NULL,
+            skill_3 INTEGER NOT NULL,
+            skill_4 INTEGER NOT NULL,
+            skill_5 INTEGER NOT NULL,
+            skill_6 INTEGER NOT NULL,
+            overall_score INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (rated_user_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (rater_user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(rated_user_id, rater_user_id)
+        )
+    '''))
+
+    conn.execute(sa.text(f'''
+        CREATE TABLE IF NOT EXISTS matchdayInfo (
+            id {id_column},
+            number INTEGER NOT NULL,
+            topPlayer TEXT NOT NULL,
+            lastPlayer TEXT NOT NULL,
+            secondToLast TEXT NOT NULL,
+            noSubs TEXT NOT NULL,
+            accumulated TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    '''))
+
+
+def _create_rating_stats(conn):
+    conn.execute(sa.text(CREATE_RATING_STATS_TABLE))
+    backfill_rating_stats(conn)
+
+
+def _add_lookup_indexes(conn):
+    # user_ratings(rated_user_id, ...) and user_preferences(user_id) are
+    # already covered by their UNIQUE constraints. Lookups by rater (a user's
+    # own ratings, deleting a user) were sequential scans.
+    conn.execute(sa.text(
+        'CREATE INDEX IF NOT EXISTS idx_user_ratings_rater ON user_ratings (rater_user_id)'
+    ))
+
+
+def _create_matchday_history(conn):
+    # matchdayInfo is left in place (no longer written) for rollbacks
+    for statement in CREATE_MATCHDAY_TABLES:
+        conn.execute(sa.text(statement))
+    migrate_matchday_info(conn)
+
+
+def _create_player_analytics(conn):
+    # Filled by "python -m models.analytics refresh" (or the master's refresher)
+    conn.execute(sa.text(CREATE_PLAYER_ANALYTICS_TABLE))
+
+
+def _create_token_revocations(conn):
+    for statement in CREATE_TOKEN_REVOCATIONS_TABLE:
+        conn.execute(sa.text(statement.format(id_column=_id_column(conn))))
+
+
+def _create_jobs(conn):
+    for statement in CREATE_JOBS_TABLE:
+        conn.execute(sa.text(statement.format(id_column=_id_column(conn))))
+
+
+MIGRATIONS = [
+    (1, 'base tables', _create_base_tables),
+    (2, 'user_rating_stats', _create_rating_stats),
+    (3, 'lookup indexes', _add_lookup_indexes),
+    (4, 'matchday history', _create_matchday_history),
+    (5, 'player analytics', _create_player_analytics),
+    (6, 'token revocations', _create_token_revocations),
+    (7, 'background jobs', _create_jobs),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _is_postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def _ensure_version_table(conn):
+    conn.execute(sa.text('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    '''))
+
+
+def get_schema_version(conn):
+    """Highest applied migration, or 0 for a database that was never migrated"""
+    try:
+        return conn.execute(sa.text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+    except sa.exc.DBAPIError:
+        return 0
+
+
+def schema_is_current():
+    conn = get_connection()
+    try:
+        return get_schema_version(conn) >= LATEST_VERSION
+    finally:
+        conn.close()
+
+
+def migrate():
+    """Apply pending migrations. Returns the list of versions applied."""
+    conn = get_connection()
+    applied = []
+    try:
+        if _is_postgres(conn):
+            # Session-level lock: held across the per-migration transactions
+            # below; other processes block here until we are done
+            conn.execute(sa.text('SELECT pg_advisory_lock(:key)'), {"key": MIGRATION_LOCK_KEY})
+
+        try:
+            with conn.begin():
+                _ensure_version_table(conn)
+
+            # Re-read under the lock: another process may have just migrated
+            current = get_schema_version(conn)
+            for version, name, apply in MIGRATIONS:
+                if version <= current:
+                    continue
+
+                with conn.begin():
+                    # SQLite has no advisory lock; instead each migration
+                    # checks the version again inside its own transaction,
+                    # which BEGIN IMMEDIATE (database.py) makes the only
+                    # writer until it commits
+                    if get_schema_version(conn) >= version:
+                        continue
+                    log.info('Applying migration', extra={'version': version, 'migration': name})
+                    apply(conn)
+                    conn.execute(
+                        sa.text('INSERT INTO schema_version (version, name) VALUES (:version, :name)'),
+                        {"version": version, "name": name}
+                    )
+                applied.append(version)
+        finally:
+            if _is_postgres(conn):
+                conn.execute(sa.text('SELECT pg_advisory_unlock(:key)'), {"key": MIGRATION_LOCK_KEY})
+
+    except Exception as e:
+        log.error('Migration failed', extra={'error': str(e)})
+        raise
+    finally:
+        conn.close()
+
+    if applied:
+        log.info('Schema migrated', extra={'version': LATEST_VERSION})
+    return applied
+
+
+def ensure_schema():
+    """Worker startup check: one cheap query when the schema is current"""
+    if schema_is_current():
+        return
+
+    if not Config.AUTO_MIGRATE:
+        raise RuntimeError(
+            f'Database schema is behind version {LATEST_VERSION}; '
+            'run "python -m models.migrations upgrade"'
+        )
+    migrate()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'upgrade':
+        applied = migrate()
+        print(f"Applied migrations: {', '.join(map(str, applied))}" if applied else 'Schema is current')
+    elif command == 'status':
+        conn = get_connection()
+        try:
+            current = get_schema_version(conn)
+        finally:
+            conn.close()
+        pending = [f'{version} ({name})' for version, name, _ in MIGRATIONS if version > current]
+        print(f'Schema version {current}, latest {LATEST_VERSION}')
+        if pending:
+            print(f"Pending: {', '.join(pending)}")
+            sys.exit(1)
+    else:
+        print('usage: python -m models.migrations upgrade|status')
+        sys.exit(2)
@@ -0,0 +1,178 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import sqlalchemy as sa
+from config import Config
+from database import get_connection
+from models.tables import users, user_preferences, user_ratings, all_rows
+from models.rating_stats import POSITION_SKILLS, SKILL_COLUMNS, get_rating_stats, stats_to_summary
+from utils.cache import TTLCache
+from utils.versions import get_version_store
+from utils.metrics import inc
+
+# Read-through cache of the rating breakdown shown on a player's page: the
+# position and its skill names, every rating with the rater's name, and the
+# averages. Entries are tagged with the versions of 'ratings' (renames and
+# deletes) and 'ratings:<id>' (ratings of, and preference changes by, that
+# user) read before the breakdown was loaded. A lookup whose tag no longer
+# matches the version store is a miss, so every write that bumps those keys
+# invalidates exactly the breakdowns it touched, in every worker that shares
+# the version store.
+#
+# Backends:
+#   memory  LRU per worker (RATING_CACHE_SIZE entries, RATING_CACHE_TTL)
+#   file    one JSON file per user under RATING_CACHE_PATH, shared by every
+#           worker on the host so a breakdown is loaded once, not per worker
+
+# Only what the client reads: who rated, and the scores. Bump SHAPE_VERSION
+# when this changes so entries in a shared backend aren't served in the old
+# shape.
+_RATINGS_FOR_USER = (
+    sa.select(
+        user_ratings.c.rater_user_id, users.c.name.label('rater_name'), user_ratings.c.overall_score,
+        *[user_ratings.c[skill] for skill in SKILL_COLUMNS],
+    )
+    .join(users, user_ratings.c.rater_user_id == users.c.id)
+    .where(user_ratings.c.rated_user_id == sa.bindparam('user_id'))
+    .order_by(user_ratings.c.rater_user_id)
+)
+SHAPE_VERSION = 2
+_POSITION_FOR_USER = sa.select(user_preferences.c.position).where(
+    user_preferences.c.user_id == sa.bindparam('user_id'))
+
+
+class MemoryBreakdownCache:
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, user_id):
+        return self._cache.get(user_id)
+
+    def set(self, user_id, entry):
+        self._cache.set(user_id, entry)
+
+    def stats(self):
+        stats = self._cache.stats()
+        return {'size': stats['size'], 'maxsize': stats['maxsize'], 'evictions': stats['evictions']}
+
+
+class FileBreakdownCache:
+    """Entries as <root>/<user id>.json, written atomically"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, user_id):
+        return os.path.join(self.root, f'{int(user_id)}.json')
+
+    def get(self, user_id):
+        try:
+            with open(self._path(user_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, user_id, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(user_id))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def stats(self):
+        return {'size': len([name for name in os.listdir(self.root) if re.match(r'^\d+\.json$', name)])}
+
+
+RATING_CACHE_BACKENDS = {
+    'memory': lambda: MemoryBreakdownCache(Config.RATING_CACHE_SIZE, Config.RATING_CACHE_TTL),
+    'file': lambda: FileBreakdownCache(Config.RATING_CACHE_PATH),
+}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stale': 0}
+
+
+def register_rating_cache_backend(name, factory):
+    RATING_CACHE_BACKENDS[name] = factory
+
+
+def get_breakdown_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                factory = RATING_CACHE_BACKENDS.get(Config.RATING_CACHE_BACKEND)
+                if factory is None:
+                    raise RuntimeError(f'Unknown rating cache backend: {Config.RATING_CACHE_BACKEND}')
+                _cache = factory()
+    return _cache
+
+
+def _count(result):
+    with _stats_lock:
+        _stats[result] += 1
+    inc('fantasyfc_rating_cache_lookups_total', {'result': result})
+
+
+def load_rating_breakdown(conn, user_id):
+    """Position, skill names, ratings (with rater names) and averages for one user"""
+    position = conn.execute(_POSITION_FOR_USER, {"user_id": user_id}).scalar()
+    skills = POSITION_SKILLS.get(position, [])
+    ratings = all_rows(conn.execute(_RATINGS_FOR_USER, {"user_id": user_id}))
+
+    # Totals come from user_rating_stats instead of summing the rows
+    summary = stats_to_summary(get_rating_stats(conn, user_id))
+    return {
+        'ratings': ratings,
+        'average_score': summary['average_score'],
+        'rating_count': summary['rating_count'],
+        'skill_averages': summary['skill_averages'][:len(skills)],
+        'skills': skills,
+        'position': position,
+    }
+
+
+def get_rating_breakdown(user_id):
+    """The breakdown for user_id, from the cache when its tag is still current"""
+    # Read versions before loading, so a concurrent write can only leave the
+    # entry tagged older than its data (a later miss), never newer
+    store = get_version_store()
+    versions = [SHAPE_VERSION, store.epoch(), store.get('ratings')[0], store.get(f'ratings:{user_id}')[0]]
+
+    cache = get_breakdown_cache()
+    entry = cache.get(user_id)
+    if entry is not None:
+        if entry['versions'] == versions:
+            _count('hits')
+            return entry['breakdown']
+        _count('stale')
+    else:
+        _count('misses')
+
+    conn = get_connection()
+    try:
+        breakdown = load_rating_breakdown(conn, user_id)
+    finally:
+        conn.close()
+    cache.set(user_id, {'versions': versions, 'breakdown': breakdown})
+    return breakdown
+
+
+def get_rating_cache_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses'] + stats['stale']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+    stats['backend'] = Config.RATING_CACHE_BACKEND
+    stats.update(get_breakdown_cache().stats())
+    return stats
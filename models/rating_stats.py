@@ -0,0 +1,233 @@
+import sys
+from database import get_connection
+import sqlalchemy as sa
+from models.tables import user_ratings, user_rating_stats, upsert, first
+
+# user_rating_stats keeps running totals per rated user so read paths don't
+# have to aggregate user_ratings. It is maintained inside the same
+# transaction as every rating write; rebuild_rating_stats() recomputes it
+# from scratch if it ever drifts.
+SKILL_COLUMNS = [f'skill_{i}' for i in range(1, 7)]
+
+# What skill_1..skill_6 mean for each position
+POSITION_SKILLS = {
+    'Goalkeeper': ['Diving', 'Handling', 'Kicking', 'Reflexes', 'Positioning', 'Speed'],
+    'Defender': ['Defending', 'Physicality', 'Pace', 'Interceptions', 'Heading Accuracy', 'Marking'],
+    'Midfielder': ['Passing', 'Dribbling', 'Physicality', 'Defending', 'Pace', 'Shooting'],
+    'Forward': ['Shooting', 'Pace', 'Dribbling', 'Finishing', 'Positioning', 'Physicality']
+}
+SUM_COLUMNS = ['overall_sum'] + [f'{skill}_sum' for skill in SKILL_COLUMNS]
+
+CREATE_RATING_STATS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS user_rating_stats (
+        rated_user_id INTEGER PRIMARY KEY,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        overall_sum INTEGER NOT NULL DEFAULT 0,
+        skill_1_sum INTEGER NOT NULL DEFAULT 0,
+        skill_2_sum INTEGER NOT NULL DEFAULT 0,
+        skill_3_sum INTEGER NOT NULL DEFAULT 0,
+        skill_4_sum INTEGER NOT NULL DEFAULT 0,
+        skill_5_sum INTEGER NOT NULL DEFAULT 0,
+        skill_6_sum INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (rated_user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+'''
+
+# Aggregate user_ratings into the stats shape, optionally filtered
+_AGGREGATE_SELECT = f'''
+    SELECT rated_user_id, COUNT(*) AS rating_count, SUM(overall_score) AS overall_sum,
+           {', '.join(f'SUM({skill}) AS {skill}_sum' for skill in SKILL_COLUMNS)}
+    FROM user_ratings
+'''
+
+
+def backfill_rating_stats(conn):
+    """Create stats rows for rated users that don't have one yet"""
+    conn.execute(sa.text(f'''
+        INSERT INTO user_rating_stats (rated_user_id, rating_count, {', '.join(SUM_COLUMNS)})
+        {_AGGREGATE_SELECT}
+        WHERE rated_user_id NOT IN (SELECT rated_user_id FROM user_rating_stats)
+        GROUP BY rated_user_id
+    '''))
+
+
+def apply_rating(conn, rated_user_id, rater_user_id, skills_data, overall_score):
+    """Upsert one rating and fold it into user_rating_stats (see apply_ratings)"""
+    return apply_ratings(conn, rater_user_id, [
+        {"rated_user_id": rated_user_id, "overall_score": overall_score, **skills_data}
+    ])
+
+
+# Built once per process (models.tables.upsert caches the upserts per dialect)
+_LOCK_STATS = (
+    sa.select(user_rating_stats.c.rated_user_id, user_rating_stats.c.rating_count, user_rating_stats.c.overall_sum)
+    .where(user_rating_stats.c.rated_user_id.in_(sa.bindparam('rated_ids', expanding=True)))
+    .order_by(user_rating_stats.c.rated_user_id)
+    # Rendered on PostgreSQL only; SQLite transactions already hold the
+    # database write lock (BEGIN IMMEDIATE, see database.py)
+    .with_for_update()
+)
+_PREVIOUS_RATINGS = (
+    sa.select(user_ratings.c.rated_user_id, user_ratings.c.overall_score,
+              *[user_ratings.c[skill] for skill in SKILL_COLUMNS])
+    .where(user_ratings.c.rater_user_id == sa.bindparam('rater_user_id'))
+    .where(user_ratings.c.rated_user_id.in_(sa.bindparam('rated_ids', expanding=True)))
+)
+_RATINGS_BY_RATER = (
+    sa.select(user_ratings.c.rated_user_id, user_ratings.c.overall_score,
+              *[user_ratings.c[skill] for skill in SKILL_COLUMNS])
+    .where(user_ratings.c.rater_user_id == sa.bindparam('rater_user_id'))
+)
+
+
+def apply_stats_deltas(conn, deltas):
+    """Add {rated_user_id: [count, overall, skill_1..skill_6]} to user_rating_stats.
+
+    One executemany of an incrementing upsert: rows that don't exist yet are
+    created with the deltas as their totals.
+    """
+    if not deltas:
+        return
+    conn.execute(
+        upsert(conn, user_rating_stats, ['rated_user_id'], increment=['rating_count'] + SUM_COLUMNS, touch=True),
+        [
+            {"rated_user_id": rated_user_id, **dict(zip(['rating_count'] + SUM_COLUMNS, values))}
+            for rated_user_id, values in sorted(deltas.items())
+        ]
+    )
+
+
+def apply_ratings(conn, rater_user_id, ratings):
+    """Upsert ratings by one rater and fold them into user_rating_stats.
+
+    ratings is a list of dicts with rated_user_id, skill_1..skill_6 and
+    overall_score, at most one per rated user. Must run inside a transaction
+    on conn. The stats rows are locked first (in id order, so batches can't
+    deadlock each other) so concurrent ratings of the same user apply their
+    deltas one at a time. Costs a fixed number of statements per batch.
+
+    Returns {rated_user_id: (rating_count, overall_sum)} after the update.
+    """
+    if not ratings:
+        return {}
+
+    rated_ids = sorted(rating['rated_user_id'] for rating in ratings)
+
+    conn.execute(
+        upsert(conn, user_rating_stats, ['rated_user_id']),
+        [{"rated_user_id": rated_id} for rated_id in rated_ids]
+    )
+    locked = {
+        row.rated_user_id: (row.rating_count, row.overall_sum)
+        for row in conn.execute(_LOCK_STATS, {"rated_ids": rated_ids})
+    }
+
+    previous = {
+        row.rated_user_id: row._mapping
+        for row in conn.execute(_PREVIOUS_RATINGS, {"rater_user_id": rater_user_id, "rated_ids": rated_ids})
+    }
+
+    columns = ['rated_user_id', 'overall_score'] + SKILL_COLUMNS
+    conn.execute(
+        upsert(conn, user_ratings, ['rated_user_id', 'rater_user_id'],
+               replace=['overall_score'] + SKILL_COLUMNS, touch=True),
+        [{"rater_user_id": rater_user_id, **{column: rating[column] for column in columns}} for rating in ratings]
+    )
+
+    # A re-rating replaces the previous values, so only the difference counts
+    deltas = {}
+    for rating in ratings:
+        old = previous.get(rating['rated_user_id'], {})
+        deltas[rating['rated_user_id']] = [
+            0 if old else 1,
+            rating['overall_score'] - old.get('overall_score', 0),
+        ] + [rating[skill] - old.get(skill, 0) for skill in SKILL_COLUMNS]
+    apply_stats_deltas(conn, deltas)
+
+    # The rows are locked, so the new totals are the locked ones plus the deltas
+    return {
+        rated_id: (count + deltas[rated_id][0], overall_sum + deltas[rated_id][1])
+        for rated_id, (count, overall_sum) in locked.items()
+    }
+
+
+def remove_ratings_by_rater(conn, rater_user_id):
+    """Subtract everything a user has rated, before their ratings are cascaded away"""
+    deltas = {
+        row.rated_user_id: [-1, -row.overall_score] + [-row._mapping[skill] for skill in SKILL_COLUMNS]
+        for row in conn.execute(_RATINGS_BY_RATER, {"rater_user_id": rater_user_id})
+    }
+    apply_stats_deltas(conn, deltas)
+
+
+def stats_to_summary(stats):
+    """Average and per-skill averages (rounded like the API always has) from a stats row"""
+    count = stats['rating_count'] if stats else 0
+    if not count:
+        return {'average_score': 0, 'rating_count': 0, 'skill_averages': [0] * len(SKILL_COLUMNS)}
+
+    return {
+        'average_score': round(stats['overall_sum'] / count),
+        'rating_count': count,
+        'skill_averages': [round(stats[f'{skill}_sum'] / count) for skill in SKILL_COLUMNS],
+    }
+
+
+def get_rating_stats(conn, rated_user_id):
+    return first(conn.execute(
+        sa.select(user_rating_stats).where(user_rating_stats.c.rated_user_id == rated_user_id)
+    ))
+
+
+def find_drift(conn):
+    """Rated user ids whose stats row doesn't match user_ratings"""
+    expected = {row.rated_user_id: row for row in conn.execute(sa.text(f'{_AGGREGATE_SELECT} GROUP BY rated_user_id'))}
+    actual = {row.rated_user_id: row for row in conn.execute(sa.text('SELECT * FROM user_rating_stats'))}
+
+    drifted = []
+    for rated_user_id in set(expected) | set(actual):
+        want = expected.get(rated_user_id)
+        have = actual.get(rated_user_id)
+        want_values = [want.rating_count] + [getattr(want, c) for c in SUM_COLUMNS] if want else [0] * 8
+        have_values = [have.rating_count] + [getattr(have, c) for c in SUM_COLUMNS] if have else [0] * 8
+        if [int(v or 0) for v in want_values] != [int(v or 0) for v in have_values]:
+            drifted.append(rated_user_id)
+    return sorted(drifted)
+
+
+def verify_rating_stats():
+    conn = get_connection()
+    try:
+        return find_drift(conn)
+    finally:
+        conn.close()
+
+
+def rebuild_rating_stats():
+    """Recompute user_rating_stats from user_ratings in one transaction"""
+    conn = get_connection()
+    try:
+        with conn.begin():
+            if conn.dialect.name == 'postgresql':
+                conn.execute(sa.text('LOCK TABLE user_rating_stats IN EXCLUSIVE MODE'))
+            conn.execute(sa.text('DELETE FROM user_rating_stats'))
+            backfill_rating_stats(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'verify':
+        drifted = verify_rating_stats()
+        if drifted:
+            print(f"ERROR: rating stats drifted for user ids: {', '.join(map(str, drifted))}")
+            sys.exit(1)
+        print('Rating stats are consistent')
+    elif command == 'rebuild':
+        rebuild_rating_stats()
+        print('Rating stats rebuilt')
+    else:
+        print('usage: python -m models.rating_stats verify|rebuild')
+        sys.exit(2)
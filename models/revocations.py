@@ -0,0 +1,47 @@
+import time
+import sqlalchemy as sa
+from models.tables import token_revocations
+
+# Token revocations, loaded by every worker into memory (see utils/auth.py).
+# Append-only apart from purging: one row per revocation, with the moment
+# after which it can't matter any more (every token it covers has expired).
+#
+# Subjects:
+#   user:<id>     every token of the user issued up to revoked_at
+#   token:<jti>   one refresh token (logout)
+#   all           every token issued up to revoked_at (snapshot imports)
+CREATE_TOKEN_REVOCATIONS_TABLE = [
+    '''
+    CREATE TABLE IF NOT EXISTS token_revocations (
+        id {id_column},
+        subject TEXT NOT NULL,
+        revoked_at DOUBLE PRECISION NOT NULL,
+        expires_at DOUBLE PRECISION NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_token_revocations_expires ON token_revocations (expires_at)',
+]
+
+_ACTIVE_REVOCATIONS = (
+    sa.select(token_revocations.c.subject, sa.func.max(token_revocations.c.revoked_at))
+    .where(token_revocations.c.expires_at > sa.bindparam('now'))
+    .group_by(token_revocations.c.subject)
+)
+
+
+def add_revocation(conn, subject, expires_at):
+    """Record a revocation (and drop expired ones). Returns its revoked_at."""
+    now = time.time()
+    conn.execute(token_revocations.delete().where(token_revocations.c.expires_at <= now))
+    conn.execute(token_revocations.insert(), {"subject": subject, "revoked_at": now, "expires_at": expires_at})
+    return now
+
+
+def clear_revocations(conn):
+    """Drop every revocation (before an 'all' one makes them moot)"""
+    conn.execute(token_revocations.delete())
+
+
+def load_revocations(conn):
+    """{subject: revoked_at} for every revocation still in effect"""
+    return dict(conn.execute(_ACTIVE_REVOCATIONS, {"now": time.time()}).fetchall())
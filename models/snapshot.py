@@ -0,0 +1,328 @@
+import argparse
+import base64
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import sys
+import tarfile
+import time
+import sqlalchemy as sa
+from database import get_connection
+from models.tables import (users, user_preferences, user_ratings, user_rating_stats, matchday_results,
+                           matchday_player_stats, player_analytics)
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# League snapshots, for backups, staging refreshes and benchmark data:
+#
+#     python -m models.snapshot export league.snapshot
+#     python -m models.snapshot import league.snapshot [--replace]
+#
+# A snapshot is a tar archive of
+#   tables/<table>/<n>.json.gz  up to --chunk-rows rows of one table, stored
+#                               by column ({"id": [...], "name": [...]}) and
+#                               gzipped; columns of similar values compress
+#                               far better than rows
+#   pictures/<sha256>           each distinct picture once; rows refer to it
+#                               by hash (inline data URLs are hashed on the
+#                               way out)
+#   manifest.json               (last) schema version, columns, row counts,
+#                               chunk files and picture content types
+#
+# Tables are read through server-side cursors (PostgreSQL) in one
+# repeatable-read transaction, so memory stays at one chunk however large
+# the league. Derived tables (rating and matchday totals, analytics) aren't
+# exported: the import rebuilds them. The legacy matchdayInfo table is
+# superseded by matchday_results and not included.
+FORMAT_VERSION = 1
+DEFAULT_CHUNK_ROWS = 10000
+
+# In foreign key order: imported front to back, cleared back to front
+SNAPSHOT_TABLES = [users, user_preferences, user_ratings, matchday_results]
+DERIVED_TABLES = [player_analytics, matchday_player_stats, user_rating_stats]
+# Tables with a SERIAL id whose sequence must catch up after an import
+SERIAL_TABLES = [users, user_preferences, user_ratings]
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        # The text form both COPY and SQLite's DATETIME read back as-is
+        return value.isoformat(sep=' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f'Cannot encode {type(value).__name__} in a snapshot')
+
+
+def _add_member(archive, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    archive.addfile(info, io.BytesIO(data))
+
+
+class _PictureWriter:
+    """Adds each distinct picture to the archive the first time a row refers to it"""
+
+    def __init__(self, archive):
+        from utils.pictures import get_picture_store
+
+        self.archive = archive
+        self.store = get_picture_store()
+        self.content_types = {}
+        self.missing = set()
+
+    def add(self, value):
+        """The value to keep in the picture column for a stored value"""
+        from utils.pictures import PICTURE_HASH_RE, DATA_URL_RE
+
+        if not value:
+            return value
+        match = DATA_URL_RE.match(value)
+        if match:
+            # Legacy inline picture: export it like a stored one
+            content_type, payload = match.groups()
+            data = base64.b64decode(payload)
+            digest = hashlib.sha256(data).hexdigest()
+            if digest not in self.content_types:
+                _add_member(self.archive, f'pictures/{digest}', data)
+                self.content_types[digest] = content_type
+            return digest
+
+        if PICTURE_HASH_RE.match(value) and value not in self.content_types and value not in self.missing:
+            opened = self.store.open(value)
+            if opened is None:
+                self.missing.add(value)
+                return value
+            f, content_type = opened
+            with f:
+                _add_member(self.archive, f'pictures/{value}', f.read())
+            self.content_types[value] = content_type
+        return value
+
+
+def export_snapshot(path, chunk_rows=DEFAULT_CHUNK_ROWS, pictures=True):
+    """Write the league to a snapshot archive at path. Returns the manifest."""
+    from models.migrations import get_schema_version
+
+    manifest = {
+        'format': FORMAT_VERSION,
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'tables': {},
+        'pictures': {},
+    }
+
+    conn = get_connection()
+    try:
+        if conn.dialect.name == 'postgresql':
+            # One consistent view of every table, without blocking writers
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+        with tarfile.open(path, 'w') as archive, conn.begin():
+            manifest['schema_version'] = get_schema_version(conn)
+            picture_writer = _PictureWriter(archive) if pictures else None
+
+            for table in SNAPSHOT_TABLES:
+                columns = [column.name for column in table.c]
+                result = conn.execution_options(stream_results=True, max_row_buffer=chunk_rows).execute(
+                    sa.select(table).order_by(*table.primary_key.columns))
+                chunks = []
+                row_count = 0
+                for rows in result.partitions(chunk_rows):
+                    values = {name: list(column) for name, column in zip(columns, zip(*rows))}
+                    if table is user_preferences and picture_writer:
+                        values['picture'] = [picture_writer.add(value) for value in values['picture']]
+                    name = f'tables/{table.name}/{len(chunks):05d}.json.gz'
+                    data = json.dumps(values, default=_json_default, separators=(',', ':')).encode()
+                    _add_member(archive, name, gzip.compress(data, compresslevel=6))
+                    chunks.append(name)
+                    row_count += len(rows)
+                manifest['tables'][table.name] = {'columns': columns, 'rows': row_count, 'chunks': chunks}
+
+            if picture_writer:
+                manifest['pictures'] = picture_writer.content_types
+                if picture_writer.missing:
+                    log.warning('Pictures missing from the store were not exported',
+                                extra={'count': len(picture_writer.missing)})
+            _add_member(archive, 'manifest.json', json.dumps(manifest, indent=2).encode())
+    finally:
+        conn.close()
+    return manifest
+
+
+def _copy_value(value):
+    # COPY text format: \N is NULL; backslash, tab and newlines are escaped
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_rows(conn, table, columns, rows):
+    """PostgreSQL: stream the chunk through COPY FROM STDIN"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN", buffer)
+    finally:
+        cursor.close()
+
+
+# DBAPI placeholder per paramstyle, for _insert_rows
+_PLACEHOLDERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+
+
+def _insert_rows(conn, table, columns, rows):
+    """Any other dialect: one DBAPI executemany per chunk.
+
+    Skips SQLAlchemy's per-row parameter processing, which costs several
+    times the insert itself; timestamps are already in the text form
+    SQLite stores.
+    """
+    placeholder = _PLACEHOLDERS[conn.dialect.paramstyle]
+    statement = f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))})"
+    cursor = conn.connection.cursor()
+    try:
+        cursor.executemany(statement, rows)
+    finally:
+        cursor.close()
+
+
+BULK_LOADERS = {
+    'postgresql': _copy_rows,
+}
+
+
+def _read_json(archive, name):
+    try:
+        data = archive.extractfile(name).read()
+    except KeyError:
+        raise SnapshotError(f'{name} is missing from the snapshot')
+    return json.loads(gzip.decompress(data) if name.endswith('.gz') else data)
+
+
+def import_snapshot(path, replace=False, pictures=True):
+    """Load a snapshot archive into the database in one transaction.
+
+    The league tables must be empty unless replace is set, in which case
+    they are cleared first. Every token issued before the import is revoked.
+    Returns the manifest.
+    """
+    from models.migrations import migrate, LATEST_VERSION
+    from models.rating_stats import backfill_rating_stats
+    from models.matchdays import rebuild_player_stats
+    from utils.pictures import store_picture, PictureError
+    from utils.versions import bump
+    from utils.auth import revoke_all
+
+    migrate()
+    try:
+        archive = tarfile.open(path, 'r')
+    except (OSError, tarfile.TarError) as e:
+        raise SnapshotError(f'Not a snapshot archive: {e}')
+
+    with archive:
+        manifest = _read_json(archive, 'manifest.json')
+        if manifest.get('format') != FORMAT_VERSION:
+            raise SnapshotError(f"Unsupported snapshot format {manifest.get('format')}")
+        if manifest.get('schema_version', 0) > LATEST_VERSION:
+            raise SnapshotError(f"Snapshot is from a newer schema ({manifest['schema_version']}); upgrade first")
+        for table in SNAPSHOT_TABLES:
+            unknown = set(manifest['tables'][table.name]['columns']) - set(table.c.keys())
+            if unknown:
+                raise SnapshotError(f"{table.name} has columns this schema doesn't know: {', '.join(sorted(unknown))}")
+
+        # Pictures go to the store first; the store is content-addressed, so
+        # a failed import leaves nothing inconsistent behind
+        if pictures:
+            unreadable = 0
+            for digest, content_type in manifest['pictures'].items():
+                data = archive.extractfile(f'pictures/{digest}').read()
+                if hashlib.sha256(data).hexdigest() != digest:
+                    raise SnapshotError(f'Picture {digest} is corrupt')
+                try:
+                    store_picture(data, content_type)
+                except PictureError:
+                    # Rows keep the hash; the picture 404s like any missing one
+                    unreadable += 1
+            if unreadable:
+                log.warning('Pictures that are not valid images were skipped', extra={'count': unreadable})
+
+        conn = get_connection()
+        try:
+            load = BULK_LOADERS.get(conn.dialect.name, _insert_rows)
+            with conn.begin():
+                if not replace and conn.execute(sa.select(users.c.id).limit(1)).first():
+                    raise SnapshotError('The database already has users; import with --replace to overwrite them')
+                for table in DERIVED_TABLES + SNAPSHOT_TABLES[::-1]:
+                    conn.execute(table.delete())
+                # Imported ids belong to other people than the ones existing
+                # tokens were issued to
+                revoke_all(conn)
+
+                for table in SNAPSHOT_TABLES:
+                    info = manifest['tables'][table.name]
+                    for name in info['chunks']:
+                        values = _read_json(archive, name)
+                        columns = list(values)
+                        rows = list(zip(*[values[column] for column in columns]))
+                        if rows:
+                            load(conn, table, columns, rows)
+
+                backfill_rating_stats(conn)
+                rebuild_player_stats(conn)
+                if conn.dialect.name == 'postgresql':
+                    # Explicit ids don't advance the SERIAL sequences
+                    for table in SERIAL_TABLES:
+                        conn.execute(sa.text(
+                            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                            f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}"
+                        ))
+                user_ids = [row[0] for row in conn.execute(sa.select(users.c.id))]
+        finally:
+            conn.close()
+
+    bump('users', 'leaderboard', 'matchday', 'ratings', *[f'profile:{user_id}' for user_id in user_ids])
+    return manifest
+
+
+def _summary(manifest):
+    tables = ', '.join(f"{name} {info['rows']}" for name, info in manifest['tables'].items())
+    return f"{tables}; {len(manifest['pictures'])} pictures"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or import a league snapshot (uses DATABASE_URL)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='write the league to a snapshot archive')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    export_parser.add_argument('--no-pictures', action='store_true', help='keep picture hashes but not the images')
+    import_parser = commands.add_parser('import', help='load a snapshot archive')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--replace', action='store_true', help='clear the existing league first')
+    import_parser.add_argument('--no-pictures', action='store_true', help="don't copy pictures into the store")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    try:
+        if args.command == 'export':
+            manifest = export_snapshot(args.path, args.chunk_rows, pictures=not args.no_pictures)
+            print(f'Exported {_summary(manifest)} to {args.path} in {time.perf_counter() - started:.2f}s')
+        else:
+            manifest = import_snapshot(args.path, replace=args.replace, pictures=not args.no_pictures)
+            print(f'Imported {_summary(manifest)} in {time.perf_counter() - started:.2f}s')
+            print('Restart running workers so their in-process caches start from the new data')
+    except SnapshotError as e:
+        print(f'ERROR: {e}')
+        sys.exit(1)
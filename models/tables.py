@@ -0,0 +1,179 @@
+import functools
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+
+# SQLAlchemy Core table metadata, used to build statements that compile
+# correctly for both PostgreSQL and SQLite. The schema itself is owned by
+# models/migrations.py (these objects never run DDL), so a migration that
+# changes a table must update the matching Table here as well.
+metadata = sa.MetaData()
+
+users = sa.Table(
+    'users', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('email', sa.Text, nullable=False, unique=True),
+    sa.Column('password', sa.Text, nullable=False),
+    sa.Column('name', sa.Text, nullable=False),
+    sa.Column('created_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+)
+
+user_preferences = sa.Table(
+    'user_preferences', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, unique=True),
+    sa.Column('position', sa.Text),
+    sa.Column('favorite_team', sa.Text),
+    sa.Column('picture', sa.Text),
+    sa.Column('slogan', sa.Text),
+    sa.Column('completed', sa.Boolean, server_default=sa.false()),
+    sa.Column('created_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+    sa.Column('updated_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+)
+
+user_ratings = sa.Table(
+    'user_ratings', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('rated_user_id', sa.Integer, sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    sa.Column('rater_user_id', sa.Integer, sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    *[sa.Column(f'skill_{i}', sa.Integer, nullable=False) for i in range(1, 7)],
+    sa.Column('overall_score', sa.Integer, nullable=False),
+    sa.Column('created_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+    sa.Column('updated_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+    sa.UniqueConstraint('rated_user_id', 'rater_user_id'),
+)
+
+user_rating_stats = sa.Table(
+    'user_rating_stats', metadata,
+    sa.Column('rated_user_id', sa.Integer, sa.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    sa.Column('rating_count', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('overall_sum', sa.Integer, nullable=False, server_default='0'),
+    *[sa.Column(f'skill_{i}_sum', sa.Integer, nullable=False, server_default='0') for i in range(1, 7)],
+    sa.Column('updated_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+)
+
+matchday_results = sa.Table(
+    'matchday_results', metadata,
+    sa.Column('number', sa.Integer, primary_key=True, autoincrement=False),
+    *[
+        column
+        for prefix in ('top_player', 'second_to_last', 'last_player', 'no_subs')
+        for column in (
+            sa.Column(f'{prefix}_name', sa.Text),
+            sa.Column(f'{prefix}_id', sa.Integer, sa.ForeignKey('users.id', ondelete='SET NULL')),
+        )
+    ],
+    sa.Column('accumulated_cents', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('created_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+    sa.Column('updated_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+)
+
+matchday_player_stats = sa.Table(
+    'matchday_player_stats', metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True,
+              autoincrement=False),
+    sa.Column('top_finishes', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('second_to_last_finishes', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('last_finishes', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('no_subs_count', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('winnings_cents', sa.Integer, nullable=False, server_default='0'),
+)
+
+player_analytics = sa.Table(
+    'player_analytics', metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True,
+              autoincrement=False),
+    sa.Column('position', sa.Text),
+    sa.Column('rating_count', sa.Integer, nullable=False),
+    sa.Column('raw_score', sa.Float, nullable=False),
+    sa.Column('adjusted_score', sa.Float, nullable=False),
+    *[sa.Column(f'skill_{i}_z', sa.Float) for i in range(1, 7)],
+    sa.Column('similar', sa.Text),
+    sa.Column('computed_at', sa.DateTime, server_default=sa.func.current_timestamp()),
+)
+
+token_revocations = sa.Table(
+    'token_revocations', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('subject', sa.Text, nullable=False),
+    sa.Column('revoked_at', sa.Float, nullable=False),
+    sa.Column('expires_at', sa.Float, nullable=False),
+)
+
+jobs = sa.Table(
+    'jobs', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('name', sa.Text, nullable=False),
+    sa.Column('payload', sa.Text, nullable=False),
+    sa.Column('idempotency_key', sa.Text, unique=True),
+    sa.Column('status', sa.Text, nullable=False, server_default='queued'),
+    sa.Column('attempts', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('max_attempts', sa.Integer, nullable=False),
+    sa.Column('run_after', sa.Float, nullable=False),
+    sa.Column('locked_until', sa.Float),
+    sa.Column('last_error', sa.Text),
+    sa.Column('enqueued_at', sa.Float, nullable=False),
+    sa.Column('finished_at', sa.Float),
+)
+
+# INSERT constructs that know ON CONFLICT, per dialect
+_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+# Dialects whose INSERT can RETURN rows (SQLAlchemy 1.4 has no SQLite RETURNING)
+_RETURNING = {'postgresql'}
+
+
+def upsert(conn, table, index_elements, replace=(), increment=(), touch=False,
+           only_changed=False, returning=False):
+    """INSERT ... ON CONFLICT for conn's dialect.
+
+    With neither replace nor increment, conflicting rows are left alone (DO
+    NOTHING). Otherwise the replace columns take the new values, the
+    increment columns add them to the stored ones, and touch also sets
+    updated_at. only_changed skips the update when every replace column
+    already holds the new value. returning adds RETURNING * where the
+    dialect supports it (check result.returns_rows). The statement has no
+    VALUES: execute it with one dict of parameters, or a list of them for a
+    single executemany.
+
+    Statements are built once per process for each combination.
+    """
+    return _build_upsert(conn.dialect.name, table, tuple(index_elements), tuple(replace), tuple(increment),
+                         touch, only_changed, returning)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_upsert(dialect_name, table, index_elements, replace, increment, touch, only_changed, returning):
+    if dialect_name not in _INSERTS:
+        raise NotImplementedError(f'No upsert support for the {dialect_name} dialect')
+
+    statement = _INSERTS[dialect_name](table)
+    if not replace and not increment:
+        statement = statement.on_conflict_do_nothing(index_elements=list(index_elements))
+    else:
+        set_ = {column: statement.excluded[column] for column in replace}
+        set_.update({column: table.c[column] + statement.excluded[column] for column in increment})
+        if touch:
+            set_['updated_at'] = sa.func.current_timestamp()
+        where = None
+        if only_changed:
+            # Null-safe: IS DISTINCT FROM on PostgreSQL, IS NOT on SQLite
+            where = sa.or_(*[table.c[column].is_distinct_from(statement.excluded[column]) for column in replace])
+        statement = statement.on_conflict_do_update(index_elements=list(index_elements), set_=set_, where=where)
+
+    if returning and dialect_name in _RETURNING:
+        statement = statement.returning(*table.c)
+    return statement
+
+
+def first(result):
+    """The first row of a result as a dict, or None"""
+    row = result.fetchone()
+    return dict(row._mapping) if row is not None else None
+
+
+def all_rows(result):
+    return [dict(row._mapping) for row in result]
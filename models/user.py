@@ -1,200 +1,129 @@
-import os
 from database import get_connection
 import sqlalchemy as sa
+from models.tables import users, user_preferences, upsert, first
+from utils.versions import bump
+from utils.log import get_logger
+
+log = get_logger(__name__)
 
 
 def init_db():
-    conn = get_connection()
+    """Bring the schema up to date (see models/migrations.py)"""
+    from models.migrations import migrate
+    migrate()
 
-    try:
-        trans = conn.begin()
-        # Users table
-        conn.execute(sa.text('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                name TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        '''))
-
-        # User preferences table
-        conn.execute(sa.text('''
-            CREATE TABLE IF NOT EXISTS user_preferences (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                position TEXT,
-                favorite_team TEXT,
-                picture TEXT,
-                slogan TEXT,
-                completed BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
-                UNIQUE(user_id)
-            )
-        '''))
-
-        # New ratings table
-        conn.execute(sa.text('''
-            CREATE TABLE IF NOT EXISTS user_ratings (
-                id SERIAL PRIMARY KEY,
-                rated_user_id INTEGER NOT NULL,
-                rater_user_id INTEGER NOT NULL,
-                skill_1 INTEGER NOT NULL,
-                skill_2 INTEGER NOT NULL,
-                skill_3 INTEGER NOT NULL,
-                skill_4 INTEGER NOT NULL,
-                skill_5 INTEGER NOT NULL,
-                skill_6 INTEGER NOT NULL,
-                overall_score INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (rated_user_id) REFERENCES users (id) ON DELETE CASCADE,
-                FOREIGN KEY (rater_user_id) REFERENCES users (id) ON DELETE CASCADE,
-                UNIQUE(rated_user_id, rater_user_id)
-            )
-        '''))
-
-        conn.execute(sa.text('''
-            CREATE TABLE IF NOT EXISTS matchdayInfo (
-                id SERIAL PRIMARY KEY,
-                number INTEGER NOT NULL,
-                topPlayer TEXT NOT NULL,
-                lastPlayer TEXT NOT NULL,
-                secondToLast TEXT NOT NULL,
-                noSubs TEXT NOT NULL,
-                accumulated TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        '''))
-
-        trans.commit()
-        print("DEBUG: Database tables created successfully")
 
-    except Exception as e:
+def get_db_connection():
+    return get_connection()
 
-        print(f"ERROR creating tables: {str(e)}")
 
-        if 'trans' in locals():
-            trans.rollback()
+# Statements are built once; SQLAlchemy caches their compiled form per engine
+_USERS_WITH_POSITION = users.outerjoin(user_preferences, user_preferences.c.user_id == users.c.id)
+_USER_BY_EMAIL = sa.select(users.c.id, users.c.email, users.c.name, users.c.password, user_preferences.c.position) \
+    .select_from(_USERS_WITH_POSITION).where(users.c.email == sa.bindparam('email'))
+_TOKEN_CLAIMS_BY_ID = sa.select(users.c.id, users.c.email, users.c.name, user_preferences.c.position) \
+    .select_from(_USERS_WITH_POSITION).where(users.c.id == sa.bindparam('user_id'))
+_PRINCIPAL_BY_EMAIL = sa.select(users.c.id, users.c.email, users.c.name).where(
+    users.c.email == sa.bindparam('email'))
+_PREFERENCES_BY_USER = sa.select(user_preferences).where(user_preferences.c.user_id == sa.bindparam('user_id'))
+PREFERENCE_FIELDS = ['position', 'favorite_team', 'picture', 'slogan']
 
-        raise e
 
+def get_user_by_email(email):
+    conn = get_db_connection()
+    try:
+        return first(conn.execute(_USER_BY_EMAIL, {"email": email}))
     finally:
         conn.close()
 
 
-def get_db_connection():
-    return get_connection()
+def get_user_principal(email):
+    """Identity fields needed by token_required (no password hash)"""
+    conn = get_db_connection()
+    try:
+        return first(conn.execute(_PRINCIPAL_BY_EMAIL, {"email": email}))
+    finally:
+        conn.close()
 
 
-def get_user_by_email(email):
+def get_user_token_claims(user_id):
+    """What an access token carries about a user (for /api/token/refresh)"""
     conn = get_db_connection()
     try:
-        result = conn.execute(
-            sa.text('SELECT id, email, name, password FROM users WHERE email = :email'),
-            {"email": email}
-        )
-        user = result.fetchone()
-
-        if user:
-            return dict(user._mapping)  # Convert to dict
-        return None
+        return first(conn.execute(_TOKEN_CLAIMS_BY_ID, {"user_id": user_id}))
     finally:
         conn.close()
 
 
+def create_user(conn, email, password, name):
+    """Insert a user and return the new id (RETURNING on PostgreSQL, lastrowid on SQLite)"""
+    result = conn.execute(users.insert(), {"email": email, "password": password, "name": name})
+    return result.inserted_primary_key[0]
+
+
 def get_user_preferences(user_id):
     conn = get_db_connection()
     try:
-        result = conn.execute(
-            sa.text('SELECT * FROM user_preferences WHERE user_id = :user_id'),
-            {"user_id": user_id}
-        )
-        preferences = result.fetchone()
-
-        if preferences:
-            return dict(preferences._mapping)  # Convert to dict
-        return None
+        return first(conn.execute(_PREFERENCES_BY_USER, {"user_id": user_id}))
     finally:
         conn.close()
 
 
-def create_user_preferences(user_id, preferences_data):
-    conn = get_db_connection()
+def save_user_preferences(conn, user_id, preferences_data):
+    """Insert or update a user's preferences in one statement.
+
+    Must run inside a transaction on conn. Nothing is written when the
+    stored values are already the same. Returns (row, changed).
+    """
+    result = conn.execute(
+        upsert(conn, user_preferences, ['user_id'], replace=PREFERENCE_FIELDS + ['completed'], touch=True,
+               only_changed=True, returning=True),
+        {
+            "user_id": user_id,
+            **{field: preferences_data.get(field) for field in PREFERENCE_FIELDS},
+            "completed": True,
+        }
+    )
+    if result.returns_rows:
+        # PostgreSQL: RETURNING gives the new row, or nothing when unchanged
+        row = first(result)
+        if row is not None:
+            return row, True
+        changed = False
+    else:
+        changed = result.rowcount > 0
+    return first(conn.execute(_PREFERENCES_BY_USER, {"user_id": user_id})), changed
 
-    print(f"DEBUG: Saving preferences for user_id: {user_id}")
-    print(f"DEBUG: Preferences data: {preferences_data}")
 
-    try:
-        # First, check if preferences already exist
-        existing_result = conn.execute(
-            sa.text('SELECT id FROM user_preferences WHERE user_id = :user_id'),
-            {"user_id": user_id}
-        )
-        existing_prefs = existing_result.fetchone()
-
-        if existing_prefs:
-            # Update existing preferences
-            conn.execute(sa.text('''
-                UPDATE user_preferences 
-                SET position = :position, favorite_team = :favorite_team, 
-                    picture = :picture, slogan = :slogan, 
-                    completed = :completed, updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = :user_id
-            '''), {
-                "position": preferences_data.get('position'),
-                "favorite_team": preferences_data.get('favorite_team'),
-                "picture": preferences_data.get('picture'),
-                "slogan": preferences_data.get('slogan'),
-                "completed": True,
-                "user_id": user_id
-            })
-            print(f"DEBUG: Updated preferences for user_id: {user_id}")
-        else:
-            # Insert new preferences
-            conn.execute(sa.text('''
-                INSERT INTO user_preferences 
-                (user_id, position, favorite_team, picture, slogan, completed)
-                VALUES (:user_id, :position, :favorite_team, :picture, :slogan, :completed)
-            '''), {
-                "user_id": user_id,
-                "position": preferences_data.get('position'),
-                "favorite_team": preferences_data.get('favorite_team'),
-                "picture": preferences_data.get('picture'),
-                "slogan": preferences_data.get('slogan'),
-                "completed": True
-            })
-            print(f"DEBUG: Inserted new preferences for user_id: {user_id}")
-
-
-        print(f"DEBUG: Successfully committed preferences for user_id: {user_id}")
-
-        # Verify the save worked
-        saved_prefs = get_user_preferences(user_id)
-        print(f"DEBUG: Verified saved preferences: {saved_prefs}")
+def create_user_preferences(user_id, preferences_data):
+    """Save preferences and return the stored row"""
+    log.debug('Saving preferences', extra={'user_id': user_id, 'preferences': preferences_data})
 
+    conn = get_db_connection()
+    try:
+        with conn.begin():
+            preferences, changed = save_user_preferences(conn, user_id, preferences_data)
     except Exception as e:
-        print(f"ERROR: Failed to save preferences for user_id {user_id}: {str(e)}")
-        conn.rollback()
-        raise e
+        log.error('Failed to save preferences', extra={'user_id': user_id, 'error': str(e)})
+        raise
     finally:
         conn.close()
 
+    log.debug('Saved preferences', extra={'user_id': user_id, 'changed': changed})
+    if changed:
+        # Position drives the rating skill names; picture/team show in listings
+        bump('users', 'leaderboard', f'ratings:{user_id}', f'profile:{user_id}')
+    return preferences
+
 
 def are_preferences_complete(user_id):
     preferences = get_user_preferences(user_id)
-    print(f"DEBUG: Checking preferences completeness for user_id {user_id}: {preferences}")
 
     if not preferences:
-        print(f"DEBUG: No preferences found for user_id {user_id}")
         return False
 
     # Check if required fields are filled
     required_fields = ['position', 'favorite_team', 'picture']
     completed = all(preferences.get(field) for field in required_fields)
-    print(f"DEBUG: Preferences complete: {completed}")
+    log.debug('Checked preferences completeness', extra={'user_id': user_id, 'complete': completed})
     return completed
\ No newline at end of file
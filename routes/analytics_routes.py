@@ -0,0 +1,99 @@
+import json
+from flask import request, jsonify
+import sqlalchemy as sa
+from utils.auth import token_required
+from utils.versions import conditional
+from models.user import get_db_connection
+from models.tables import users, player_analytics, first, all_rows
+from models.rating_stats import POSITION_SKILLS
+from models.analytics import VERSION_KEY, Z_COLUMNS
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+SORT_COLUMNS = ('adjusted_score', 'raw_score', 'rating_count')
+
+_SUMMARY_COLUMNS = [
+    player_analytics.c.user_id, users.c.name, player_analytics.c.position, player_analytics.c.rating_count,
+    player_analytics.c.raw_score, player_analytics.c.adjusted_score,
+]
+_PLAYERS = sa.select(*_SUMMARY_COLUMNS).join(users, users.c.id == player_analytics.c.user_id)
+_PLAYER = (
+    sa.select(*_SUMMARY_COLUMNS, *[player_analytics.c[column] for column in Z_COLUMNS],
+              player_analytics.c.similar, player_analytics.c.computed_at)
+    .join(users, users.c.id == player_analytics.c.user_id)
+    .where(player_analytics.c.user_id == sa.bindparam('user_id'))
+)
+_NAMES = sa.select(users.c.id, users.c.name).where(users.c.id.in_(sa.bindparam('user_ids', expanding=True)))
+_COMPUTED_AT = sa.select(sa.func.max(player_analytics.c.computed_at))
+
+
+def configure_analytics_routes(app):
+    @app.route('/api/analytics/players', methods=['GET'])
+    @token_required
+    @conditional([VERSION_KEY, 'users'])
+    def get_player_analytics(current_user):
+        """Rated players by leniency-adjusted score (see models/analytics.py).
+
+        Query parameters: position, sort (adjusted_score, raw_score or
+        rating_count) and limit (default 50).
+        """
+        position = request.args.get('position') or None
+        sort = request.args.get('sort', 'adjusted_score')
+        if position and position not in POSITION_SKILLS:
+            return jsonify({'error': 'Invalid position'}), 400
+        if sort not in SORT_COLUMNS:
+            return jsonify({'error': f"sort must be one of {', '.join(SORT_COLUMNS)}"}), 400
+        try:
+            limit = max(1, min(int(request.args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT))
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+
+        statement = _PLAYERS.order_by(player_analytics.c[sort].desc(), player_analytics.c.user_id).limit(limit)
+        if position:
+            statement = statement.where(player_analytics.c.position == position)
+
+        conn = get_db_connection()
+        try:
+            players = all_rows(conn.execute(statement))
+            computed_at = conn.execute(_COMPUTED_AT).scalar()
+        finally:
+            conn.close()
+
+        return jsonify({'position': position, 'sort': sort, 'computed_at': computed_at, 'players': players}), 200
+
+    @app.route('/api/analytics/players/<int:user_id>', methods=['GET'])
+    @token_required
+    @conditional(lambda current_user, user_id: [VERSION_KEY, 'users'])
+    def get_player_analytics_detail(current_user, user_id):
+        """One player's scores, skill z-scores within their position and most similar players"""
+        conn = get_db_connection()
+        try:
+            row = first(conn.execute(_PLAYER, {"user_id": user_id}))
+            if row is None:
+                return jsonify({'error': 'No analytics for this player yet'}), 404
+
+            similar = json.loads(row['similar']) if row['similar'] else []
+            names = {}
+            if similar:
+                names = dict(conn.execute(_NAMES, {"user_ids": [similar_id for similar_id, _ in similar]}).fetchall())
+        finally:
+            conn.close()
+
+        skill_names = POSITION_SKILLS.get(row['position'], [])
+        return jsonify({
+            'user_id': row['user_id'],
+            'name': row['name'],
+            'position': row['position'],
+            'rating_count': row['rating_count'],
+            'raw_score': row['raw_score'],
+            'adjusted_score': row['adjusted_score'],
+            'skills': [
+                {'skill': skill, 'z_score': row[column]} for skill, column in zip(skill_names, Z_COLUMNS)
+            ],
+            # Deleted since the last refresh: left out
+            'similar': [
+                {'user_id': similar_id, 'name': names[similar_id], 'similarity': similarity}
+                for similar_id, similarity in similar if similar_id in names
+            ],
+            'computed_at': row['computed_at'],
+        }), 200
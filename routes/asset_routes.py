@@ -0,0 +1,85 @@
+import mimetypes
+import os
+import threading
+from flask import request, send_file, abort
+from werkzeug.utils import safe_join
+from config import Config
+from utils.assets import load_manifest, encoding_suffix, INDEX
+
+# Fingerprinted names change whenever the content does
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def get_manifest():
+    """Build manifest keyed by fingerprinted path, loaded once per process ({} without a build)"""
+    global _manifest
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                manifest = load_manifest() or {}
+                _manifest = {asset['path']: asset for asset in manifest.values()}
+    return _manifest
+
+
+def pick_encoding(available):
+    """Best precompressed variant the client accepts, or None for identity"""
+    for encoding in ('br', 'gzip'):
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def send_built_file(path, max_age, immutable):
+    full_path = safe_join(Config.ASSET_BUILD_PATH, path)
+    if full_path is None:
+        abort(404)
+
+    asset = get_manifest().get(path)
+    if asset is not None:
+        available = asset['encodings']
+    else:
+        # Left over from an earlier build (clients with a cached index.html)
+        if not os.path.isfile(full_path):
+            abort(404)
+        available = [e for e in ('br', 'gzip') if os.path.isfile(f'{full_path}.{encoding_suffix(e)}')]
+
+    encoding = pick_encoding(available)
+    if encoding:
+        full_path = f'{full_path}.{encoding_suffix(encoding)}'
+
+    # A path (not a file object) lets the server use sendfile via wsgi.file_wrapper
+    response = send_file(
+        full_path,
+        mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        max_age=max_age,
+        conditional=True,
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def configure_asset_routes(app):
+    @app.route('/')
+    def serve_frontend():
+        if INDEX in get_manifest():
+            return send_built_file(INDEX, max_age=0, immutable=False)
+        return app.send_static_file('index.html')
+
+    @app.route('/assets/<path:path>')
+    def serve_asset(path):
+        return send_built_file(path, max_age=ASSET_MAX_AGE, immutable=True)
+
+    @app.route('/<path:path>')
+    def serve_static(path):
+        # Unfingerprinted URLs (no build, or links from before one)
+        return app.send_static_file(path)
@@ -1,7 +1,16 @@
 from flask import request, jsonify
-from models.user import get_user_by_email, init_db, get_db_connection
-from utils.auth import hash_password, generate_token
-import sqlalchemy as sa
+from config import Config
+from models.user import get_user_by_email, get_user_token_claims, create_user, get_db_connection
+from models.tables import users
+from utils.auth import (hash_password, verify_password, generate_token, generate_refresh_token, decode_token,
+                        revoke_refresh_token, HashingBusy)
+from utils.versions import bump
+from utils.ratelimit import limit_request, client_ip
+
+def hashing_busy_response():
+    response = jsonify({'error': 'Server busy, please try again'})
+    response.headers['Retry-After'] = '2'
+    return response, 503
 
 def configure_auth_routes(app):
     @app.route('/api/register', methods=['POST'])
@@ -15,19 +24,24 @@ def configure_auth_routes(app):
             if not email or not password or not name:
                 return jsonify({'error': 'All fields are required'}), 400
 
+            limited = limit_request('register', ip=client_ip())
+            if limited:
+                return limited
+
             if get_user_by_email(email):
                 return jsonify({'error': 'User already exists'}), 400
 
-            hashed_password = hash_password(password)
+            try:
+                hashed_password = hash_password(password)
+            except HashingBusy:
+                return hashing_busy_response()
 
             conn = get_db_connection()
-            result = conn.execute(
-                sa.text('INSERT INTO users (email, password, name) VALUES (:email, :password, :name) RETURNING id'),
-                {"email": email, "password": hashed_password, "name": name}
-            )
-            user_id = result.fetchone()[0]
-
-            conn.close()
+            try:
+                create_user(conn, email, hashed_password, name)
+            finally:
+                conn.close()
+            bump('users')
 
             return jsonify({'message': 'User created successfully'}), 201
 
@@ -44,16 +58,42 @@ def configure_auth_routes(app):
             if not email or not password:
                 return jsonify({'error': 'Email and password are required'}), 400
 
+            # Before the users lookup and the hash, which is what a password
+            # guessing script is spending
+            # The account bucket is per (email, ip): one per email would let
+            # anyone lock a player out with a few bad passwords
+            ip = client_ip()
+            limited = limit_request('login', ip=ip, account=f'{email.strip().lower()}|{ip}')
+            if limited:
+                return limited
+
             user = get_user_by_email(email)
-            if not user or user['password'] != hash_password(password):
+            if not user:
                 return jsonify({'error': 'Invalid credentials'}), 401
 
-            # Generate JWT token
-            token = generate_token(user)
+            try:
+                valid, needs_rehash = verify_password(password, user['password'])
+                if valid and needs_rehash:
+                    # Upgrade legacy SHA-256 (or outdated scrypt) hashes in place
+                    conn = get_db_connection()
+                    try:
+                        conn.execute(
+                            users.update().where(users.c.id == user['id']),
+                            {"password": hash_password(password)}
+                        )
+                    finally:
+                        conn.close()
+            except HashingBusy:
+                return hashing_busy_response()
+
+            if not valid:
+                return jsonify({'error': 'Invalid credentials'}), 401
 
             return jsonify({
                 'message': 'Login successful',
-                'token': token,
+                'token': generate_token(user),
+                'expires_in': Config.ACCESS_TOKEN_TTL,
+                'refresh_token': generate_refresh_token(user),
                 'user': {
                     'email': user['email'],
                     'name': user['name']
@@ -61,4 +101,33 @@ def configure_auth_routes(app):
             }), 200
 
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
\ No newline at end of file
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/token/refresh', methods=['POST'])
+    def refresh_token():
+        """Trade a refresh token for a new access token with the user's current details"""
+        data = request.get_json(silent=True) or {}
+        claims = decode_token(data.get('refresh_token') or '', 'refresh')
+        if claims is None:
+            return jsonify({'error': 'Refresh token is invalid'}), 401
+
+        user = get_user_token_claims(claims['uid'])
+        if user is None:
+            return jsonify({'error': 'Refresh token is invalid'}), 401
+
+        return jsonify({'token': generate_token(user), 'expires_in': Config.ACCESS_TOKEN_TTL}), 200
+
+    @app.route('/api/logout', methods=['POST'])
+    def logout():
+        """Revoke the refresh token; the access token runs out on its own"""
+        data = request.get_json(silent=True) or {}
+        claims = decode_token(data.get('refresh_token') or '', 'refresh')
+        if claims is not None:
+            conn = get_db_connection()
+            try:
+                with conn.begin():
+                    revoke_refresh_token(conn, claims)
+            finally:
+                conn.close()
+
+        return jsonify({'message': 'Logged out'}), 200
\ No newline at end of file
@@ -0,0 +1,57 @@
+from flask import request, jsonify
+from utils.auth import token_required
+from models.rating_stats import POSITION_SKILLS
+from models.leaderboard import leaderboard, NAMED_SKILLS, VERSION_KEY, RATINGS_VERSION_KEY
+from utils.versions import conditional
+
+DEFAULT_TOP = 10
+MAX_TOP = 100
+
+def entry_to_dict(entry):
+    return {
+        'rank': entry['rank'],
+        'user_id': entry['user_id'],
+        'name': entry['name'],
+        'position': entry['position'],
+        'score': round(entry['score']),
+        'rating_count': entry['rating_count'],
+    }
+
+def configure_leaderboard_routes(app):
+    @app.route('/api/leaderboard', methods=['GET'])
+    @token_required
+    # "user" is the caller's own rank by default, so the tag depends on who asks
+    @conditional([VERSION_KEY, RATINGS_VERSION_KEY],
+                 vary=lambda current_user: request.args.get('user_id', current_user['id']))
+    def get_leaderboard(current_user):
+        """Top players overall, by position and/or by named skill.
+
+        Query parameters: position, skill (e.g. Pace), top (default 10) and
+        user_id, whose rank is returned as "user" (defaults to the caller).
+        """
+        position = request.args.get('position') or None
+        skill = request.args.get('skill') or None
+        if position and position not in POSITION_SKILLS:
+            return jsonify({'error': 'Invalid position'}), 400
+        if skill and skill not in NAMED_SKILLS:
+            return jsonify({'error': 'Unknown skill'}), 400
+        if position and skill and position not in NAMED_SKILLS[skill]:
+            return jsonify({'error': f'{position}s are not rated on {skill}'}), 400
+
+        try:
+            top = int(request.args.get('top', DEFAULT_TOP))
+            user_id = int(request.args.get('user_id', current_user['id']))
+        except ValueError:
+            return jsonify({'error': 'top and user_id must be integers'}), 400
+        top = max(1, min(top, MAX_TOP))
+
+        total, entries, user_entry = leaderboard.query(position, skill, top, user_id)
+
+        return jsonify({
+            'position': position,
+            'skill': skill,
+            'positions': sorted(NAMED_SKILLS[skill]) if skill else None,
+            'total': total,
+            'leaders': [entry_to_dict(entry) for entry in entries],
+            'user': entry_to_dict(user_entry) if user_entry else None,
+        }), 200
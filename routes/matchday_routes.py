@@ -0,0 +1,114 @@
+from flask import request, jsonify
+from models.user import get_db_connection
+from models.matchdays import (
+    MatchdayError, record_matchday, matchday_to_dict, get_matchday,
+    get_matchday_history, get_season_standings,
+)
+from utils.versions import bump, conditional
+from utils.events import publish
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+DEFAULT_HISTORY_SIZE = 50
+MAX_HISTORY_SIZE = 200
+
+# Shown before the first matchday is recorded
+EMPTY_MATCHDAY = {
+    'number': 1,
+    'topPlayer': "No data yet",
+    'lastPlayer': "No data yet",
+    'secondToLast': "No data yet",
+    'noSubs': "No data yet",
+    'accumulated': "$0",
+    'accumulatedCents': 0,
+}
+
+def configure_matchday_routes(app):
+    @app.route('/api/matchday', methods=['GET'])
+    @conditional(['matchday'], private=False)
+    def get_matchdayinfo():
+        """Get the latest matchday"""
+        conn = get_db_connection()
+        try:
+            matchday = get_matchday(conn)
+        except Exception as e:
+            log.error('Failed to fetch matchday info', extra={'error': str(e)})
+            return jsonify({'error': 'Failed to fetch matchday information'}), 500
+        finally:
+            conn.close()
+
+        return jsonify({'matchday': matchday or EMPTY_MATCHDAY}), 200
+
+    @app.route('/api/matchday/<int:number>', methods=['GET'])
+    @conditional(['matchday'], private=False)
+    def get_matchday_by_number(number):
+        conn = get_db_connection()
+        try:
+            matchday = get_matchday(conn, number)
+        finally:
+            conn.close()
+
+        if not matchday:
+            return jsonify({'error': 'Matchday not found'}), 404
+        return jsonify({'matchday': matchday}), 200
+
+    @app.route('/api/matchday/history', methods=['GET'])
+    @conditional(['matchday'], private=False)
+    def get_matchday_history_route():
+        """Matchdays newest first (?limit=, ?before=<number>) plus season standings"""
+        try:
+            limit = int(request.args.get('limit', DEFAULT_HISTORY_SIZE))
+            before = request.args.get('before')
+            before = int(before) if before else None
+        except ValueError:
+            return jsonify({'error': 'limit and before must be integers'}), 400
+        limit = max(1, min(limit, MAX_HISTORY_SIZE))
+
+        conn = get_db_connection()
+        try:
+            matchdays = get_matchday_history(conn, limit + 1, before)
+            standings = get_season_standings(conn)
+        finally:
+            conn.close()
+
+        next_before = None
+        if len(matchdays) > limit:
+            matchdays = matchdays[:limit]
+            next_before = matchdays[-1]['number']
+
+        return jsonify({
+            'matchdays': matchdays,
+            'standings': standings,
+            'next_before': next_before,
+        }), 200
+
+    @app.route('/api/matchday', methods=['PUT'])
+    def update_matchdayinfo():
+        """Record a matchday result (admin only). Re-sending a number corrects it."""
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+
+        # Validate required fields
+        required_fields = ['number', 'topPlayer', 'lastPlayer', 'secondToLast', 'noSubs', 'accumulated']
+        for field in required_fields:
+            if field not in data:
+                return jsonify({'error': f'Missing required field: {field}'}), 400
+
+        conn = get_db_connection()
+        try:
+            with conn.begin():
+                row = record_matchday(conn, data)
+            matchday = matchday_to_dict(row)
+            bump('matchday')
+            publish('matchday', {'matchday': matchday}, conn)
+        except MatchdayError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            log.error('Failed to update matchday info', extra={'error': str(e)})
+            return jsonify({'error': 'Failed to update matchday information'}), 500
+        finally:
+            conn.close()
+
+        return jsonify({'message': 'Matchday information updated successfully', 'matchday': matchday}), 200
@@ -0,0 +1,57 @@
+import time
+from flask import request, g, Response
+from config import Config
+from utils.metrics import inc, observe, render_metrics, QUERY_COUNT_BUCKETS
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# (route, statement) pairs already logged as repeated, so each is logged once per worker
+_reported_repeats = set()
+
+def configure_metrics_routes(app):
+    @app.before_request
+    def start_request_metrics():
+        g.request_started = time.perf_counter()
+        g.db_queries = 0
+        g.db_time = 0.0
+        g.db_statements = {}
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_started' not in g:
+            return response
+
+        # The rule, not the path, so /api/ratings/<int:user_id> is one series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {'method': request.method, 'route': route}
+        elapsed = time.perf_counter() - g.request_started
+
+        inc('fantasyfc_http_requests_total', dict(labels, status=str(response.status_code)))
+        observe('fantasyfc_http_request_duration_seconds', labels, elapsed)
+        if response.content_length is not None:
+            inc('fantasyfc_http_response_bytes_total', labels, response.content_length)
+
+        inc('fantasyfc_db_queries_total', {'route': route}, g.db_queries)
+        inc('fantasyfc_db_query_seconds_total', {'route': route}, g.db_time)
+        observe('fantasyfc_db_queries_per_request', labels, g.db_queries, QUERY_COUNT_BUCKETS)
+
+        repeated = {
+            statement: count for statement, count in g.db_statements.items()
+            if count >= Config.DB_REPEATED_QUERY_THRESHOLD
+        }
+        if repeated:
+            inc('fantasyfc_db_repeated_queries_total', labels)
+            for statement, count in repeated.items():
+                if (route, statement) not in _reported_repeats:
+                    _reported_repeats.add((route, statement))
+                    log.warning('Repeated query in one request (possible N+1)', extra={
+                        'route': route, 'count': count, 'statement': ' '.join(statement.split())
+                    })
+
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus scrape endpoint, covering every gunicorn worker"""
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
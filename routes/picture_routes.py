@@ -0,0 +1,39 @@
+from flask import request, jsonify, send_file
+from utils.pictures import get_picture_store, PICTURE_HASH_RE, ORIGINAL, THUMBNAIL, VARIANTS
+
+# Pictures are addressed by content hash, so a URL never changes meaning
+PICTURE_MAX_AGE = 365 * 24 * 3600
+
+def configure_picture_routes(app):
+    @app.route('/api/pictures/<digest>', methods=['GET'])
+    def get_picture(digest):
+        """Serve a stored profile picture (?size=thumb for the thumbnail)"""
+        variant = request.args.get('size', ORIGINAL)
+        if not PICTURE_HASH_RE.match(digest) or variant not in VARIANTS:
+            return jsonify({'error': 'Picture not found'}), 404
+
+        store = get_picture_store()
+        processed = store.exists(digest, THUMBNAIL)
+        # Until its job has run, a staged picture only has the original (and
+        # may still be rejected), so nothing about it is cached for long
+        picture = store.open(digest, variant if processed else ORIGINAL)
+        if picture is None:
+            return jsonify({'error': 'Picture not found'}), 404
+
+        f, content_type = picture
+        response = send_file(
+            f,
+            mimetype=content_type,
+            etag=f'{digest}-{variant}' if processed else f'{digest}-staged',
+            max_age=PICTURE_MAX_AGE if processed else 0,
+            conditional=True,
+        )
+        # The type is checked against the bytes on upload; don't let a
+        # browser second-guess it
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        if processed:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
@@ -1,47 +1,59 @@
 from flask import request, jsonify
-from utils.auth import token_required
+from config import Config
+from utils.auth import token_required, invalidate_principal, generate_token
 from models.user import get_user_preferences, create_user_preferences, are_preferences_complete, get_db_connection
+from utils.pictures import store_picture_data_url, process_picture_later, with_picture_url, PictureError
 import sqlalchemy as sa
+from utils.log import get_logger
+
+log = get_logger(__name__)
 
 def configure_preference_routes(app):
     @app.route('/api/preferences', methods=['GET'])
     @token_required
     def get_preferences(current_user):
         preferences = get_user_preferences(current_user['id'])
-        return jsonify({'preferences': preferences}), 200
+        return jsonify({'preferences': with_picture_url(preferences)}), 200
 
     @app.route('/api/preferences', methods=['POST'])
     @token_required
     def save_preferences(current_user):
         try:
             data = request.get_json()
-            print(f"DEBUG: Received preferences data from user {current_user['email']}")
+            log.debug('Received preferences', extra={'user_id': current_user['id']})
 
             # Validate required fields
             if not data.get('position') or not data.get('favorite_team'):
                 return jsonify({'error': 'Position and Favorite Team are required'}), 400
 
-            # Handle picture data (could be Data URL or empty)
+            # Handle picture data (could be Data URL, an already stored picture or empty)
             picture_data = data.get('picture', '')
 
-            # If it's a Data URL and too long, you might want to store it as a file
-            # For simplicity, we'll store it as is for now
             if picture_data and len(picture_data) > 1000000:  # ~1MB limit
                 return jsonify({'error': 'Image file too large'}), 400
 
-            create_user_preferences(current_user['id'], data)
+            # Stage the picture (header check and original only); the row only
+            # keeps the hash, and the thumbnail is made by a background job
+            try:
+                data['picture'] = store_picture_data_url(picture_data, defer=True)
+            except PictureError as e:
+                return jsonify({'error': str(e)}), 400
 
-            # Get the updated preferences to verify
-            updated_preferences = get_user_preferences(current_user['id'])
-            print(f"DEBUG: Preferences after save: {updated_preferences}")
+            # One upsert; the stored row comes back with it
+            updated_preferences = create_user_preferences(current_user['id'], data)
+            invalidate_principal(current_user['id'])
+            process_picture_later(updated_preferences['picture'])
 
             return jsonify({
                 'message': 'Preferences saved successfully',
-                'preferences': updated_preferences
+                'preferences': with_picture_url(updated_preferences),
+                # The access token carries the position; this one has the new one
+                'token': generate_token({**current_user, 'position': updated_preferences['position']}),
+                'expires_in': Config.ACCESS_TOKEN_TTL
             }), 200
 
         except Exception as e:
-            print(f"ERROR: Failed to save preferences for user {current_user['email']}: {str(e)}")
+            log.error('Failed to save preferences', extra={'user_id': current_user['id'], 'error': str(e)})
             return jsonify({'error': str(e)}), 500
 
     @app.route('/api/preferences/check', methods=['GET'])
@@ -49,7 +61,6 @@ def configure_preference_routes(app):
     def check_preferences(current_user):
         """Check if user has completed preferences"""
         complete = are_preferences_complete(current_user['id'])
-        print(f"DEBUG: Preferences check for user {current_user['email']}: {complete}")
         return jsonify({'preferences_complete': complete}), 200
 
     @app.route('/api/debug/preferences/<int:user_id>', methods=['GET'])
@@ -66,6 +77,6 @@ def configure_preference_routes(app):
         user_prefs = get_user_preferences(user_id)
 
         return jsonify({
-            'user_preferences': user_prefs,
-            'all_preferences': [dict(pref._mapping) for pref in all_prefs]
+            'user_preferences': with_picture_url(user_prefs),
+            'all_preferences': [with_picture_url(dict(pref._mapping)) for pref in all_prefs]
         }), 200
\ No newline at end of file
@@ -1,63 +1,71 @@
 from flask import request, jsonify
 from utils.auth import token_required
 from models.user import get_db_connection
+from models.tables import user_preferences
+from models.rating_stats import POSITION_SKILLS, apply_rating, apply_ratings
+from models.rating_breakdowns import get_rating_breakdown
+from models.analytics import schedule_refresh as schedule_analytics_refresh
+from utils.versions import bump, conditional
+from utils.events import publish_events
+from utils.ratelimit import limit_request, client_ip
 import sqlalchemy as sa
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+POSITION_FOR_USER = sa.select(user_preferences.c.position).where(
+    user_preferences.c.user_id == sa.bindparam('user_id'))
+POSITIONS_FOR_USERS = sa.select(user_preferences.c.user_id, user_preferences.c.position).where(
+    user_preferences.c.user_id.in_(sa.bindparam('user_ids', expanding=True)))
+
+
+def get_position(conn, user_id):
+    """A user's position, or None when they have no preferences yet"""
+    return conn.execute(POSITION_FOR_USER, {"user_id": user_id}).scalar()
+
 
 def configure_rating_routes(app):
-    # Skill definitions by position
-    POSITION_SKILLS = {
-        'Goalkeeper': ['Diving', 'Handling', 'Kicking', 'Reflexes', 'Positioning', 'Speed'],
-        'Defender': ['Defending', 'Physicality', 'Pace', 'Interceptions', 'Heading Accuracy', 'Marking'],
-        'Midfielder': ['Passing', 'Dribbling', 'Physicality', 'Defending', 'Pace', 'Shooting'],
-        'Forward': ['Shooting', 'Pace', 'Dribbling', 'Finishing', 'Positioning', 'Physicality']
-    }
+    MAX_BATCH_RATINGS = 50
+
+    def publish_rating_totals(conn, totals):
+        """Push new averages to /api/stream listeners, on the connection that wrote them"""
+        publish_events([('rating', {
+            'user_id': rated_user_id,
+            'average_score': round(overall_sum / rating_count) if rating_count else 0,
+            'rating_count': rating_count
+        }) for rated_user_id, (rating_count, overall_sum) in totals.items()], conn)
+
+    def validate_rating(position, data):
+        """Check a submitted rating against the position's skills.
+
+        Returns (skills_data, overall_score, None) or (None, None, error).
+        """
+        skills = POSITION_SKILLS.get(position)
+        if not skills:
+            return None, None, 'Invalid position'
+
+        # Validate all skills are provided and within range
+        skills_data = {}
+        for i, skill in enumerate(skills, 1):
+            skill_value = data.get(f'skill_{i}')
+            if skill_value is None:
+                return None, None, f'Missing skill: {skill}'
+            if not isinstance(skill_value, int) or skill_value < 0 or skill_value > 100:
+                return None, None, f'Skill {skill} must be between 0 and 100'
+            skills_data[f'skill_{i}'] = skill_value
+
+        # Calculate overall score (average of all skills)
+        skill_values = list(skills_data.values())
+        overall_score = round(sum(skill_values) / len(skill_values))
+        return skills_data, overall_score, None
 
     @app.route('/api/ratings/<int:user_id>', methods=['GET'])
     @token_required
+    @conditional(lambda current_user, user_id: ['ratings', f'ratings:{user_id}'])
     def get_user_ratings(current_user, user_id):
         """Get all ratings for a specific user"""
-        conn = get_db_connection()
-
-        # Get user's position to determine which skills to show
-        result = conn.execute(
-            sa.text('SELECT position FROM user_preferences WHERE user_id = :user_id'),
-            {"user_id": user_id}
-        )
-        user_prefs = result.fetchone()
-
-        position = user_prefs['position'] if user_prefs else None
-        skills = POSITION_SKILLS.get(position, [])
-
-        # Get all ratings for this user
-        result = conn.execute(sa.text('''
-            SELECT ur.*, u.name as rater_name 
-            FROM user_ratings ur 
-            JOIN users u ON ur.rater_user_id = u.id 
-            WHERE ur.rated_user_id = :user_id
-        '''), {"user_id": user_id})
-        ratings = result.fetchall()
-
-        conn.close()
-
-        # Calculate average overall score
-        total_score = 0
-        rating_count = len(ratings)
-
-        ratings_list = []
-        for rating in ratings:
-            rating_dict = dict(rating._mapping)
-            ratings_list.append(rating_dict)
-            total_score += rating_dict['overall_score']
-
-        average_score = round(total_score / rating_count) if rating_count > 0 else 0
-
-        return jsonify({
-            'ratings': ratings_list,
-            'average_score': average_score,
-            'rating_count': rating_count,
-            'skills': skills,
-            'position': position
-        }), 200
+        # Cached per rated user; the ETag versions above also tag the entry
+        return jsonify(get_rating_breakdown(user_id)), 200
 
     @app.route('/api/ratings/<int:user_id>', methods=['POST'])
     @token_required
@@ -70,66 +78,29 @@ def configure_rating_routes(app):
             if current_user['id'] == user_id:
                 return jsonify({'error': 'You cannot rate yourself'}), 400
 
+            limited = limit_request('rating', ip=client_ip(), account=current_user['id'])
+            if limited:
+                return limited
+
             # Get the rated user's position
             conn = get_db_connection()
-            result = conn.execute(
-                sa.text('SELECT position FROM user_preferences WHERE user_id = :user_id'),
-                {"user_id": user_id}
-            )
-            user_prefs = result.fetchone()
-
-            if not user_prefs or not user_prefs['position']:
-                return jsonify({'error': 'User has no position set'}), 400
-
-            position = user_prefs['position']
-            skills = POSITION_SKILLS.get(position)
-
-            if not skills:
-                return jsonify({'error': 'Invalid position'}), 400
-
-            # Validate all skills are provided and within range
-            skills_data = {}
-            for i, skill in enumerate(skills, 1):
-                skill_value = data.get(f'skill_{i}')
-                if skill_value is None:
-                    return jsonify({'error': f'Missing skill: {skill}'}), 400
-                if not isinstance(skill_value, int) or skill_value < 0 or skill_value > 100:
-                    return jsonify({'error': f'Skill {skill} must be between 0 and 100'}), 400
-                skills_data[f'skill_{i}'] = skill_value
-
-            # Calculate overall score (average of all skills)
-            skill_values = list(skills_data.values())
-            overall_score = round(sum(skill_values) / len(skill_values))
-
-            # Insert or update rating (PostgreSQL uses ON CONFLICT for upsert)
-            conn.execute(sa.text('''
-                INSERT INTO user_ratings 
-                (rated_user_id, rater_user_id, skill_1, skill_2, skill_3, skill_4, skill_5, skill_6, overall_score)
-                VALUES (:rated_user_id, :rater_user_id, :skill_1, :skill_2, :skill_3, :skill_4, :skill_5, :skill_6, :overall_score)
-                ON CONFLICT (rated_user_id, rater_user_id) 
-                DO UPDATE SET 
-                    skill_1 = EXCLUDED.skill_1,
-                    skill_2 = EXCLUDED.skill_2,
-                    skill_3 = EXCLUDED.skill_3,
-                    skill_4 = EXCLUDED.skill_4,
-                    skill_5 = EXCLUDED.skill_5,
-                    skill_6 = EXCLUDED.skill_6,
-                    overall_score = EXCLUDED.overall_score,
-                    updated_at = CURRENT_TIMESTAMP
-            '''), {
-                "rated_user_id": user_id,
-                "rater_user_id": current_user['id'],
-                "skill_1": skills_data['skill_1'],
-                "skill_2": skills_data['skill_2'],
-                "skill_3": skills_data['skill_3'],
-                "skill_4": skills_data['skill_4'],
-                "skill_5": skills_data['skill_5'],
-                "skill_6": skills_data['skill_6'],
-                "overall_score": overall_score
-            })
-
-
-            conn.close()
+            try:
+                position = get_position(conn, user_id)
+                if not position:
+                    return jsonify({'error': 'User has no position set'}), 400
+
+                skills_data, overall_score, error = validate_rating(position, data)
+                if error:
+                    return jsonify({'error': error}), 400
+
+                # Upsert the rating and update the rated user's totals atomically
+                with conn.begin():
+                    totals = apply_rating(conn, user_id, current_user['id'], skills_data, overall_score)
+                bump('users', f'ratings:{user_id}')
+                publish_rating_totals(conn, totals)
+            finally:
+                conn.close()
+            schedule_analytics_refresh()
 
             return jsonify({
                 'message': 'Rating submitted successfully',
@@ -137,37 +108,97 @@ def configure_rating_routes(app):
             }), 200
 
         except Exception as e:
-            print(f"ERROR: Failed to save rating: {str(e)}")
+            log.error('Failed to save rating', extra={'error': str(e)})
             return jsonify({'error': str(e)}), 500
 
-    @app.route('/api/ratings/<int:user_id>/my-rating', methods=['GET'])
+    @app.route('/api/ratings/batch', methods=['POST'])
     @token_required
-    def get_my_rating(current_user, user_id):
-        """Get current user's rating for another user"""
-        conn = get_db_connection()
+    def rate_users_batch(current_user):
+        """Rate several users at once: {"ratings": [{"user_id": 2, "skill_1": 80, ...}, ...]}
+
+        Positions are resolved in one query and every valid rating is written
+        in one transaction. Returns a result per submitted item.
+        """
+        try:
+            data = request.get_json() or {}
+            items = data.get('ratings')
+            if not isinstance(items, list) or not items:
+                return jsonify({'error': 'ratings must be a non-empty list'}), 400
+            if len(items) > MAX_BATCH_RATINGS:
+                return jsonify({'error': f'At most {MAX_BATCH_RATINGS} ratings per batch'}), 400
 
-        result = conn.execute(sa.text('''
-            SELECT * FROM user_ratings 
-            WHERE rated_user_id = :rated_user_id AND rater_user_id = :rater_user_id
-        '''), {"rated_user_id": user_id, "rater_user_id": current_user['id']})
-        rating = result.fetchone()
+            # Same buckets as single ratings, one token per item
+            limited = limit_request('rating', cost=len(items), ip=client_ip(), account=current_user['id'])
+            if limited:
+                return limited
 
-        # Get user's position for skill names
-        result = conn.execute(
-            sa.text('SELECT position FROM user_preferences WHERE user_id = :user_id'),
-            {"user_id": user_id}
-        )
-        user_prefs = result.fetchone()
+            user_ids = {item.get('user_id') for item in items if isinstance(item, dict) and isinstance(item.get('user_id'), int)}
 
-        position = user_prefs['position'] if user_prefs else None
-        skills = POSITION_SKILLS.get(position, [])
+            conn = get_db_connection()
+            try:
+                positions = {}
+                if user_ids:
+                    result = conn.execute(POSITIONS_FOR_USERS, {"user_ids": sorted(user_ids)})
+                    positions = {row.user_id: row.position for row in result}
+
+                results = []
+                valid = []
+                seen = set()
+                for item in items:
+                    user_id = item.get('user_id') if isinstance(item, dict) else None
+                    if not isinstance(user_id, int):
+                        results.append({'user_id': user_id, 'status': 'error', 'error': 'user_id is required'})
+                        continue
+                    if user_id == current_user['id']:
+                        results.append({'user_id': user_id, 'status': 'error', 'error': 'You cannot rate yourself'})
+                        continue
+                    if user_id in seen:
+                        results.append({'user_id': user_id, 'status': 'error', 'error': 'Duplicate rating in batch'})
+                        continue
+                    if not positions.get(user_id):
+                        results.append({'user_id': user_id, 'status': 'error', 'error': 'User has no position set'})
+                        continue
+
+                    skills_data, overall_score, error = validate_rating(positions[user_id], item)
+                    if error:
+                        results.append({'user_id': user_id, 'status': 'error', 'error': error})
+                        continue
+
+                    seen.add(user_id)
+                    valid.append({'rated_user_id': user_id, 'overall_score': overall_score, **skills_data})
+                    results.append({'user_id': user_id, 'status': 'ok', 'overall_score': overall_score})
+
+                # One multi-row upsert plus one stats update for the whole batch
+                totals = {}
+                if valid:
+                    with conn.begin():
+                        totals = apply_ratings(conn, current_user['id'], valid)
+                    bump('users', *[f"ratings:{rating['rated_user_id']}" for rating in valid])
+                    publish_rating_totals(conn, totals)
+            finally:
+                conn.close()
+
+            if valid:
+                schedule_analytics_refresh()
+
+            return jsonify({
+                'message': f'{len(valid)} of {len(items)} ratings submitted',
+                'results': results
+            }), 200
 
-        conn.close()
+        except Exception as e:
+            log.error('Failed to save rating batch', extra={'error': str(e)})
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/ratings/<int:user_id>/my-rating', methods=['GET'])
+    @token_required
+    def get_my_rating(current_user, user_id):
+        """Get current user's rating for another user"""
+        breakdown = get_rating_breakdown(user_id)
+        rating = next((r for r in breakdown['ratings'] if r['rater_user_id'] == current_user['id']), None)
 
         if rating:
-            rating_dict = dict(rating._mapping)
-            # Add skill names to the response
-            rating_dict['skill_names'] = skills
-            return jsonify({'rating': rating_dict}), 200
+            # Add skill names to the response (on a copy: the breakdown is cached)
+            return jsonify({'rating': {**rating, 'skill_names': breakdown['skills']}}), 200
         else:
-            return jsonify({'rating': None, 'skill_names': skills}), 200
\ No newline at end of file
+            return jsonify({'rating': None, 'skill_names': breakdown['skills']}), 200
@@ -0,0 +1,49 @@
+from flask import request, jsonify, Response
+from config import Config
+from utils.auth import decode_token
+from utils.events import bus, start_listener, format_sse
+from utils.concurrency import is_cooperative
+
+def configure_stream_routes(app):
+    @app.route('/api/stream', methods=['GET'])
+    def stream_events():
+        """Server-sent events for matchday and rating changes.
+
+        EventSource can't send an Authorization header, so the token comes in
+        the query string. It's checked like any access token (signature and
+        revocations) but never looked up: the events carry ids and totals,
+        not profile data.
+        """
+        token = request.args.get('token')
+        if not token:
+            return jsonify({'error': 'Token is missing'}), 401
+        if decode_token(token, 'access', 'legacy') is None:
+            return jsonify({'error': 'Token is invalid'}), 401
+
+        max_clients = Config.STREAM_MAX_CLIENTS if is_cooperative() else Config.STREAM_MAX_CLIENTS_THREADED
+        if bus.subscriber_count() >= max_clients:
+            # The client keeps polling instead; EventSource retries after Retry-After
+            response = jsonify({'error': 'Too many open streams'})
+            response.headers['Retry-After'] = '60'
+            return response, 503
+
+        start_listener()
+        subscription = bus.subscribe()
+
+        def generate():
+            try:
+                yield 'retry: 5000\n\n'
+                while not subscription.dropped:
+                    event = subscription.get(timeout=Config.STREAM_HEARTBEAT)
+                    if event is None:
+                        # Comment line keeps proxies from closing an idle stream
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield format_sse(*event)
+            finally:
+                bus.unsubscribe(subscription)
+
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
@@ -1,25 +1,26 @@
 from flask import request, jsonify
-from utils.auth import token_required
-from models.user import get_db_connection
+from utils.auth import token_required, invalidate_principal, revoke_user
+from models.user import get_db_connection, get_user_preferences
+from models.tables import users
+from models.rating_stats import remove_ratings_by_rater
+from models.analytics import schedule_refresh as schedule_analytics_refresh
+from utils.pictures import picture_url, with_picture_url, THUMBNAIL
+from utils.versions import bump, conditional
+from utils.serialization import Schema, Field, stream_json_array
 import sqlalchemy as sa
 
 def configure_user_routes(app):
     @app.route('/api/profile', methods=['GET'])
     @token_required
+    @conditional(lambda current_user: [f"profile:{current_user['id']}"])
     def get_profile(current_user):
-        conn = get_db_connection()
-        result = conn.execute(
-            sa.text('SELECT * FROM user_preferences WHERE user_id = :user_id'),
-            {"user_id": current_user['id']}
-        )
-        preferences = result.fetchone()
-        conn.close()
+        preferences = get_user_preferences(current_user['id'])
 
         return jsonify({
             'user': {
                 'email': current_user['email'],
                 'name': current_user['name'],
-                'preferences': dict(preferences._mapping) if preferences else None
+                'preferences': with_picture_url(preferences)
             }
         }), 200
 
@@ -27,9 +28,20 @@ def configure_user_routes(app):
     def delete_user(user_id):
         """Admin endpoint to delete user"""
         conn = get_db_connection()
-        conn.execute(sa.text('DELETE FROM users WHERE id = :user_id'), {"user_id": user_id})
+        with conn.begin():
+            # Their ratings of others disappear with the cascade, so take them
+            # out of the rated users' totals first
+            remove_ratings_by_rater(conn, user_id)
+            conn.execute(users.delete().where(users.c.id == user_id))
+            # Access tokens carry the uid and aren't looked up, so they have
+            # to be revoked explicitly
+            revoke_user(conn, user_id)
 
         conn.close()
+        invalidate_principal(user_id)
+        # The matchday standings join users (and lose the player's row)
+        bump('users', 'leaderboard', 'matchday', 'ratings', f'ratings:{user_id}', f'profile:{user_id}')
+        schedule_analytics_refresh()
 
         return jsonify({'message': 'User deleted successfully'}), 200
 
@@ -41,162 +53,126 @@ def configure_user_routes(app):
         name = data.get('name')
 
         conn = get_db_connection()
-        conn.execute(
-            sa.text('UPDATE users SET email = :email, name = :name WHERE id = :user_id'),
-            {"email": email, "name": name, "user_id": user_id}
-        )
+        conn.execute(users.update().where(users.c.id == user_id), {"email": email, "name": name})
 
         conn.close()
+        invalidate_principal(user_id, email)
+        # A rename shows up as rater_name in everyone's rating breakdowns and
+        # in the matchday standings
+        bump('users', 'leaderboard', 'matchday', 'ratings', f'profile:{user_id}')
 
         return jsonify({'message': 'User updated successfully'}), 200
 
+    # Fields that can be requested through ?fields= on /api/users, with the
+    # placeholders the cards show for unset preferences applied in SQL.
+    # picture (a thumbnail URL) is only sent on request.
+    USER_LIST_SCHEMA = Schema(
+        Field('id', 'u.id'),
+        Field('email', 'u.email'),
+        Field('name', 'u.name'),
+        Field('created_at', 'u.created_at'),
+        Field('position', "COALESCE(NULLIF(up.position, ''), 'Not set')"),
+        Field('favorite_team', "COALESCE(NULLIF(up.favorite_team, ''), 'Not set')"),
+        Field('picture', 'up.picture', transform=lambda value: picture_url(value, THUMBNAIL) or ''),
+        Field('slogan', "COALESCE(NULLIF(up.slogan, ''), 'No slogan yet')"),
+        # Integer division truncates like the int() the API always applied
+        Field('average_rating', 'COALESCE(s.overall_sum / NULLIF(s.rating_count, 0), 0)'),
+        Field('rating_count', 'COALESCE(s.rating_count, 0)'),
+    )
+    # Exact average for ordering and the keyset cursor (never sent)
+    SORT_RATING = 'COALESCE(CAST(s.overall_sum AS FLOAT) / NULLIF(s.rating_count, 0), 0)'
+    DEFAULT_USER_FIELDS = [field for field in USER_LIST_SCHEMA.fields if field != 'picture']
+    DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200
+
     @app.route('/api/users', methods=['GET'])
     @token_required
+    @conditional(['users'])
     def get_all_users(current_user):
-        """Get all users with their preferences and ratings"""
-        conn = get_db_connection()
-
-        # Join users with their preferences and calculate average ratings
-        result = conn.execute(sa.text('''
-            SELECT 
-                u.id, u.email, u.name, u.created_at,
-                up.position, up.favorite_team, up.picture, up.slogan,
-                COALESCE(AVG(ur.overall_score), 0) as average_rating,
-                COUNT(ur.id) as rating_count
-            FROM users u
-            LEFT JOIN user_preferences up ON u.id = up.user_id
-            LEFT JOIN user_ratings ur ON u.id = ur.rated_user_id
-            GROUP BY u.id, up.position, up.favorite_team, up.picture, up.slogan
-        '''))
-        users = result.fetchall()
+        """List users a page at a time.
+
+        Query parameters: after (the previous page's next_after), limit,
+        position, favorite_team, sort (id | average_rating) and fields.
+        """
+        fields = request.args.get('fields')
+        if fields:
+            fields = list(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+            unknown = [field for field in fields if field not in USER_LIST_SCHEMA]
+            if unknown:
+                return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+        else:
+            fields = list(DEFAULT_USER_FIELDS)
+
+        sort = request.args.get('sort', 'id')
+        if sort not in ('id', 'average_rating'):
+            return jsonify({'error': 'sort must be id or average_rating'}), 400
 
-        conn.close()
-
-        users_list = []
-        for user in users:
-            user_data = dict(user._mapping)
-            # Add default values if preferences don't exist
-            if not user_data['position']:
-                user_data['position'] = 'Not set'
-            if not user_data['favorite_team']:
-                user_data['favorite_team'] = 'Not set'
-            if not user_data['slogan']:
-                user_data['slogan'] = 'No slogan yet'
-            if not user_data['picture']:
-                user_data['picture'] = ''
-
-            # Convert average rating to integer
-            user_data['average_rating'] = int(user_data['average_rating'])
-
-            users_list.append(user_data)
-
-        return jsonify({'users': users_list}), 200
-
-    @app.route('/api/matchday', methods=['GET'])
-    def get_matchdayinfo():
-        """Get current matchday information"""
         try:
-            conn = get_db_connection()
-
-            # Get the single matchday record
-            result = conn.execute(sa.text('SELECT * FROM matchdayInfo LIMIT 1'))
-            matchday = result.fetchone()
-
-            conn.close()
-
-            if matchday:
-                return jsonify({
-                    'matchday': {
-                        'number': matchday['number'],
-                        'topPlayer': matchday['topplayer'],  # Note: PostgreSQL converts to lowercase
-                        'lastPlayer': matchday['lastplayer'],
-                        'secondToLast': matchday['secondtolast'],
-                        'noSubs': matchday['nosubs'],
-                        'accumulated': matchday['accumulated']
-                    }
-                }), 200
-            else:
-                # Return default data if no matchday info exists
-                return jsonify({
-                    'matchday': {
-                        'number': 1,
-                        'topPlayer': "No data yet",
-                        'lastPlayer': "No data yet",
-                        'secondToLast': "No data yet",
-                        'noSubs': "No data yet",
-                        'accumulated': "$0"
-                    }
-                }), 200
-
-        except Exception as e:
-            print(f"Error fetching matchday info: {str(e)}")
-            return jsonify({
-                'error': 'Failed to fetch matchday information',
-                'matchday': {
-                    'number': 1,
-                    'topPlayer': "Error loading",
-                    'lastPlayer': "Error loading",
-                    'secondToLast': "Error loading",
-                    'noSubs': "Error loading",
-                    'accumulated': "$0"
-                }
-            }), 500
-
-    @app.route('/api/matchday', methods=['PUT'])
-    def update_matchdayinfo():
-        """Update matchday information (admin only)"""
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        # The requested fields come first (the row encoder reads them by
+        # position), then what the cursor needs
+        inner_columns = USER_LIST_SCHEMA.select_list(fields)
+        inner_columns += ', u.id AS cursor_id'
+        if sort == 'average_rating':
+            inner_columns += f', {SORT_RATING} AS sort_rating'
+
+        params = {"limit": limit + 1}
+        filters = []
+        for field in ('position', 'favorite_team'):
+            value = request.args.get(field)
+            if value:
+                filters.append(f'up.{field} = :{field}')
+                params[field] = value
+        where = f"WHERE {' AND '.join(filters)}" if filters else ''
+
+        # Keyset cursor: "<id>" when sorting by id, "<average>_<id>" otherwise
+        after = request.args.get('after')
+        cursor_clause = ''
         try:
-            data = request.get_json()
-
-            # Validate required fields
-            required_fields = ['number', 'topPlayer', 'lastPlayer', 'secondToLast', 'noSubs', 'accumulated']
-            for field in required_fields:
-                if field not in data:
-                    return jsonify({'error': f'Missing required field: {field}'}), 400
-
-            conn = get_db_connection()
-
-            # Check if record exists
-            result = conn.execute(sa.text('SELECT id FROM matchdayInfo LIMIT 1'))
-            existing = result.fetchone()
-
-            if existing:
-                # Update existing record
-                conn.execute(sa.text('''
-                    UPDATE matchdayInfo 
-                    SET number = :number, topPlayer = :topPlayer, lastPlayer = :lastPlayer, 
-                        secondToLast = :secondToLast, noSubs = :noSubs, accumulated = :accumulated, 
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE id = :id
-                '''), {
-                    "number": data['number'],
-                    "topPlayer": data['topPlayer'],
-                    "lastPlayer": data['lastPlayer'],
-                    "secondToLast": data['secondToLast'],
-                    "noSubs": data['noSubs'],
-                    "accumulated": data['accumulated'],
-                    "id": existing['id']
-                })
-            else:
-                # Insert new record
-                conn.execute(sa.text('''
-                    INSERT INTO matchdayInfo 
-                    (number, topPlayer, lastPlayer, secondToLast, noSubs, accumulated)
-                    VALUES (:number, :topPlayer, :lastPlayer, :secondToLast, :noSubs, :accumulated)
-                '''), {
-                    "number": data['number'],
-                    "topPlayer": data['topPlayer'],
-                    "lastPlayer": data['lastPlayer'],
-                    "secondToLast": data['secondToLast'],
-                    "noSubs": data['noSubs'],
-                    "accumulated": data['accumulated']
-                })
-
+            if after and sort == 'average_rating':
+                after_rating, _, after_id = after.rpartition('_')
+                params['after_rating'] = float(after_rating)
+                params['after_id'] = int(after_id)
+                cursor_clause = ('WHERE page.sort_rating < :after_rating '
+                                 'OR (page.sort_rating = :after_rating AND page.cursor_id > :after_id)')
+            elif after:
+                params['after_id'] = int(after)
+                cursor_clause = 'WHERE page.cursor_id > :after_id'
+        except ValueError:
+            return jsonify({'error': 'Invalid after cursor'}), 400
+
+        order_by = 'page.sort_rating DESC, page.cursor_id' if sort == 'average_rating' else 'page.cursor_id'
 
+        conn = get_db_connection()
+        try:
+            result = conn.execute(sa.text(f'''
+                SELECT * FROM (
+                    SELECT {inner_columns}
+                    FROM users u
+                    LEFT JOIN user_preferences up ON u.id = up.user_id
+                    LEFT JOIN user_rating_stats s ON u.id = s.rated_user_id
+                    {where}
+                ) AS page
+                {cursor_clause}
+                ORDER BY {order_by}
+                LIMIT :limit
+            '''), params)
+            users = result.fetchall()
+        finally:
             conn.close()
 
-            return jsonify({'message': 'Matchday information updated successfully'}), 200
+        next_after = None
+        if len(users) > limit:
+            users = users[:limit]
+            last = users[-1]._mapping
+            if sort == 'average_rating':
+                next_after = f"{float(last['sort_rating'])!r}_{last['cursor_id']}"
+            else:
+                next_after = str(last['cursor_id'])
 
-        except Exception as e:
-            print(f"Error updating matchday info: {str(e)}")
-            return jsonify({'error': 'Failed to update matchday information'}), 500
\ No newline at end of file
+        encode_row = USER_LIST_SCHEMA.row_encoder(fields)
+        return stream_json_array({'next_after': next_after}, 'users', (encode_row(user) for user in users))
@@ -2,8 +2,23 @@ class AuthApp {
     constructor() {
         this.apiBase = 'https://fantasyfc.onrender.com/api';
         this.token = localStorage.getItem('authToken');
+        this.refreshToken = localStorage.getItem('refreshToken');
         this.currentUser = null;
 
+        // Paged user lists: each asks /api/users for the fields it renders
+        this.userLists = {
+            cards: {
+                containerId: 'usersGrid',
+                fields: 'id,name,position,favorite_team,picture,slogan,average_rating,rating_count,created_at',
+                render: (users, append) => this.displayUserCards(users, append),
+            },
+            admin: {
+                containerId: 'usersList',
+                fields: 'id,name,email,created_at',
+                render: (users, append) => this.displayUsers(users, append),
+            },
+        };
+
         this.initializeEventListeners();
         this.checkAuthStatus();
     }
@@ -43,10 +58,10 @@ class AuthApp {
 
         try {
             const response = await this.apiCall('/login', 'POST', { email, password });
-            this.token = response.token;
             this.currentUser = response.user;
-
-            localStorage.setItem('authToken', this.token);
+            this.refreshToken = response.refresh_token;
+            localStorage.setItem('refreshToken', this.refreshToken);
+            this.setAccessToken(response.token, response.expires_in);
             this.showAuthenticatedView();
             this.showMessage('Login successful!', 'success');
         } catch (error) {
@@ -71,15 +86,64 @@ class AuthApp {
     }
 
     handleLogout() {
+        if (this.refreshToken) {
+            // Nothing to wait for: the tokens are forgotten here either way
+            this.apiCall('/logout', 'POST', { refresh_token: this.refreshToken }).catch(() => {});
+        }
         this.clearAuth();
         this.showLoginView();
         this.showMessage('Logged out successfully!', 'success');
     }
 
     clearAuth() {
+        this.closeEventStream();
+        clearTimeout(this.refreshTimer);
         this.token = null;
+        this.refreshToken = null;
+        this.refreshing = null;
         this.currentUser = null;
         localStorage.removeItem('authToken');
+        localStorage.removeItem('refreshToken');
+    }
+
+    setAccessToken(token, expiresIn) {
+        this.token = token;
+        localStorage.setItem('authToken', token);
+
+        // Access tokens are short-lived: renew a minute before this one runs out
+        clearTimeout(this.refreshTimer);
+        if (expiresIn) {
+            const delay = Math.max(expiresIn - 60, 30) * 1000;
+            this.refreshTimer = setTimeout(() => this.refreshAccessToken().catch(() => {}), delay);
+        }
+
+        if (this.streamExpired) {
+            this.streamExpired = false;
+            this.openEventStream();
+        }
+    }
+
+    refreshAccessToken() {
+        // Requests failing together share one refresh
+        if (!this.refreshing) {
+            this.refreshing = (async () => {
+                try {
+                    const response = await fetch(`${this.apiBase}/token/refresh`, {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ refresh_token: this.refreshToken }),
+                    });
+                    const result = await response.json();
+                    if (!response.ok) {
+                        throw new Error(result.error || 'Session expired');
+                    }
+                    this.setAccessToken(result.token, result.expires_in);
+                } finally {
+                    this.refreshing = null;
+                }
+            })();
+        }
+        return this.refreshing;
     }
 
     showLoginView() {
@@ -110,6 +174,60 @@ class AuthApp {
         this.loadAllUsers();
         // Load matchday data
         this.loadMatchdayData();
+        // Live updates instead of re-fetching
+        this.openEventStream();
+    }
+
+    openEventStream() {
+        if (!window.EventSource || this.eventSource || !this.token) {
+            return;
+        }
+
+        const url = `${this.apiBase}/stream?token=${encodeURIComponent(this.token)}`;
+        this.eventSource = new EventSource(url);
+
+        this.eventSource.onerror = () => {
+            // The browser reconnects with the same URL; once its token has
+            // expired that fails for good, so wait for the next token instead
+            if (this.eventSource && this.eventSource.readyState === EventSource.CLOSED) {
+                this.eventSource = null;
+                this.streamExpired = true;
+            }
+        };
+
+        this.eventSource.addEventListener('matchday', (e) => {
+            const data = JSON.parse(e.data);
+            this.displayMatchdayBanner(data.matchday);
+        });
+
+        this.eventSource.addEventListener('rating', (e) => {
+            const data = JSON.parse(e.data);
+            const card = document.querySelector(`.player-card[data-user-id="${data.user_id}"]`);
+            if (!card) {
+                return;
+            }
+            card.querySelector('.rating-value').textContent = data.average_score;
+            card.querySelector('.rating-count').textContent = `(${data.rating_count} ratings)`;
+            this.scheduleChartReload(data.user_id);
+        });
+    }
+
+    scheduleChartReload(userId) {
+        // The chart needs the full breakdown; a burst of ratings for a player
+        // refetches it once, after the burst
+        this.chartReloads = this.chartReloads || new Map();
+        clearTimeout(this.chartReloads.get(userId));
+        this.chartReloads.set(userId, setTimeout(() => {
+            this.chartReloads.delete(userId);
+            this.loadUserSkillsAndCreateChart(userId);
+        }, 2000));
+    }
+
+    closeEventStream() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
     }
 
     async loadMatchdayData() {
@@ -143,7 +261,7 @@ class AuthApp {
         document.getElementById('secondToLast').textContent = matchdayData.secondToLast;
 
         // Update no subs player
-        document.getElementById('noSubsPlayer').textContent = matchdayData.noSubs;
+        document.getElementById('noSubsPlayer').textContent = matchdayData.noSubs || 'Nobody';
     }
 
     // Optional: Method to hide the banner if data fails to load
@@ -239,8 +357,7 @@ class AuthApp {
     }
     async loadAllUsers() {
         try {
-            const response = await this.apiCall('/users');
-            this.displayUserCards(response.users);
+            await this.loadUserPage(this.userLists.cards, true);
         } catch (error) {
             console.error('Failed to load users:', error);
         }
@@ -520,16 +637,15 @@ class AuthApp {
     async loadAdminSection() {
         // This would typically check user role/permissions
         try {
-            const users = await this.apiCall('/users', 'GET');
-            this.displayUsers(users.users);
+            await this.loadUserPage(this.userLists.admin, true);
         } catch (error) {
             console.error('Failed to load users:', error);
         }
     }
 
-    displayUsers(users) {
+    displayUsers(users, append = false) {
         const usersList = document.getElementById('usersList');
-        usersList.innerHTML = users.map(user => `
+        const html = users.map(user => `
             <div class="user-card">
                 <div class="user-info">
                     <h4>${user.name}</h4>
@@ -541,6 +657,11 @@ class AuthApp {
                 </div>
             </div>
         `).join('');
+        if (append) {
+            usersList.insertAdjacentHTML('beforeend', html);
+        } else {
+            usersList.innerHTML = html;
+        }
     }
 
     async deleteUser(userId) {
@@ -555,7 +676,66 @@ class AuthApp {
         }
     }
 
-    async apiCall(endpoint, method = 'GET', data = null) {
+    async loadUserPage(list, reset = false) {
+        // /api/users is keyset-paginated: show the first page, then fetch the
+        // next one (from next_after) when the list is scrolled to its end or
+        // "More players" is clicked
+        if (reset) {
+            list.after = null;
+            list.done = false;
+            list.generation = (list.generation || 0) + 1;
+        } else if (list.loading || list.done) {
+            return;
+        }
+        const generation = list.generation;
+        const append = list.after !== null;
+        list.loading = true;
+        try {
+            const params = new URLSearchParams({ fields: list.fields, limit: '50' });
+            if (append) {
+                params.set('after', list.after);
+            }
+            const response = await this.apiCall(`/users?${params.toString()}`);
+            if (generation !== list.generation) {
+                return; // reloaded from the top meanwhile
+            }
+            list.render(response.users, append);
+            list.after = response.next_after;
+            list.done = !list.after;
+        } finally {
+            if (generation === list.generation) {
+                list.loading = false;
+                this.updateMoreButton(list);
+            }
+        }
+    }
+
+    updateMoreButton(list) {
+        // One "More players" button after each list; it also loads the next
+        // page by itself once it scrolls into view
+        if (!list.moreButton) {
+            const button = document.createElement('button');
+            button.className = 'btn btn-secondary load-more-btn';
+            button.textContent = 'More players';
+            const loadMore = () => this.loadUserPage(list).catch(error => {
+                console.error('Failed to load more users:', error);
+            });
+            button.addEventListener('click', loadMore);
+            document.getElementById(list.containerId).after(button);
+            if ('IntersectionObserver' in window) {
+                new IntersectionObserver(entries => {
+                    if (entries.some(entry => entry.isIntersecting)) {
+                        loadMore();
+                    }
+                }, { rootMargin: '200px' }).observe(button);
+            }
+            list.moreButton = button;
+        }
+        list.moreButton.style.display = list.done ? 'none' : '';
+        list.moreButton.disabled = list.loading;
+    }
+
+    async apiCall(endpoint, method = 'GET', data = null, retried = false) {
         const config = {
             method,
             headers: {
@@ -577,6 +757,12 @@ class AuthApp {
         const response = await fetch(`${this.apiBase}${endpoint}`, config);
         const result = await response.json();
 
+        if (response.status === 401 && this.refreshToken && !retried && endpoint !== '/login') {
+            // Most likely the access token expired: get a new one and try once more
+            await this.refreshAccessToken();
+            return this.apiCall(endpoint, method, data, true);
+        }
+
         if (!response.ok) {
             throw new Error(result.error || 'Something went wrong');
         }
@@ -793,6 +979,8 @@ class AuthApp {
         try {
             const response = await this.apiCall('/preferences', 'POST', preferences);
             console.log("Backend response:", response);
+            // Same token, carrying the new position
+            this.setAccessToken(response.token, response.expires_in);
 
             this.showMessage(response.message, 'success');
             this.closeModal(document.querySelector('.modal-overlay'));
@@ -974,10 +1162,10 @@ class AuthApp {
         }
     }
 
-    displayUserCards(users) {
+    displayUserCards(users, append = false) {
         const usersGrid = document.getElementById('usersGrid');
 
-        usersGrid.innerHTML = users.map(user => {
+        const html = users.map(user => {
             // Use the first letter of the name as avatar
             const userInitial = user.name ? user.name[0].toUpperCase() : 'U';
             const defaultAvatar = this.generateAvatarSVG(userInitial);
@@ -985,7 +1173,7 @@ class AuthApp {
             let imageUrl = user.picture && user.picture.trim() !== '' ? user.picture : defaultAvatar;
 
             return `
-        <div class="player-card" data-team="${user.favorite_team}">
+        <div class="player-card" data-team="${user.favorite_team}" data-user-id="${user.id}">
             <div class="card-header">
                 <div class="player-image">
                     <img src="${imageUrl}" alt="${user.name}" 
@@ -1029,6 +1217,11 @@ class AuthApp {
         </div>
         `;
         }).join('');
+        if (append) {
+            usersGrid.insertAdjacentHTML('beforeend', html);
+        } else {
+            usersGrid.innerHTML = html;
+        }
 
         // Load skills and create charts for each user
         users.forEach(user => {
@@ -0,0 +1,102 @@
+import threading
+import time
+from flask import request, g, jsonify
+from config import Config
+from database import get_pool_pressure
+from utils.metrics import inc
+
+# Global admission control. When a worker is overloaded, new /api requests
+# are answered 503 with Retry-After straight away, before they touch the
+# database, instead of queueing until the client or gunicorn's timeout gives
+# up. Checked in order (0 turns a check off):
+#   in_flight   more than ADMISSION_MAX_IN_FLIGHT /api requests running in
+#               this worker (async mode; gthread already caps it at threads)
+#   queue_time  the request waited more than ADMISSION_MAX_QUEUE_TIME seconds
+#               before reaching the worker, per the proxy's X-Request-Start
+#   pool        ADMISSION_MAX_POOL_WAITERS requests are already waiting for a
+#               pool connection, or one has waited ADMISSION_MAX_POOL_WAIT
+# Both pool signals describe the pool right now, so shedding stops as soon as
+# the backlog drains.
+#
+# Event streams, metrics and debug endpoints are never shed or counted.
+EXEMPT_PREFIXES = ('/api/stream', '/api/debug/')
+
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+_shed = {'in_flight': 0, 'queue_time': 0, 'pool': 0}
+
+
+def _queue_time():
+    """Seconds since the proxy received the request, or None without X-Request-Start"""
+    header = request.headers.get('X-Request-Start')
+    if not header:
+        return None
+    try:
+        started = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return None
+    # Proxies send seconds, milliseconds or microseconds since the epoch
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return time.time() - started
+
+
+def _overload_reason(in_flight):
+    if Config.ADMISSION_MAX_IN_FLIGHT and in_flight > Config.ADMISSION_MAX_IN_FLIGHT:
+        return 'in_flight'
+
+    if Config.ADMISSION_MAX_QUEUE_TIME:
+        queued = _queue_time()
+        if queued is not None and queued > Config.ADMISSION_MAX_QUEUE_TIME:
+            return 'queue_time'
+
+    waiting, longest_wait = get_pool_pressure()
+    if Config.ADMISSION_MAX_POOL_WAITERS and waiting >= Config.ADMISSION_MAX_POOL_WAITERS:
+        return 'pool'
+    if Config.ADMISSION_MAX_POOL_WAIT and longest_wait > Config.ADMISSION_MAX_POOL_WAIT:
+        return 'pool'
+    return None
+
+
+def configure_admission_control(app):
+    @app.before_request
+    def admit_request():
+        global _in_flight
+        if not request.path.startswith('/api/') or request.path.startswith(EXEMPT_PREFIXES):
+            return None
+
+        with _in_flight_lock:
+            _in_flight += 1
+            in_flight = _in_flight
+        g.admission_counted = True
+
+        reason = _overload_reason(in_flight)
+        if reason is None:
+            return None
+
+        with _in_flight_lock:
+            _shed[reason] += 1
+        inc('fantasyfc_requests_shed_total', {'reason': reason})
+        response = jsonify({'error': 'Server busy, please try again'})
+        response.headers['Retry-After'] = str(Config.ADMISSION_RETRY_AFTER)
+        return response, 503
+
+    @app.teardown_request
+    def release_request(exc):
+        global _in_flight
+        if g.pop('admission_counted', False):
+            with _in_flight_lock:
+                _in_flight -= 1
+
+
+def get_admission_stats():
+    waiting, longest_wait = get_pool_pressure()
+    with _in_flight_lock:
+        return {
+            'in_flight': _in_flight,
+            'pool_waiting': waiting,
+            'pool_longest_wait': longest_wait,
+            'shed': dict(_shed),
+        }
@@ -0,0 +1,184 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+from config import Config
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# Frontend build step. Copies every file under static/ to ASSET_BUILD_PATH as
+# <name>.<content hash>.<ext>, writes .gz (and .br when the brotli module is
+# installed) next to each compressible file, and rewrites the references in
+# index.html to the fingerprinted /assets/ URLs. routes/asset_routes.py then
+# serves those files with immutable caching, picking the precompressed
+# variant the client accepts.
+#
+#     python -m utils.assets build
+#
+# The gunicorn master also builds once in on_starting. Without a build the
+# app falls back to serving static/ as-is.
+INDEX = 'index.html'
+MANIFEST = 'manifest.json'
+ASSET_PREFIX = '/assets/'
+
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.html', '.svg', '.json', '.txt', '.ico'}
+# Compression that saves less than this isn't worth a separate variant
+MIN_COMPRESSION_SAVING = 0.1
+
+# src="..." / href="..." attributes pointing at local files
+REFERENCE_RE = re.compile(r'''(\b(?:src|href)=["'])([^"'#?:]+)(["'])''')
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _write_with_variants(path, data):
+    """Write a file plus its precompressed variants; returns the encodings written"""
+    _write_atomic(path, data)
+    encodings = []
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return encodings
+
+    compressed = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed['br'] = brotli.compress(data, quality=11)
+
+    for encoding, payload in compressed.items():
+        if len(payload) <= len(data) * (1 - MIN_COMPRESSION_SAVING):
+            _write_atomic(f'{path}.{encoding_suffix(encoding)}', payload)
+            encodings.append(encoding)
+    return encodings
+
+
+def encoding_suffix(encoding):
+    return {'gzip': 'gz', 'br': 'br'}[encoding]
+
+
+def transcode_gif(data):
+    """Animated GIF -> animated WebP, or None if it isn't smaller (or Pillow is missing)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        output = io.BytesIO()
+        image.save(output, format='WEBP', save_all=True, quality=80, method=6)
+    except Exception as e:
+        log.error('Failed to transcode GIF', extra={'error': str(e)})
+        return None
+
+    webp = output.getvalue()
+    return webp if len(webp) < len(data) else None
+
+
+def fingerprinted_name(logical_path, data):
+    root, extension = os.path.splitext(logical_path)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+
+
+def rewrite_references(html, manifest):
+    """Point local src/href attributes in html at their fingerprinted URLs"""
+    def replace(match):
+        prefix, reference, suffix = match.groups()
+        asset = manifest.get(reference.lstrip('/'))
+        if asset is None:
+            return match.group(0)
+        return f"{prefix}{ASSET_PREFIX}{asset['path']}{suffix}"
+
+    return REFERENCE_RE.sub(replace, html)
+
+
+def build_assets(source=None, output=None, transcode_gifs=None):
+    """Build the fingerprinted, precompressed asset tree. Returns the manifest."""
+    source = source or Config.STATIC_PATH
+    output = output or Config.ASSET_BUILD_PATH
+    transcode_gifs = Config.ASSET_TRANSCODE_GIFS if transcode_gifs is None else transcode_gifs
+
+    manifest = {}
+    for directory, _, files in os.walk(source):
+        for filename in sorted(files):
+            full_path = os.path.join(directory, filename)
+            logical_path = os.path.relpath(full_path, source).replace(os.sep, '/')
+            if logical_path == INDEX:
+                continue
+
+            with open(full_path, 'rb') as f:
+                data = f.read()
+
+            if transcode_gifs and logical_path.lower().endswith('.gif'):
+                webp = transcode_gif(data)
+                if webp is not None:
+                    log.info('Transcoded GIF to WebP', extra={'asset': logical_path, 'gif_bytes': len(data), 'webp_bytes': len(webp)})
+                    data = webp
+                    logical_target = logical_path[:-len('.gif')] + '.webp'
+                else:
+                    logical_target = logical_path
+            else:
+                logical_target = logical_path
+
+            asset_path = fingerprinted_name(logical_target, data)
+            target = os.path.join(output, asset_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Content-addressed: an existing file already has these bytes
+            if os.path.exists(target):
+                encodings = [
+                    encoding for encoding in ('br', 'gzip')
+                    if os.path.exists(f'{target}.{encoding_suffix(encoding)}')
+                ]
+            else:
+                encodings = _write_with_variants(target, data)
+
+            manifest[logical_path] = {'path': asset_path, 'size': len(data), 'encodings': encodings}
+
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(source, INDEX), encoding='utf-8') as f:
+        index = rewrite_references(f.read(), manifest).encode('utf-8')
+    index_encodings = _write_with_variants(os.path.join(output, INDEX), index)
+    manifest[INDEX] = {'path': INDEX, 'size': len(index), 'encodings': index_encodings}
+
+    # Manifest last: its presence means the build is complete
+    _write_atomic(os.path.join(output, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def load_manifest(output=None):
+    """The manifest of the last complete build, or None if there isn't one"""
+    try:
+        with open(os.path.join(output or Config.ASSET_BUILD_PATH, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['build']:
+        print('usage: python -m utils.assets build [--transcode-gifs]')
+        sys.exit(2)
+
+    manifest = build_assets(transcode_gifs=True if '--transcode-gifs' in sys.argv else None)
+    for logical_path, asset in sorted(manifest.items()):
+        encodings = ', '.join(asset['encodings']) or 'uncompressed'
+        print(f"{logical_path} -> {asset['path']} ({asset['size']} bytes; {encodings})")
+    if brotli is None:
+        print('brotli module not installed: built gzip variants only')
@@ -1,12 +1,173 @@
-import hashlib
 import jwt
+import math
+import os
+import time
+import uuid
 import datetime
+import threading
 from functools import wraps
 from flask import request, jsonify
 from config import Config
+from utils.cache import TTLCache
+from utils.passwords import hash_password, verify_password, HashingBusy
+from utils.log import get_logger
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+log = get_logger(__name__)
+
+# Tokens come in three kinds, told apart by the typ claim:
+#   access   ACCESS_TOKEN_TTL; carries uid, email, name and position, so
+#            token_required authorizes it with no database query at all
+#   refresh  REFRESH_TOKEN_TTL; only uid and a jti, traded for a new access
+#            token at /api/token/refresh (which does read the user)
+#   (none)   legacy 7-day tokens issued before access tokens existed; still
+#            resolved through the principal cache below until they expire
+#
+# Revocations (models/revocations.py) are what makes short-lived stateless
+# tokens safe: each worker keeps the whole set in memory, reloaded every
+# REVOCATION_SYNC_INTERVAL seconds, and checks it with two dict lookups.
+LEGACY_TOKEN_TTL = 7 * 24 * 3600
+
+# Resolved principals ({id, email, name}) keyed by (email, token iat), so a
+# valid legacy token only costs one users lookup per TTL window.
+_principal_cache = TTLCache(maxsize=Config.PRINCIPAL_CACHE_SIZE, ttl=Config.PRINCIPAL_CACHE_TTL)
+
+# {subject: revoked_at}, replaced wholesale by each sync
+_revocations = {}
+_revocations_synced_at = None
+_revocation_sync_errors = 0
+_revocation_sync_pid = None
+_revocation_sync_lock = threading.Lock()
+
+def invalidate_principal(user_id=None, email=None):
+    """Forget cached principals for a user (after update/delete/preference changes)"""
+    return _principal_cache.delete_where(
+        lambda key, principal: principal['id'] == user_id or principal['email'] == email
+    )
+
+def get_principal_cache_stats():
+    return _principal_cache.stats()
+
+def resolve_principal(data):
+    """Map decoded legacy token claims to the current user, or None if it no longer exists"""
+    cache_key = (data['email'], data.get('iat'))
+    principal = _principal_cache.get(cache_key)
+    if principal is not None:
+        return principal
+
+    from models.user import get_user_principal
+    principal = get_user_principal(data['email'])
+    if principal is not None:
+        _principal_cache.set(cache_key, principal)
+    return principal
+
+def sync_revocations():
+    """Reload the revocation set from the database"""
+    global _revocations, _revocations_synced_at
+    from database import get_connection
+    from models.revocations import load_revocations
+
+    conn = get_connection()
+    try:
+        revocations = load_revocations(conn)
+    finally:
+        conn.close()
+    _revocations = revocations
+    _revocations_synced_at = time.time()
+
+def _revocation_sync_loop():
+    global _revocation_sync_errors
+    while True:
+        time.sleep(Config.REVOCATION_SYNC_INTERVAL)
+        try:
+            sync_revocations()
+        except Exception as e:
+            # Keep checking against the last set we loaded; try again next tick
+            _revocation_sync_errors += 1
+            log.error('Failed to sync token revocations', extra={'error': str(e)})
+
+def _ensure_revocations():
+    """Load the set once per process, then keep it fresh on a daemon thread"""
+    global _revocation_sync_pid, _revocation_sync_errors
+    pid = os.getpid()
+    if _revocation_sync_pid == pid:
+        return
+    with _revocation_sync_lock:
+        if _revocation_sync_pid != pid:
+            try:
+                sync_revocations()
+            except Exception as e:
+                _revocation_sync_errors += 1
+                log.error('Failed to load token revocations', extra={'error': str(e)})
+            threading.Thread(target=_revocation_sync_loop, name='revocation-sync', daemon=True).start()
+            _revocation_sync_pid = pid
+
+def is_revoked(claims):
+    """True if all tokens or the user's tokens up to this one's iat, or this
+    token itself, were revoked"""
+    _ensure_revocations()
+    # iat is whole seconds, so only tokens from before the second of the
+    # revocation count as revoked; one issued just after it (a login right
+    # after a logout or import) has the same iat and must stay valid
+    iat = claims.get('iat', 0)
+    for subject in ('all', f"user:{claims.get('uid')}"):
+        revoked_at = _revocations.get(subject)
+        if revoked_at is not None and iat < math.floor(revoked_at):
+            return True
+    jti = claims.get('jti')
+    return jti is not None and f'token:{jti}' in _revocations
+
+def _revoke(conn, subject, expires_at):
+    from models.revocations import add_revocation
+
+    revoked_at = add_revocation(conn, subject, expires_at)
+    # This worker stops accepting the tokens right away; the others pick the
+    # row up on their next sync (and a rolled back one drops out on ours)
+    _revocations[subject] = revoked_at
+
+def revoke_user(conn, user_id):
+    """Reject every token issued to the user so far. Runs inside the caller's transaction."""
+    _revoke(conn, f'user:{user_id}', time.time() + max(Config.REFRESH_TOKEN_TTL, LEGACY_TOKEN_TTL))
+
+def revoke_all(conn):
+    """Reject every token issued so far, to anyone (the user ids they carry
+    are about to mean other people). Runs inside the caller's transaction."""
+    global _revocations
+    from models.revocations import clear_revocations
+
+    clear_revocations(conn)
+    _revocations = {}
+    _revoke(conn, 'all', time.time() + max(Config.REFRESH_TOKEN_TTL, LEGACY_TOKEN_TTL))
+
+def revoke_refresh_token(conn, claims):
+    """Reject one refresh token (logout) for the rest of its lifetime"""
+    _revoke(conn, f"token:{claims['jti']}", claims['exp'])
+
+def get_revocation_stats():
+    return {
+        'revocations': len(_revocations),
+        'synced_at': _revocations_synced_at,
+        'sync_errors': _revocation_sync_errors,
+    }
+
+def decode_token(token, *types):
+    """Verified, unrevoked claims of a token of one of the given kinds, or None"""
+    try:
+        claims = jwt.decode(token, Config.JWT_SECRET, algorithms=[Config.JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    if claims.get('typ', 'legacy') not in types or is_revoked(claims):
+        return None
+    return claims
+
+def decode_access_token(token):
+    """The principal an access (or legacy) token stands for, or None"""
+    claims = decode_token(token, 'access', 'legacy')
+    if claims is None:
+        return None
+    if 'typ' not in claims:
+        return resolve_principal(claims)
+    return {'id': claims['uid'], 'email': claims['email'], 'name': claims['name'],
+            'position': claims.get('position')}
 
 def token_required(f):
     @wraps(f)
@@ -15,21 +176,39 @@ def token_required(f):
         if not token:
             return jsonify({'error': 'Token is missing'}), 401
 
+        if token.startswith('Bearer '):
+            token = token[7:]
         try:
-            if token.startswith('Bearer '):
-                token = token[7:]
-            data = jwt.decode(token, Config.JWT_SECRET, algorithms=[Config.JWT_ALGORITHM])
-            from models.user import get_user_by_email
-            current_user = get_user_by_email(data['email'])
+            current_user = decode_access_token(token)
         except Exception as e:
+            log.error('Failed to resolve token', extra={'error': str(e)})
+            current_user = None
+
+        if current_user is None:
             return jsonify({'error': 'Token is invalid'}), 401
 
         return f(current_user, *args, **kwargs)
     return decorated
 
 def generate_token(user_data):
+    """A short-lived access token for a user row ({id, email, name[, position]})"""
+    now = datetime.datetime.utcnow()
     return jwt.encode({
+        'typ': 'access',
+        'uid': user_data['id'],
         'email': user_data['email'],
         'name': user_data['name'],
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(days=7)
-    }, Config.JWT_SECRET, algorithm=Config.JWT_ALGORITHM)
\ No newline at end of file
+        'position': user_data.get('position'),
+        'iat': now,
+        'exp': now + datetime.timedelta(seconds=Config.ACCESS_TOKEN_TTL)
+    }, Config.JWT_SECRET, algorithm=Config.JWT_ALGORITHM)
+
+def generate_refresh_token(user_data):
+    now = datetime.datetime.utcnow()
+    return jwt.encode({
+        'typ': 'refresh',
+        'uid': user_data['id'],
+        'jti': uuid.uuid4().hex,
+        'iat': now,
+        'exp': now + datetime.timedelta(seconds=Config.REFRESH_TOKEN_TTL)
+    }, Config.JWT_SECRET, algorithm=Config.JWT_ALGORITHM)
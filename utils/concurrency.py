@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Helpers for code that runs under both serving modes (see .gunicorn.conf.py):
+#   threaded  gthread workers, one OS thread per in-flight request
+#   async     gevent workers, one greenlet per request; sockets and psycopg2
+#             (via psycogreen) wait cooperatively
+# Under gevent, "threading" is monkey patched, so a plain ThreadPoolExecutor
+# runs its jobs as greenlets on the same OS thread. CPU-heavy work (the
+# password KDF, Pillow) would then stall every request of the worker, so it
+# has to go to gevent's pool of real threads instead.
+#
+# The gunicorn master forks every worker, so it must not run threads of its
+# own: one holding a lock when the master forks leaves the worker a lock
+# nobody will ever release. Its config calls hold_background_threads(), and
+# code that starts daemon threads lazily (the log listener, the metrics
+# flusher) checks background_threads_allowed() first. Forked children have
+# their own pid, so the hold never reaches them.
+_threads_held_pid = None
+
+
+def hold_background_threads():
+    """Keep this process (not its children) from starting background threads"""
+    global _threads_held_pid
+    _threads_held_pid = os.getpid()
+
+
+def background_threads_allowed():
+    return _threads_held_pid != os.getpid()
+
+
+def is_cooperative():
+    """True when running under gevent's monkey patching"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def make_executor(max_workers, thread_name_prefix=''):
+    """An executor whose jobs run on OS threads in either serving mode.
+
+    Call it after the worker has started (not at import), since gevent
+    patches modules when the worker process boots.
+    """
+    if is_cooperative():
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        # .result() on its futures yields to other greenlets while waiting
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+
+def run_blocking(fn, *args):
+    """Run CPU-bound fn off the event loop under gevent; call it directly otherwise.
+
+    Only worth it for work that releases the GIL (hashlib, Pillow, zlib).
+    """
+    if not is_cooperative():
+        return fn(*args)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args)
@@ -0,0 +1,229 @@
+import json
+import queue
+import select
+import threading
+import time
+from config import Config
+from utils.concurrency import is_cooperative
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# In-process pub/sub feeding the /api/stream server-sent events endpoint.
+# publish() hands an event to the configured fan-out backend, which delivers
+# it to the subscribers of every worker:
+#   local     deliver in this process only (single worker, development)
+#   postgres  pg_notify() on publish, one LISTEN thread per worker delivers
+#
+# Writes publish after they commit, on the connection they wrote with, and
+# publish all their events at once: a batch of ratings is one pg_notify
+# (or a few, see NOTIFY_PAYLOAD_LIMIT), not a connection checkout per event.
+EVENT_CHANNEL = 'fantasyfc_events'
+# PostgreSQL rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7800
+
+
+class Subscription:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = False
+
+    def get(self, timeout):
+        """Next (event_type, data), or None if nothing arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def deliver(self, event_type, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self.published += 1
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait((event_type, data))
+                self.delivered += 1
+            except queue.Full:
+                # A client that can't keep up is cut loose; it reconnects and
+                # re-fetches instead of holding memory for a backlog
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+                self.dropped += 1
+
+
+class LocalFanout:
+    def __init__(self, bus):
+        self.bus = bus
+
+    def start(self):
+        pass
+
+    def publish(self, events, conn=None):
+        for event_type, data in events:
+            self.bus.deliver(event_type, data)
+
+
+class PostgresFanout:
+    """Cross-worker delivery through LISTEN/NOTIFY on the application database"""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def _payloads(self, events):
+        # Each payload a JSON list of events, as many as fit
+        messages = [json.dumps({'type': event_type, 'data': data}) for event_type, data in events]
+        batch = []
+        size = 2
+        for message in messages:
+            if batch and size + len(message) + 1 > NOTIFY_PAYLOAD_LIMIT:
+                yield '[' + ','.join(batch) + ']'
+                batch, size = [], 2
+            batch.append(message)
+            size += len(message) + 1
+        if batch:
+            yield '[' + ','.join(batch) + ']'
+
+    def publish(self, events, conn=None):
+        from database import get_connection
+        import sqlalchemy as sa
+
+        self.start()
+        own_conn = conn is None
+        if own_conn:
+            conn = get_connection()
+        try:
+            with conn.begin():
+                for payload in self._payloads(events):
+                    conn.execute(sa.text('SELECT pg_notify(:channel, :payload)'),
+                                 {"channel": EVENT_CHANNEL, "payload": payload})
+        finally:
+            if own_conn:
+                conn.close()
+
+    def start(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._listener_lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='event-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        import sqlalchemy as sa
+
+        # A dedicated connection outside the request pool, held for good
+        engine = sa.create_engine(Config.DATABASE_URL, poolclass=sa.pool.NullPool)
+        while True:
+            raw = None
+            try:
+                raw = engine.raw_connection()
+                dbapi_conn = raw.connection
+                dbapi_conn.set_isolation_level(0)  # autocommit, required for LISTEN
+                cursor = dbapi_conn.cursor()
+                cursor.execute(f'LISTEN {EVENT_CHANNEL}')
+
+                while True:
+                    # select() is cooperative under gevent's monkey patching
+                    if select.select([dbapi_conn], [], [], 30) == ([], [], []):
+                        continue
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        notify = dbapi_conn.notifies.pop(0)
+                        messages = json.loads(notify.payload)
+                        if isinstance(messages, dict):
+                            # One event per NOTIFY, from a worker still
+                            # running the previous release
+                            messages = [messages]
+                        for message in messages:
+                            self.bus.deliver(message['type'], message['data'])
+            except Exception as e:
+                log.error('Event listener failed, reconnecting', extra={'error': str(e)})
+                time.sleep(1)
+            finally:
+                if raw is not None:
+                    try:
+                        raw.invalidate()
+                    except Exception:
+                        pass
+
+
+EVENT_FANOUTS = {
+    'local': LocalFanout,
+    'postgres': PostgresFanout,
+}
+
+bus = EventBus(Config.STREAM_QUEUE_SIZE)
+_fanout = None
+_fanout_lock = threading.Lock()
+
+
+def register_event_fanout(name, factory):
+    EVENT_FANOUTS[name] = factory
+
+
+def get_fanout():
+    global _fanout
+    if _fanout is None:
+        with _fanout_lock:
+            if _fanout is None:
+                factory = EVENT_FANOUTS.get(Config.EVENT_FANOUT)
+                if factory is None:
+                    raise RuntimeError(f'Unknown event fanout: {Config.EVENT_FANOUT}')
+                _fanout = factory(bus)
+    return _fanout
+
+
+def publish_events(events, conn=None):
+    """Push [(event_type, data)] to every connected stream.
+
+    Call after the write has committed, passing its connection (still open,
+    outside any transaction) so no other one is checked out.
+    """
+    if not events:
+        return
+    try:
+        get_fanout().publish(events, conn)
+    except Exception as e:
+        # Streams are an optimization over polling; never fail the write
+        log.error('Failed to publish events', extra={'event_type': events[0][0], 'count': len(events),
+                                                     'error': str(e)})
+
+
+def publish(event_type, data, conn=None):
+    """Push one event to every connected stream (see publish_events)"""
+    publish_events([(event_type, data)], conn)
+
+
+def start_listener():
+    """Start cross-worker delivery before the first publish (e.g. when a stream opens)"""
+    get_fanout().start()
+
+
+def format_sse(event_type, data):
+    return f'event: {event_type}\ndata: {json.dumps(data)}\n\n'
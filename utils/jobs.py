@@ -0,0 +1,374 @@
+import argparse
+import heapq
+import importlib
+import itertools
+import os
+import sys
+import threading
+import time
+from config import Config
+from utils.cache import TTLCache
+from utils.metrics import inc, observe
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# Background jobs: follow-up work a request hands off instead of doing it
+# before responding.
+#
+#     @job('pictures.process')
+#     def process_picture(digest):
+#         ...
+#
+#     enqueue('pictures.process', {'digest': digest})
+#
+# Handlers are called with the payload as keyword arguments, and must be
+# safe to run more than once: a job is retried (with exponential backoff)
+# when its handler raises, and runs again when its worker dies mid-job and
+# the lease runs out. A key makes enqueueing idempotent: while a job with
+# that key is queued, running or recently finished (JOB_RETENTION), another
+# with the same key is dropped.
+#
+# Jobs run on JOB_WORKER_THREADS daemon threads in each app process, and/or
+# in a separate worker process:
+#
+#     python -m utils.jobs work [--threads N]
+#     python -m utils.jobs stats
+#
+# Only serving processes start pollers (start_workers() from gunicorn's
+# post_worker_init or the development server); enqueueing never does, so
+# CLIs, snapshot imports and the gunicorn master just insert. With
+# JOB_BACKEND=memory, jobs queued by a process without pollers never run.
+
+# Modules whose @job handlers a worker process needs
+JOB_MODULES = ['utils.pictures', 'models.analytics']
+# Seconds between lease recovery / cleanup passes of each poller
+MAINTENANCE_INTERVAL = 60
+# Seconds this process remembers the keys it enqueued, so repeats skip the
+# database entirely
+KEY_MEMORY_TTL = 60
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+JOB_HANDLERS = {}
+# {name: (interval seconds, payload)}
+PERIODIC_JOBS = {}
+
+
+def job(name, every=0, payload=None):
+    """Register the decorated function as the handler for jobs called name,
+    and with every set, run it (with payload) every `every` seconds"""
+    def decorator(f):
+        JOB_HANDLERS[name] = f
+        if every:
+            PERIODIC_JOBS[name] = (every, payload or {})
+        return f
+    return decorator
+
+
+class MemoryJobStore:
+    """Jobs in this process only, ordered by when they're due"""
+
+    def __init__(self, retention):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._keys = TTLCache(maxsize=100000, ttl=retention)
+        self._counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+
+    def enqueue(self, name, payload, key, run_after, max_attempts):
+        with self._lock:
+            if key is not None:
+                if self._keys.get(key) is not None:
+                    return False
+                self._keys.set(key, True)
+            job_id = next(self._ids)
+            heapq.heappush(self._heap, (run_after, job_id, {
+                'id': job_id, 'name': name, 'payload': payload or {}, 'attempts': 0,
+                'max_attempts': max_attempts, 'run_after': run_after,
+            }))
+            self._counts['queued'] += 1
+            return True
+
+    def claim(self):
+        with self._lock:
+            if not self._heap or self._heap[0][0] > time.time():
+                return None
+            _, _, job = heapq.heappop(self._heap)
+            job['attempts'] += 1
+            self._counts['queued'] -= 1
+            self._counts['running'] += 1
+            return job
+
+    def _finish(self, status):
+        with self._lock:
+            self._counts['running'] -= 1
+            self._counts[status] += 1
+
+    def complete(self, job):
+        self._finish('done')
+
+    def retry(self, job, run_after, error):
+        with self._lock:
+            job['run_after'] = run_after
+            heapq.heappush(self._heap, (run_after, job['id'], job))
+            self._counts['running'] -= 1
+            self._counts['queued'] += 1
+
+    def fail(self, job, error):
+        self._finish('failed')
+
+    def maintain(self):
+        pass
+
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class DatabaseJobStore:
+    """Jobs in the jobs table (models/jobs.py), shared by every process"""
+
+    def __init__(self, lease, retention):
+        self.lease = lease
+        self.retention = retention
+
+    def _run(self, f, *args):
+        from database import get_connection
+
+        conn = get_connection()
+        try:
+            return f(conn, *args)
+        finally:
+            conn.close()
+
+    def enqueue(self, name, payload, key, run_after, max_attempts):
+        from models.jobs import insert_job
+        return self._run(insert_job, name, payload, key, run_after, max_attempts)
+
+    def claim(self):
+        from models.jobs import claim_job
+        return self._run(claim_job, self.lease)
+
+    def complete(self, job):
+        from models.jobs import complete_job
+        self._run(complete_job, job)
+
+    def retry(self, job, run_after, error):
+        from models.jobs import retry_job
+        self._run(retry_job, job, run_after, error)
+
+    def fail(self, job, error):
+        from models.jobs import fail_job
+        self._run(fail_job, job, error)
+
+    def maintain(self):
+        from models.jobs import recover_jobs
+        self._run(recover_jobs, self.retention)
+
+    def counts(self):
+        from models.jobs import count_jobs
+        return self._run(count_jobs)
+
+
+JOB_BACKENDS = {
+    'memory': lambda: MemoryJobStore(Config.JOB_RETENTION),
+    'database': lambda: DatabaseJobStore(Config.JOB_LEASE, Config.JOB_RETENTION),
+}
+
+_store = None
+_store_lock = threading.Lock()
+_recent_keys = TTLCache(maxsize=4096, ttl=KEY_MEMORY_TTL)
+# Set on enqueue so this process's idle pollers don't wait out the interval
+_wakeup = threading.Event()
+_workers_pid = None
+_workers_lock = threading.Lock()
+_worker_count = 0
+
+
+def register_job_backend(name, factory):
+    JOB_BACKENDS[name] = factory
+
+
+def get_job_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                factory = JOB_BACKENDS.get(Config.JOB_BACKEND)
+                if factory is None:
+                    raise RuntimeError(f'Unknown job backend: {Config.JOB_BACKEND}')
+                _store = factory()
+    return _store
+
+
+def enqueue(name, payload=None, key=None, delay=0, max_attempts=None):
+    """Queue a job to run after delay seconds. Returns False when it was
+    dropped as a duplicate of key, or couldn't be queued (logged).
+
+    Call it after committing whatever the job reads.
+    """
+    if key is not None and _recent_keys.get(key) is not None:
+        return False
+    try:
+        queued = get_job_store().enqueue(name, payload, key, time.time() + delay,
+                                         max_attempts or Config.JOB_MAX_ATTEMPTS)
+    except Exception as e:
+        # The request's own work is done; losing the follow-up beats failing it
+        log.error('Failed to enqueue job', extra={'job': name, 'key': key, 'error': str(e)})
+        return False
+    if key is not None:
+        _recent_keys.set(key, True)
+    if queued:
+        inc('fantasyfc_jobs_enqueued_total', {'job': name})
+        if delay <= 0:
+            _wakeup.set()
+    return queued
+
+
+def schedule_periodic(names=None):
+    """Queue the next run of each periodic job (a no-op when it's already queued)"""
+    now = time.time()
+    for name in PERIODIC_JOBS if names is None else names:
+        every, payload = PERIODIC_JOBS[name]
+        due = (now // every + 1) * every
+        enqueue(name, payload, key=f'{name}@{due:.0f}', delay=due - now)
+
+
+def run_job(store, job):
+    """Run one claimed job and record how it went"""
+    name = job['name']
+    started = time.time()
+    observe('fantasyfc_job_wait_seconds', {'job': name}, max(started - job['run_after'], 0), JOB_BUCKETS)
+    try:
+        handler = JOB_HANDLERS.get(name)
+        if handler is None:
+            raise LookupError(f'No handler for job {name}')
+        handler(**job['payload'])
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        if job['attempts'] < job['max_attempts']:
+            result = 'retried'
+            delay = Config.JOB_RETRY_BACKOFF * 2 ** (job['attempts'] - 1)
+            store.retry(job, time.time() + delay, error)
+            log.warning('Job failed, will retry', extra={'job': name, 'job_id': job['id'],
+                                                         'attempt': job['attempts'], 'error': error})
+        else:
+            result = 'failed'
+            store.fail(job, error)
+            log.error('Job failed', extra={'job': name, 'job_id': job['id'],
+                                           'attempts': job['attempts'], 'error': error})
+    else:
+        result = 'done'
+        store.complete(job)
+
+    seconds = time.time() - started
+    observe('fantasyfc_job_duration_seconds', {'job': name}, seconds, JOB_BUCKETS)
+    inc('fantasyfc_jobs_total', {'job': name, 'result': result})
+    if name in PERIODIC_JOBS:
+        schedule_periodic([name])
+    log.debug('Job finished', extra={'job': name, 'job_id': job['id'], 'result': result,
+                                     'seconds': round(seconds, 3)})
+    return result
+
+
+def work(stop=None, poll_interval=None):
+    """Claim and run jobs until stop is set (forever by default)"""
+    store = get_job_store()
+    poll_interval = poll_interval or Config.JOB_POLL_INTERVAL
+    last_maintenance = 0
+    while stop is None or not stop.is_set():
+        job = None
+        try:
+            if time.time() - last_maintenance >= MAINTENANCE_INTERVAL:
+                store.maintain()
+                schedule_periodic()
+                last_maintenance = time.time()
+            job = store.claim()
+            if job is not None:
+                run_job(store, job)
+        except Exception as e:
+            # Store unavailable (or a result couldn't be recorded: the lease
+            # brings the job back); keep polling
+            log.error('Job worker error', extra={'job': job and job['name'], 'error': str(e)})
+        if job is None:
+            _wakeup.wait(poll_interval)
+            _wakeup.clear()
+
+
+def load_job_handlers():
+    for module in JOB_MODULES:
+        importlib.import_module(module)
+
+
+def start_workers(count=None):
+    """Start this process's pollers, once per process (threads don't survive fork)"""
+    global _workers_pid, _worker_count
+    pid = os.getpid()
+    if _workers_pid == pid:
+        return
+    with _workers_lock:
+        if _workers_pid == pid:
+            return
+        count = Config.JOB_WORKER_THREADS if count is None else count
+        if Config.JOB_BACKEND == 'memory':
+            # Nobody else can see this process's queue
+            count = max(count, 1)
+        if count:
+            load_job_handlers()
+        for i in range(count):
+            threading.Thread(target=work, name=f'job-worker-{i}', daemon=True).start()
+        _worker_count = count
+        _workers_pid = pid
+
+
+def get_job_stats():
+    stats = {'backend': Config.JOB_BACKEND, 'workers': _worker_count if _workers_pid == os.getpid() else 0}
+    try:
+        stats['jobs'] = get_job_store().counts()
+    except Exception as e:
+        stats['error'] = str(e)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run or inspect background jobs (uses DATABASE_URL)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    work_parser = commands.add_parser('work', help='run jobs until interrupted')
+    work_parser.add_argument('--threads', type=int, default=2)
+    commands.add_parser('stats', help='count jobs by status')
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        for status, count in sorted(get_job_store().counts().items()):
+            print(f'{status:8} {count}')
+        return
+
+    if Config.JOB_BACKEND == 'memory':
+        print('ERROR: JOB_BACKEND=memory jobs only run in the process that queued them')
+        sys.exit(1)
+    from models.migrations import ensure_schema
+    ensure_schema()
+    # These threads are this process's pollers (for get_job_stats)
+    global _workers_pid, _worker_count
+    _workers_pid, _worker_count = os.getpid(), args.threads
+    load_job_handlers()
+    stop = threading.Event()
+    threads = [threading.Thread(target=work, args=(stop,), name=f'job-worker-{i}') for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    print(f'Running jobs on {args.threads} threads ({Config.JOB_BACKEND} backend); Ctrl-C to stop')
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        _wakeup.set()
+        for thread in threads:
+            thread.join()
+
+
+if __name__ == '__main__':
+    # Through the package, so the handlers JOB_MODULES register are the ones
+    # the workers look up (this file also runs as __main__)
+    from utils.jobs import main
+    main()
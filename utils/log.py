@@ -0,0 +1,130 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from config import Config
+from utils.concurrency import background_threads_allowed
+
+# Leveled JSON-lines logging that never blocks a request thread. Loggers hand
+# records to an in-memory queue; one listener thread per process formats them
+# and writes to stdout. When the queue is full, records are dropped and
+# counted rather than making the request wait on the log pipe. A process
+# that can't run threads (the gunicorn master) writes its records directly.
+#
+#     log = get_logger(__name__)
+#     log.info('Saved preferences', extra={'user_id': user_id})
+#
+# Keyword fields passed through extra= become top-level JSON keys.
+ROOT_LOGGER = 'fantasyfc'
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops instead of blocking, and starts the listener per process"""
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue)
+        self.target = target
+        self.dropped = 0
+        self._listener = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # Threads don't survive fork, so each gunicorn worker starts its own
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._listener_lock:
+            if self._listener_pid != pid:
+                self._listener = logging.handlers.QueueListener(self.queue, self.target)
+                self._listener.start()
+                self._listener_pid = pid
+
+    def enqueue(self, record):
+        if not background_threads_allowed():
+            # The gunicorn master logs little and mustn't run the listener
+            self.target.handle(record)
+            return
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Merge args now (they may be mutated later); JSON formatting happens
+        # on the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def flush_and_stop(self):
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+            self._listener_pid = None
+
+
+_handler = None
+_setup_lock = threading.Lock()
+
+
+def _setup():
+    global _handler
+    with _setup_lock:
+        if _handler is not None:
+            return
+
+        target = logging.StreamHandler(sys.stdout)
+        target.setFormatter(JsonFormatter())
+        _handler = NonBlockingQueueHandler(queue.Queue(maxsize=Config.LOG_QUEUE_SIZE), target)
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(Config.LOG_LEVEL.upper())
+        root.addHandler(_handler)
+        root.propagate = False
+
+        atexit.register(_handler.flush_and_stop)
+
+
+def get_logger(name):
+    """Logger under the fantasyfc namespace (e.g. get_logger(__name__))"""
+    if _handler is None:
+        _setup()
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+
+def get_log_stats():
+    return {
+        'queued': _handler.queue.qsize() if _handler else 0,
+        'dropped': _handler.dropped if _handler else 0,
+        'level': Config.LOG_LEVEL.upper(),
+    }
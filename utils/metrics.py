@@ -0,0 +1,231 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from config import Config
+from utils.concurrency import background_threads_allowed
+
+# Request/DB metrics in Prometheus text format, summed across workers.
+#
+# Each process keeps counters and histograms in memory and a background
+# thread writes a snapshot to METRICS_PATH/<pid>.json every
+# METRICS_FLUSH_INTERVAL seconds. Whichever worker answers /metrics merges
+# every snapshot in the directory. Snapshots of exited workers are kept so
+# totals don't go backwards when gunicorn replaces a worker; the directory is
+# cleared when the master starts. The master itself records nothing: it runs
+# no flusher (see utils/concurrency.py), and whatever it counted would be
+# inherited by every worker it forks.
+
+# Request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Queries issued by one request
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 50)
+
+METRIC_HELP = {
+    'fantasyfc_http_requests_total': ('counter', 'HTTP requests by route and status'),
+    'fantasyfc_http_request_duration_seconds': ('histogram', 'Time to produce the response'),
+    'fantasyfc_http_response_bytes_total': ('counter', 'Response body bytes (when known)'),
+    'fantasyfc_db_queries_total': ('counter', 'SQL statements executed'),
+    'fantasyfc_db_query_seconds_total': ('counter', 'Time spent executing SQL statements'),
+    'fantasyfc_db_queries_per_request': ('histogram', 'SQL statements issued by one request'),
+    'fantasyfc_db_repeated_queries_total': ('counter', 'Requests that ran the same statement repeatedly (N+1)'),
+    'fantasyfc_log_records_dropped_total': ('counter', 'Log records dropped because the log queue was full'),
+    'fantasyfc_rating_cache_lookups_total': ('counter', 'Rating breakdown cache lookups by result (hits, misses, stale)'),
+    'fantasyfc_rate_limited_total': ('counter', 'Requests rejected with 429 by limit and key scope'),
+    'fantasyfc_requests_shed_total': ('counter', 'Requests rejected with 503 by admission control, by reason'),
+    'fantasyfc_jobs_enqueued_total': ('counter', 'Background jobs queued by this process, by job'),
+    'fantasyfc_jobs_total': ('counter', 'Background jobs run, by job and result (done, retried, failed)'),
+    'fantasyfc_job_duration_seconds': ('histogram', 'Time a background job handler ran'),
+    'fantasyfc_job_wait_seconds': ('histogram', 'Time a background job waited past its due time'),
+}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), dict(h, counts=list(h['counts']))] for (name, labels), h in self.histograms.items()],
+            }
+
+
+registry = Registry()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def inc(name, labels, value=1):
+    if _ensure_flusher():
+        registry.inc(name, labels, value)
+
+
+def observe(name, labels, value, buckets=LATENCY_BUCKETS):
+    if _ensure_flusher():
+        registry.observe(name, labels, value, buckets)
+
+
+def record_query(statement, seconds):
+    """Called for every SQL statement (see database.py); attributed to the current request"""
+    from flask import g, has_request_context
+
+    if has_request_context() and 'db_statements' in g:
+        g.db_queries += 1
+        g.db_time += seconds
+        g.db_statements[statement] = g.db_statements.get(statement, 0) + 1
+    else:
+        inc('fantasyfc_db_queries_total', {'route': '-'})
+        inc('fantasyfc_db_query_seconds_total', {'route': '-'}, seconds)
+
+
+def _snapshot_path(pid=None):
+    return os.path.join(Config.METRICS_PATH, f'{pid or os.getpid()}.json')
+
+
+def flush():
+    """Write this process's snapshot for the other workers to read"""
+    from utils.log import get_log_stats
+
+    snapshot = registry.snapshot()
+    dropped = get_log_stats()['dropped']
+    if dropped:
+        snapshot['counters'].append(['fantasyfc_log_records_dropped_total', {}, dropped])
+
+    os.makedirs(Config.METRICS_PATH, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=Config.METRICS_PATH, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, _snapshot_path())
+
+
+def _flush_loop():
+    while True:
+        time.sleep(Config.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            # Metrics must never take the worker down; try again next tick
+            pass
+
+
+def _ensure_flusher():
+    """Start this process's flusher once; False where none may run (record nothing then)"""
+    global _flusher_pid
+    pid = os.getpid()
+    if _flusher_pid == pid:
+        return True
+    if not background_threads_allowed():
+        return False
+    with _flusher_lock:
+        if _flusher_pid != pid:
+            threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+            _flusher_pid = pid
+    return True
+
+
+def reset_metrics():
+    """Forget every worker snapshot (the gunicorn master calls this on start)"""
+    if not os.path.isdir(Config.METRICS_PATH):
+        return
+    for filename in os.listdir(Config.METRICS_PATH):
+        if filename.endswith('.json'):
+            os.remove(os.path.join(Config.METRICS_PATH, filename))
+
+
+def _merge_snapshots():
+    counters = {}
+    histograms = {}
+    try:
+        filenames = os.listdir(Config.METRICS_PATH)
+    except FileNotFoundError:
+        filenames = []
+
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(Config.METRICS_PATH, filename)) as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = dict(histogram, counts=list(histogram['counts']))
+            else:
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+                merged['sum'] += histogram['sum']
+                merged['count'] += histogram['count']
+    return counters, histograms
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics():
+    """All workers' metrics in Prometheus text exposition format"""
+    flush()
+    counters, histograms = _merge_snapshots()
+
+    lines = []
+    described = set()
+
+    def describe(name):
+        if name not in described and name in METRIC_HELP:
+            kind, help_text = METRIC_HELP[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+        described.add(name)
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name)
+        lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        describe(name)
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram['sum'])}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+    return '\n'.join(lines) + '\n'
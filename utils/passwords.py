@@ -0,0 +1,150 @@
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import threading
+import time
+from config import Config
+from utils.concurrency import make_executor
+
+# Stored format: scrypt$<n>$<r>$<p>$<salt b64>$<hash b64>
+# Hashes without a scheme prefix are legacy unsalted SHA-256 hex digests; they
+# still verify, and login rehashes them with the current parameters.
+SCHEME = 'scrypt'
+
+
+class HashingBusy(Exception):
+    """Too many password hashes queued (or one took too long); the caller should shed the request"""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=32
+    )
+
+
+def _hash(password):
+    n, r, p = Config.SCRYPT_N, Config.SCRYPT_R, Config.SCRYPT_P
+    salt = os.urandom(16)
+    return f'{SCHEME}${n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}'
+
+
+def _verify(password, stored):
+    """Returns (matches, needs_rehash)"""
+    if not stored:
+        return False, False
+
+    if not stored.startswith(f'{SCHEME}$'):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        matches = hmac.compare_digest(legacy, stored)
+        return matches, matches
+
+    try:
+        _, n, r, p, salt, expected = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        actual = _scrypt(password, base64.b64decode(salt), n, r, p)
+    except ValueError:
+        return False, False
+
+    matches = hmac.compare_digest(actual, base64.b64decode(expected))
+    outdated = (n, r, p) != (Config.SCRYPT_N, Config.SCRYPT_R, Config.SCRYPT_P)
+    return matches, matches and outdated
+
+
+# Hashing runs on a small dedicated pool of OS threads (also under gevent,
+# see utils/concurrency.py). The semaphore bounds running plus queued jobs,
+# so a login burst gets HashingBusy instead of parking every request behind
+# the KDF.
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(Config.PASSWORD_HASH_WORKERS + Config.PASSWORD_HASH_QUEUE)
+
+_stats_lock = threading.Lock()
+_stats = {
+    'completed': 0,
+    'rejected': 0,
+    'timed_out': 0,
+    'queue_time_total': 0.0,
+    'queue_time_max': 0.0,
+    'hash_time_total': 0.0,
+}
+
+
+def _get_executor():
+    # Created on first use, after gevent (if any) has patched the worker
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = make_executor(Config.PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+    return _executor
+
+
+def _release_slot(future):
+    _slots.release()
+
+
+def _run(fn, *args):
+    if not _slots.acquire(blocking=False):
+        with _stats_lock:
+            _stats['rejected'] += 1
+        raise HashingBusy()
+
+    submitted = time.perf_counter()
+
+    def job():
+        # Only timestamps here: under gevent this runs on a native thread,
+        # which must not touch the (patched) locks
+        started = time.perf_counter()
+        return fn(*args), started, time.perf_counter()
+
+    try:
+        future = _get_executor().submit(job)
+    except Exception:
+        _slots.release()
+        raise
+    # The slot belongs to the hash, not to this request: it is freed when
+    # the hash finishes, even if we stopped waiting for it. (gevent's pool
+    # runs done callbacks in the hub, so the patched semaphore is safe.)
+    future.add_done_callback(_release_slot)
+
+    try:
+        result, started, finished = future.result(timeout=Config.PASSWORD_HASH_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        with _stats_lock:
+            _stats['timed_out'] += 1
+        raise HashingBusy()
+
+    with _stats_lock:
+        queued = started - submitted
+        _stats['completed'] += 1
+        _stats['queue_time_total'] += queued
+        _stats['queue_time_max'] = max(_stats['queue_time_max'], queued)
+        _stats['hash_time_total'] += finished - started
+    return result
+
+
+def hash_password(password):
+    return _run(_hash, password)
+
+
+def verify_password(password, stored):
+    """Constant-time check; returns (matches, needs_rehash)"""
+    return _run(_verify, password, stored)
+
+
+def get_hashing_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    completed = stats['completed']
+    stats['queue_time_avg'] = stats['queue_time_total'] / completed if completed else 0.0
+    stats['hash_time_avg'] = stats['hash_time_total'] / completed if completed else 0.0
+    stats['workers'] = Config.PASSWORD_HASH_WORKERS
+    stats['queue_limit'] = Config.PASSWORD_HASH_QUEUE
+    return stats
@@ -0,0 +1,343 @@
+import base64
+import binascii
+import glob
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import sys
+import tempfile
+import threading
+from config import Config
+from utils.concurrency import run_blocking
+from utils.jobs import job, enqueue
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# user_preferences.picture holds the sha256 of the image bytes; the bytes
+# themselves live in a picture store. Rows saved before the migration may
+# still hold an inline data URL, which is passed through untouched.
+#
+# Uploads through /api/preferences are staged: the request only checks the
+# image header and stores the original, and a background job decodes the
+# image and writes the thumbnail. A picture is processed once its thumbnail
+# exists; one that turns out not to decode is removed again, along with
+# the rows that refer to it.
+PICTURE_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+DATA_URL_RE = re.compile(r'^data:(image/[\w.+-]+);base64,(.*)$', re.DOTALL)
+
+ORIGINAL = 'original'
+THUMBNAIL = 'thumb'
+VARIANTS = (ORIGINAL, THUMBNAIL)
+# Only raster formats; anything else (e.g. SVG) could run script on our origin
+ALLOWED_CONTENT_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+# Pillow's format name -> the content type a picture is stored and served as
+FORMAT_CONTENT_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+
+
+class PictureError(ValueError):
+    pass
+
+
+class LocalPictureStore:
+    """Keeps pictures on the local filesystem as <root>/<ab>/<hash>-<variant>.<ext>"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _pattern(self, digest, variant):
+        return os.path.join(self.root, digest[:2], f'{digest}-{variant}.*')
+
+    def exists(self, digest, variant=ORIGINAL):
+        return bool(glob.glob(self._pattern(digest, variant)))
+
+    def put(self, digest, variant, data, content_type):
+        directory = os.path.join(self.root, digest[:2])
+        os.makedirs(directory, exist_ok=True)
+        extension = mimetypes.guess_extension(content_type) or '.bin'
+        path = os.path.join(directory, f'{digest}-{variant}{extension}')
+
+        # Write to a temp file and rename so readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, digest):
+        """Remove every variant of a picture"""
+        for variant in VARIANTS:
+            for path in glob.glob(self._pattern(digest, variant)):
+                os.remove(path)
+
+    def open(self, digest, variant=ORIGINAL):
+        """Return (file object, content type) or None if the picture is unknown"""
+        matches = glob.glob(self._pattern(digest, variant))
+        if not matches:
+            return None
+        path = matches[0]
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return open(path, 'rb'), content_type
+
+
+PICTURE_BACKENDS = {
+    'local': lambda: LocalPictureStore(Config.PICTURE_STORAGE_PATH),
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def register_picture_backend(name, factory):
+    PICTURE_BACKENDS[name] = factory
+
+
+def get_picture_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                factory = PICTURE_BACKENDS.get(Config.PICTURE_BACKEND)
+                if factory is None:
+                    raise RuntimeError(f'Unknown picture backend: {Config.PICTURE_BACKEND}')
+                _store = factory()
+    return _store
+
+
+def make_thumbnail(data):
+    """Square, fixed-size JPEG/PNG thumbnail. Returns (bytes, content type)."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+    except Exception:
+        raise PictureError('Invalid image data')
+
+    size = Config.PICTURE_THUMBNAIL_SIZE
+    thumbnail = ImageOps.fit(image, (size, size))
+    output = io.BytesIO()
+    if thumbnail.mode in ('RGBA', 'LA', 'P'):
+        thumbnail.convert('RGBA').save(output, format='PNG', optimize=True)
+        return output.getvalue(), 'image/png'
+    thumbnail.convert('RGB').save(output, format='JPEG', quality=85, optimize=True)
+    return output.getvalue(), 'image/jpeg'
+
+
+def probe_picture(data, content_type):
+    """Reject bytes that aren't an image of the declared type, reading only
+    the header (no decode). The stored extension and the served
+    Content-Type come from content_type, so it must be what the bytes are.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+    except Exception:
+        raise PictureError('Invalid image data')
+    if FORMAT_CONTENT_TYPES.get(image_format) != content_type:
+        raise PictureError('Image data does not match its type')
+
+
+def _put_thumbnail(store, digest, data, content_type):
+    # Pillow releases the GIL; under gevent this keeps the worker's
+    # other requests running while the image is decoded and resized
+    thumbnail = run_blocking(make_thumbnail, data)
+    if thumbnail:
+        store.put(digest, THUMBNAIL, *thumbnail)
+    else:
+        # No imaging library available: the original doubles as thumbnail
+        store.put(digest, THUMBNAIL, data, content_type)
+
+
+def store_picture(data, content_type):
+    """Store raw image bytes and their thumbnail now; returns their content hash"""
+    probe_picture(data, content_type)
+    digest = hashlib.sha256(data).hexdigest()
+    store = get_picture_store()
+
+    if not store.exists(digest, THUMBNAIL):
+        _put_thumbnail(store, digest, data, content_type)
+    if not store.exists(digest, ORIGINAL):
+        store.put(digest, ORIGINAL, data, content_type)
+
+    return digest
+
+
+def stage_picture(data, content_type):
+    """Store the original only and return its hash; see process_picture_later"""
+    digest = hashlib.sha256(data).hexdigest()
+    store = get_picture_store()
+
+    if not store.exists(digest, ORIGINAL):
+        probe_picture(data, content_type)
+        store.put(digest, ORIGINAL, data, content_type)
+
+    return digest
+
+
+def process_picture_later(value):
+    """Queue the thumbnail of a staged picture (after saving the row that refers to it)"""
+    if value and PICTURE_HASH_RE.match(value) and not get_picture_store().exists(value, THUMBNAIL):
+        enqueue('pictures.process', {'digest': value})
+
+
+@job('pictures.process')
+def process_picture(digest):
+    """Decode a staged picture and write its thumbnail, or remove it if it doesn't decode"""
+    store = get_picture_store()
+    if store.exists(digest, THUMBNAIL):
+        return
+    picture = store.open(digest, ORIGINAL)
+    if picture is None:
+        return
+    f, content_type = picture
+    with f:
+        data = f.read()
+
+    try:
+        _put_thumbnail(store, digest, data, content_type)
+    except PictureError:
+        reject_picture(digest)
+
+
+def reject_picture(digest):
+    """Clear a picture that isn't a usable image from every row, then delete it"""
+    from models.user import get_db_connection
+    from models.tables import user_preferences
+    from utils.versions import bump
+    import sqlalchemy as sa
+
+    conn = get_db_connection()
+    try:
+        with conn.begin():
+            user_ids = [row[0] for row in conn.execute(
+                sa.select(user_preferences.c.user_id).where(user_preferences.c.picture == digest))]
+            conn.execute(user_preferences.update().where(user_preferences.c.picture == digest), {"picture": None})
+    finally:
+        conn.close()
+    get_picture_store().delete(digest)
+
+    if user_ids:
+        bump('users', *[f'profile:{user_id}' for user_id in user_ids])
+    log.warning('Removed a picture that is not a valid image', extra={'digest': digest, 'users': user_ids})
+
+
+def store_picture_data_url(value, defer=False):
+    """Turn the picture field sent by the client into what we keep in the row.
+
+    Data URLs are decoded and stored; hashes and /api/pictures URLs of stored
+    pictures are kept as their hash; empty values clear the picture. With defer, the picture
+    is only staged: call process_picture_later once the row is saved.
+    """
+    if not value:
+        return None
+
+    if value.startswith('/api/pictures/'):
+        value = value[len('/api/pictures/'):].split('?', 1)[0]
+    if PICTURE_HASH_RE.match(value):
+        # Only pictures we actually hold; anything else would leave the
+        # profile pointing at a 404
+        if not get_picture_store().exists(value, ORIGINAL):
+            raise PictureError('Unknown picture')
+        return value
+
+    match = DATA_URL_RE.match(value)
+    if not match:
+        raise PictureError('Picture must be an image data URL')
+
+    content_type, payload = match.groups()
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise PictureError('Unsupported image type')
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise PictureError('Picture is not valid base64')
+
+    if len(data) > Config.PICTURE_MAX_BYTES:
+        raise PictureError('Image file too large')
+
+    if defer:
+        return stage_picture(data, content_type)
+    return store_picture(data, content_type)
+
+
+def picture_url(value, variant=ORIGINAL):
+    """Client-facing URL for a stored picture value"""
+    if value and PICTURE_HASH_RE.match(value):
+        url = f'/api/pictures/{value}'
+        return f'{url}?size={THUMBNAIL}' if variant == THUMBNAIL else url
+    return value
+
+
+def with_picture_url(preferences, variant=ORIGINAL):
+    if preferences and 'picture' in preferences:
+        preferences = dict(preferences)
+        preferences['picture'] = picture_url(preferences['picture'], variant)
+    return preferences
+
+
+def migrate_inline_pictures(batch_size=50):
+    """Move data URLs still stored in user_preferences.picture into the store"""
+    from models.user import get_db_connection
+    import sqlalchemy as sa
+
+    conn = get_db_connection()
+    try:
+        ids = [row[0] for row in conn.execute(sa.text(
+            "SELECT id FROM user_preferences WHERE picture LIKE 'data:%' ORDER BY id"
+        ))]
+    finally:
+        conn.close()
+
+    migrated = 0
+    failed = []
+    for start in range(0, len(ids), batch_size):
+        conn = get_db_connection()
+        try:
+            with conn.begin():
+                for pref_id in ids[start:start + batch_size]:
+                    picture = conn.execute(
+                        sa.text('SELECT picture FROM user_preferences WHERE id = :id'),
+                        {"id": pref_id}
+                    ).scalar()
+                    try:
+                        digest = store_picture_data_url(picture)
+                    except PictureError as e:
+                        failed.append((pref_id, str(e)))
+                        continue
+
+                    conn.execute(
+                        sa.text("UPDATE user_preferences SET picture = :picture WHERE id = :id AND picture LIKE 'data:%'"),
+                        {"picture": digest, "id": pref_id}
+                    )
+                    migrated += 1
+        finally:
+            conn.close()
+
+    return migrated, failed
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['migrate']:
+        print('usage: python -m utils.pictures migrate')
+        sys.exit(2)
+
+    migrated, failed = migrate_inline_pictures()
+    print(f'Migrated {migrated} inline pictures')
+    for pref_id, reason in failed:
+        print(f'ERROR: user_preferences.id={pref_id}: {reason}')
+    sys.exit(1 if failed else 0)
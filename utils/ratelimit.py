@@ -0,0 +1,248 @@
+import fcntl
+import hashlib
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from flask import request, jsonify
+from config import Config
+from utils.metrics import inc
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# Per-client rate limits as token buckets. Each bucket holds up to `count`
+# tokens and refills at count/period per second; a request takes one token
+# (or one per item for batches) from every bucket it is limited by, or none
+# at all: it is answered 429 with Retry-After when any of them is short.
+# Views call limit_request() before doing any work, so a throttled login
+# costs neither a users lookup nor a password hash.
+#
+# Limits, by endpoint and key:
+#   login     ip, account (the submitted email from this ip, so guessing at
+#             someone's password from elsewhere can't lock them out)
+#   register  ip
+#   rating    ip, account (the authenticated user)
+#
+# Backends:
+#   memory  buckets in this process (RATE_LIMIT_MAX_KEYS, least recently used
+#           evicted); limits hold per worker. Also the stand-in for tests.
+#   file    one small file per bucket under RATE_LIMIT_PATH, shared by every
+#           worker on the host
+# register_rate_limit_backend() plugs in a store shared across hosts; it
+# needs take_all(buckets) and stats(), where buckets is [(key, rate, burst,
+# cost)] and take_all returns each bucket's retry_after, having taken the
+# cost from every bucket if they were all 0 and from none otherwise.
+
+_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(spec):
+    """'10/minute' -> (tokens per second, burst), or None when turned off"""
+    if not spec or spec.strip() == '0':
+        return None
+    count, _, period = spec.partition('/')
+    count = int(count)
+    period = period.strip()
+    seconds = _PERIODS[period] if period in _PERIODS else float(period)
+    if count <= 0:
+        return None
+    return count / seconds, count
+
+
+RATE_LIMITS = {
+    'login': {'ip': parse_limit(Config.RATE_LIMIT_LOGIN_IP), 'account': parse_limit(Config.RATE_LIMIT_LOGIN_ACCOUNT)},
+    'register': {'ip': parse_limit(Config.RATE_LIMIT_REGISTER_IP)},
+    'rating': {'ip': parse_limit(Config.RATE_LIMIT_RATING_IP), 'account': parse_limit(Config.RATE_LIMIT_RATING_ACCOUNT)},
+}
+
+
+def _take_all(states, buckets, now):
+    """Refill each bucket ((tokens, updated) in states) up to now and take its
+    cost if every one can pay: (new token counts, retry_afters)"""
+    levels = [min(burst, tokens + max(0.0, now - updated) * rate)
+              for (tokens, updated), (_, rate, burst, _) in zip(states, buckets)]
+    retry_afters = [0.0 if tokens >= cost else (cost - tokens) / rate
+                    for tokens, (_, rate, _, cost) in zip(levels, buckets)]
+    if not any(retry_afters):
+        levels = [tokens - cost for tokens, (_, _, _, cost) in zip(levels, buckets)]
+    return levels, retry_afters
+
+
+class MemoryBucketStore:
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take_all(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            states = [self._buckets.pop(key, (burst, now)) for key, _, burst, _ in buckets]
+            levels, retry_afters = _take_all(states, buckets, now)
+            for (key, _, _, _), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                # An evicted bucket comes back full, which only errs towards allowing
+                self._buckets.popitem(last=False)
+        return retry_afters
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        return {'keys': len(self._buckets), 'max_keys': self.max_keys}
+
+
+class FileBucketStore:
+    """Buckets in small files, shared by every worker on the host"""
+
+    # How often (seconds) a worker sweeps out idle bucket files
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, root, max_idle):
+        self.root = root
+        # A bucket untouched this long has refilled completely, so its file
+        # can go: a missing bucket starts full
+        self.max_idle = max_idle
+        os.makedirs(root, exist_ok=True)
+        self._lock_path = os.path.join(root, '.lock')
+        self._pruned_at = time.time()
+
+    def _path(self, key):
+        return os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, key, burst, now):
+        try:
+            with open(self._path(key)) as f:
+                tokens, updated = (float(value) for value in f.read().split())
+            return tokens, updated
+        except (FileNotFoundError, ValueError):
+            return burst, now
+
+    def take_all(self, buckets):
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                states = [self._read(key, burst, now) for key, _, burst, _ in buckets]
+                levels, retry_afters = _take_all(states, buckets, now)
+                for (key, _, _, _), tokens in zip(buckets, levels):
+                    fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(f'{tokens} {now}')
+                    os.replace(tmp_path, self._path(key))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        if now - self._pruned_at > self.PRUNE_INTERVAL:
+            self._pruned_at = now
+            self._prune(now)
+        return retry_afters
+
+    def _prune(self, now):
+        for name in os.listdir(self.root):
+            if name.startswith('.') or name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.path.getmtime(path) > self.max_idle:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {'keys': len([name for name in os.listdir(self.root)
+                             if not name.startswith('.') and not name.endswith('.tmp')])}
+
+
+def _longest_refill():
+    limits = [limit for scopes in RATE_LIMITS.values() for limit in scopes.values() if limit]
+    return max((burst / rate for rate, burst in limits), default=0.0)
+
+
+RATE_LIMIT_BACKENDS = {
+    'memory': lambda: MemoryBucketStore(Config.RATE_LIMIT_MAX_KEYS),
+    'file': lambda: FileBucketStore(Config.RATE_LIMIT_PATH, _longest_refill()),
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def register_rate_limit_backend(name, factory):
+    RATE_LIMIT_BACKENDS[name] = factory
+
+
+def get_rate_limit_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                factory = RATE_LIMIT_BACKENDS.get(Config.RATE_LIMIT_BACKEND)
+                if factory is None:
+                    raise RuntimeError(f'Unknown rate limit backend: {Config.RATE_LIMIT_BACKEND}')
+                _store = factory()
+    return _store
+
+
+def client_ip():
+    """The caller's address, taking PROXY_COUNT trusted proxies into account"""
+    if Config.PROXY_COUNT:
+        # Each proxy appends the address it received the request from, so
+        # the client is PROXY_COUNT entries from the right; anything further
+        # left was sent by the client and can't be trusted
+        forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+        if len(forwarded) >= Config.PROXY_COUNT:
+            return forwarded[-Config.PROXY_COUNT]
+    return request.remote_addr
+
+
+def limit_request(name, cost=1, **keys):
+    """None when the request may go ahead, else a 429 response to return.
+
+    keys gives this request's value for scopes of RATE_LIMITS[name], e.g.
+    limit_request('rating', ip=client_ip(), account=user_id). Every
+    bucket is checked before any is charged, so a request one scope rejects
+    costs the others nothing. cost is the number of tokens to take (capped
+    at the burst, so it can pass).
+    """
+    if not Config.RATE_LIMIT_ENABLED:
+        return None
+
+    scopes = []
+    buckets = []
+    for scope, value in keys.items():
+        limit = RATE_LIMITS[name].get(scope)
+        if limit is None or value is None:
+            continue
+        rate, burst = limit
+        scopes.append(scope)
+        buckets.append((f'{name}:{scope}:{value}', rate, burst, min(cost, burst)))
+    if not buckets:
+        return None
+
+    try:
+        retry_afters = get_rate_limit_store().take_all(buckets)
+    except Exception as e:
+        # A broken store must not lock everyone out
+        log.error('Rate limit store failed', extra={'limit': name, 'error': str(e)})
+        return None
+    if not any(retry_afters):
+        return None
+
+    # Counted against the scope that keeps the client waiting longest
+    retry_after, scope = max(zip(retry_afters, scopes))
+    inc('fantasyfc_rate_limited_total', {'limit': name, 'scope': scope})
+    response = jsonify({'error': 'Too many requests, please try again later'})
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response, 429
+
+
+def get_rate_limit_stats():
+    stats = {'enabled': Config.RATE_LIMIT_ENABLED, 'backend': Config.RATE_LIMIT_BACKEND}
+    stats.update(get_rate_limit_store().stats())
+    return stats
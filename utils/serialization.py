@@ -0,0 +1,173 @@
+import json
+import threading
+from flask import current_app
+from flask.json.provider import DefaultJSONProvider
+from config import Config
+
+# Response serialization.
+#
+# Schemas list the fields an endpoint sends, each with the SQL expression that
+# produces it (defaults applied there with COALESCE), so views select exactly
+# those columns and turn rows into dicts with a precomputed shape instead of
+# patching values row by row.
+#
+# Encoding goes through a pluggable backend used by jsonify (via
+# FastJSONProvider) and by stream_json_array:
+#   json    the standard library
+#   orjson  several times faster, when installed
+#   auto    orjson if it imports, else json (default)
+
+# Types neither encoder handles natively (dates as HTTP dates, Decimal, ...)
+_default = DefaultJSONProvider.default
+
+
+def _json_encoder():
+    def encode(obj):
+        return json.dumps(obj, default=_default, separators=(',', ':')).encode()
+    return encode
+
+
+def _orjson_encoder():
+    import orjson
+
+    # Datetimes go through _default so both backends send the same format
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def encode(obj):
+        return orjson.dumps(obj, default=_default, option=options)
+    return encode
+
+
+def _auto_encoder():
+    try:
+        return _orjson_encoder()
+    except ImportError:
+        return _json_encoder()
+
+
+JSON_BACKENDS = {
+    'json': _json_encoder,
+    'orjson': _orjson_encoder,
+    'auto': _auto_encoder,
+}
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def register_json_backend(name, factory):
+    JSON_BACKENDS[name] = factory
+
+
+def get_encoder():
+    """Function turning a JSON-able object into UTF-8 bytes"""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                factory = JSON_BACKENDS.get(Config.JSON_BACKEND)
+                if factory is None:
+                    raise RuntimeError(f'Unknown JSON backend: {Config.JSON_BACKEND}')
+                _encoder = factory()
+    return _encoder
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """app.json provider that encodes jsonify() responses with the configured backend"""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return get_encoder()(obj).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(get_encoder()(obj) + b'\n', mimetype=self.mimetype)
+
+
+class Field:
+    def __init__(self, name, expression, transform=None):
+        self.name = name
+        # SQL producing the value, e.g. "COALESCE(up.position, 'Not set')"
+        self.expression = expression
+        # Python step for what SQL can't express (applied per row)
+        self.transform = transform
+
+
+class Schema:
+    """The fields one endpoint can send, and how each is selected"""
+
+    def __init__(self, *fields):
+        self.fields = {field.name: field for field in fields}
+        self._shapes = {}
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def select_list(self, names):
+        return ', '.join(f'{self.fields[name].expression} AS {name}' for name in names)
+
+    def row_encoder(self, names):
+        """Function turning a row whose first columns are `names` into a dict.
+
+        Built once per field list and reused for every row of every request.
+        """
+        names = tuple(names)
+        encoder = self._shapes.get(names)
+        if encoder is None:
+            transforms = [(name, self.fields[name].transform) for name in names if self.fields[name].transform]
+            count = len(names)
+            if transforms:
+                def encoder(row):
+                    item = dict(zip(names, row[:count]))
+                    for name, transform in transforms:
+                        item[name] = transform(item[name])
+                    return item
+            else:
+                def encoder(row):
+                    return dict(zip(names, row[:count]))
+            self._shapes[names] = encoder
+        return encoder
+
+
+def stream_json_array(envelope, key, items, status=200):
+    """Respond with {**envelope, key: [items...]}.
+
+    items is an iterable of JSON-able objects (e.g. a generator over rows).
+    Arrays of at least JSON_STREAM_MIN_ITEMS are sent chunked, encoding
+    JSON_STREAM_CHUNK items at a time, so neither the list nor the whole body
+    is held in memory; smaller ones go out as one body. Work that needs the
+    database (or a connection) should be done before calling this: the
+    chunks are produced after the view has returned.
+    """
+    encode = get_encoder()
+    items = iter(items)
+    chunk_size = Config.JSON_STREAM_CHUNK
+
+    head = []
+    for item in items:
+        head.append(item)
+        if len(head) >= Config.JSON_STREAM_MIN_ITEMS:
+            break
+    else:
+        return current_app.response_class(encode({**envelope, key: head}) + b'\n',
+                                          status=status, mimetype='application/json')
+
+    # {"a":1,"b":2} -> {"a":1,"b":2,"<key>":[
+    prefix = encode(envelope)[:-1] + (b',' if envelope else b'') + encode(key) + b':['
+
+    def generate():
+        yield prefix
+        # encode([...]) is "[a,b,c]"; strip the brackets and join the chunks
+        yield encode(head)[1:-1]
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield b',' + encode(chunk)[1:-1]
+                chunk = []
+        if chunk:
+            yield b',' + encode(chunk)[1:-1]
+        yield b']}\n'
+
+    return current_app.response_class(generate(), status=status, mimetype='application/json')
@@ -0,0 +1,187 @@
+import fcntl
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from functools import wraps
+from flask import request, make_response
+from config import Config
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# Per-resource version counters used to validate cached GET responses.
+# Writers bump() the resources they touch after committing; read endpoints
+# wrapped in @conditional answer If-None-Match with 304 straight from the
+# counters, without running the view (no DB, no JSON encoding). Each store
+# also has an epoch, a new one whenever its counters start again from zero,
+# which goes into every tag.
+#
+# Resource keys in use:
+#   users            anything shown in /api/users or /api/leaderboard
+#   matchday         /api/matchday, /api/matchday/<n>, /api/matchday/history
+#   ratings          global generation for all rating breakdowns (renames/deletes)
+#   ratings:<id>     ratings of one user
+#   profile:<id>     one user's profile/preferences
+#   analytics        /api/analytics/* (each models.analytics refresh)
+#   leaderboard      positions, names and players behind /api/leaderboard
+#                    changed (ratings alone only bump users)
+
+
+class MemoryVersionStore:
+    """Counters in this process only. Fine for a single worker or tests."""
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._epoch = uuid.uuid4().hex
+
+    def epoch(self):
+        return self._epoch
+
+    def get(self, key):
+        return self._versions.get(key, (0, None))
+
+    def bump(self, key):
+        with self._lock:
+            version, _ = self._versions.get(key, (0, None))
+            self._versions[key] = (version + 1, time.time())
+
+
+class FileVersionStore:
+    """Counters in small files, shared by every worker on the host"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock_path = os.path.join(root, '.lock')
+        self._epoch_path = os.path.join(root, '.epoch')
+
+    def epoch(self):
+        """Id of this set of counters; a new one whenever the directory starts over"""
+        try:
+            with open(self._epoch_path) as f:
+                epoch = f.read().strip()
+            if epoch:
+                return epoch
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        try:
+            # Whoever links first sets the epoch; everyone reads theirs back
+            os.link(tmp_path, self._epoch_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+        with open(self._epoch_path) as f:
+            return f.read().strip()
+
+    def _path(self, key):
+        return os.path.join(self.root, re.sub(r'[^A-Za-z0-9_.-]', '_', key))
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                version, updated_at = f.read().split()
+            return int(version), float(updated_at)
+        except (FileNotFoundError, ValueError):
+            return 0, None
+
+    def bump(self, key):
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                version, _ = self.get(key)
+                fd, tmp_path = tempfile.mkstemp(dir=self.root)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(f'{version + 1} {time.time()}')
+                os.replace(tmp_path, self._path(key))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+VERSION_BACKENDS = {
+    'memory': MemoryVersionStore,
+    'file': lambda: FileVersionStore(Config.VERSION_STORE_PATH),
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def register_version_backend(name, factory):
+    VERSION_BACKENDS[name] = factory
+
+
+def get_version_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                factory = VERSION_BACKENDS.get(Config.VERSION_BACKEND)
+                if factory is None:
+                    raise RuntimeError(f'Unknown version backend: {Config.VERSION_BACKEND}')
+                _store = factory()
+    return _store
+
+
+def bump(*keys):
+    """Mark resources as changed. Call after the write has committed."""
+    store = get_version_store()
+    for key in keys:
+        try:
+            store.bump(key)
+        except Exception as e:
+            # A missed bump would serve stale 304s, so make it loud
+            log.error('Failed to bump version', extra={'key': key, 'error': str(e)})
+
+
+def conditional(keys, private=True, vary=None):
+    """Add ETag/Last-Modified to a GET view and short-circuit revalidations.
+
+    keys is a list of resource keys, or a callable receiving the view's
+    arguments and returning one (for per-user/per-id resources). vary, also
+    called with the view's arguments, returns anything else the response
+    depends on (e.g. whose rank it shows); it becomes part of the tag.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            resource_keys = keys(*args, **kwargs) if callable(keys) else keys
+
+            # Read versions before running the view so a concurrent write can
+            # only make the tag older than the data, never newer
+            store = get_version_store()
+            versions = [(key, *store.get(key)) for key in resource_keys]
+            # The epoch keeps a tag from before a counter reset (restart,
+            # wiped store) from matching the same numbers counted again
+            tag_source = '|'.join([store.epoch()] + [f'{key}={version}' for key, version, _ in versions])
+            if vary is not None:
+                tag_source += f'|{vary(*args, **kwargs)}'
+            etag = hashlib.sha1(tag_source.encode()).hexdigest()[:20]
+            timestamps = [updated_at for _, _, updated_at in versions if updated_at]
+            last_modified = formatdate(max(timestamps), usegmt=True) if timestamps else None
+            cache_control = 'private, no-cache' if private else 'no-cache'
+
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified:
+                response.headers['Last-Modified'] = last_modified
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return decorated
+    return decorator
@@ -1,4 +1,6 @@
 from app import app
 
 if __name__ == "__main__":
+    from utils.jobs import start_workers
+    start_workers()
     app.run()
\ No newline at end of file